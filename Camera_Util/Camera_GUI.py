@@ -12,9 +12,10 @@ import numpy as np
 import tifffile
 from scene_imager import setup_thorlabs_cam, take_and_save_thorlabs_image, setup_cubert_cam, take_and_save_cubert_image
 import scene_imager as si
+from dark_capture_worker import DarkCaptureWorker
 from PyQt5.QtGui import QPixmap, QImage
 from PyQt5.QtCore import Qt
-from PyQt5.QtCore import QTimer, Qt
+from PyQt5.QtCore import QTimer, Qt, QThread
 from PyQt5.QtGui import QColor, QFont, QPalette
 
 class CameraGUI(QWidget):   
@@ -33,6 +34,8 @@ class CameraGUI(QWidget):
         self.countdown_timer.timeout.connect(self.update_countdown)
         self.remaining_seconds = 0
         self.auto_mode_active = False  # Track if auto mode is active
+        self.dark_thread = None  # QThread running the dark capture
+        self.dark_worker = None
 
         # Variables to store dark calibration file paths
         self.dark_cal_tl = None
@@ -100,6 +103,13 @@ class CameraGUI(QWidget):
 
         countdown_layout.addLayout(dark_cal_layout)
 
+        # Master darks of both cams, with the lenses covered
+        self.dark_capture_button = QPushButton("Capture Darks")
+        self.dark_capture_button.clicked.connect(self.capture_darks)
+        self.dark_progress_label = QLabel("Darks: Idle")
+        countdown_layout.addWidget(self.dark_progress_label)
+        countdown_layout.addWidget(self.dark_capture_button)
+
         # Auto mode
         auto_layout = QHBoxLayout()
         self.interval_input = QLineEdit()
@@ -119,6 +129,8 @@ class CameraGUI(QWidget):
     def initCameras(self):
         self.cam_tl = setup_thorlabs_cam()
         self.acquisitionContext, self.processingContext, _ = setup_cubert_cam()
+        si.load_defect_map()
+        si.start_frame_writer()
 
     def select_folder(self):
         folder = QFileDialog.getExistingDirectory(self, "Select Folder")
@@ -128,12 +140,16 @@ class CameraGUI(QWidget):
             si.cubert_image_folder = os.path.join(folder, "cubert")
             os.makedirs(si.thorlabs_image_folder, exist_ok=True)
             os.makedirs(si.cubert_image_folder, exist_ok=True)
+            si.dark_folder = os.path.join(folder, "darks")
+            # Frames saved from now on are indexed in the catalog of the new folder
+            si.frame_catalog_path = os.path.join(folder, "frame_catalog.sqlite")
+            si.close_frame_catalog()
             self.folder_input.setText(folder)
 
     def select_dark_cal_tl(self):
         file, _ = QFileDialog.getOpenFileName(self, "Select Thorlabs Dark Cal File", "", "All Files (*.*)")
         if file:
-            self.dark_cal_tl = np.load(file)
+            self.dark_cal_tl = si.load_dark(file)
             self.dark_cal_tl_label.setText(f"Thorlabs Dark Cal: {os.path.basename(file)}")
         else:
             self.dark_cal_tl = None
@@ -142,16 +158,69 @@ class CameraGUI(QWidget):
         
         file, _ = QFileDialog.getOpenFileName(self, "Select Cubert Dark Cal File", "", "All Files (*.*)")
         if file:
-            self.dark_cal_cb = np.load(file)
+            self.dark_cal_cb = si.load_dark(file)
             self.dark_cal_cb_label.setText(f"Cubert Dark Cal: {os.path.basename(file)}")
         else:
             self.dark_cal_cb = None
 
+    def capture_darks(self):
+        # A second click cancels the running capture
+        if self.dark_thread is not None:
+            self.dark_worker.cancel()
+            self.dark_capture_button.setEnabled(False)
+            self.dark_progress_label.setText("Darks: Cancelling after current frame...")
+            return
+
+        # Run the capture on a worker thread so the UI stays responsive
+        self.dark_thread = QThread()
+        self.dark_worker = DarkCaptureWorker(self, si.capture_darks)
+        self.dark_worker.moveToThread(self.dark_thread)
+        self.dark_thread.started.connect(self.dark_worker.run)
+        self.dark_worker.progress.connect(self.dark_progress_label.setText)
+        self.dark_worker.error.connect(self.on_darks_error)
+        self.dark_worker.finished.connect(self.on_darks_finished)
+        self.dark_worker.finished.connect(self.dark_thread.quit)
+        self.dark_thread.finished.connect(self.on_dark_thread_finished)
+
+        self.dark_capture_button.setText("Cancel Darks")
+        self.dark_progress_label.setText("Darks: Capturing...")
+        self.dark_thread.start()
+
+    def on_darks_error(self, message):
+        print(f"Dark capture error: {message}")
+        self.dark_progress_label.setText(f"Darks: Error: {message}")
+
+    def on_dark_thread_finished(self):
+        # Only drop the references once the thread has actually stopped
+        self.dark_thread.deleteLater()
+        self.dark_worker.deleteLater()
+        self.dark_thread = None
+        self.dark_worker = None
+        self.dark_capture_button.setText("Capture Darks")
+        self.dark_capture_button.setEnabled(True)
+
+    def on_darks_finished(self, paths):
+        self.cam_tl = self.dark_worker.cam_tl
+
+        # Use the new darks right away
+        if paths["tl"] is not None:
+            self.dark_cal_tl = si.load_dark(paths["tl"])
+            self.dark_cal_tl_label.setText(f"Thorlabs Dark Cal: {os.path.basename(paths['tl'])}")
+        if paths["cb"] is not None:
+            self.dark_cal_cb = si.load_dark(paths["cb"])
+            self.dark_cal_cb_label.setText(f"Cubert Dark Cal: {os.path.basename(paths['cb'])}")
+        done = paths["tl"] is not None and paths["cb"] is not None
+        self.dark_progress_label.setText("Darks: Captured" if done else "Darks: Capture incomplete")
+
     def capture_images(self):
         if not self.folder_path:
             print("Please select a folder to save images.")
             return
 
+        if self.dark_thread is not None:
+            print("Dark capture running, no images taken.")
+            return
+
         if self.auto_mode_active:
             self.countdown_label.setText("Imaging")
             self.update_countdown_color(imaging=True)
@@ -174,6 +243,10 @@ class CameraGUI(QWidget):
         tl_path = os.path.join(self.folder_path, f"thorlabs/{img_name}_thorlabs.tif")
         cb_path = os.path.join(self.folder_path, f"cubert/{img_name}_cubert.tif")
 
+        # Previews are read back from disk, so wait for queued writes
+        if si.frame_writer is not None:
+            si.frame_writer.flush()
+
         if os.path.exists(tl_path):
             self.display_image(tl_path, self.tl_label, channel=0, max_size=(500, 500), tl_flag = True)
         if os.path.exists(cb_path):
@@ -259,6 +332,14 @@ class CameraGUI(QWidget):
             self.remaining_seconds = int(self.interval_input.text())
             self.countdown_timer.start(1000)
 
+    def closeEvent(self, event):
+        if self.dark_thread is not None:
+            self.dark_worker.cancel()
+            self.dark_thread.quit()
+            self.dark_thread.wait()
+        si.stop_frame_writer()
+        super().closeEvent(event)
+
     def update_countdown_color(self, remaining_seconds=0, imaging=False):
         palette = self.countdown_label.palette()
         if imaging:
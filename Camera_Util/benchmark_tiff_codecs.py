@@ -0,0 +1,132 @@
+"""
+Size/speed benchmark of the TIFF codecs for Thorlabs and Cubert frames.
+
+Writes a TL polarization stack and a CB cube with every codec in TIFF_CODECS, with and
+without predictor, and reports the write time, read time and compression ratio, so the
+tiff_compression_tl / tiff_compression_cb settings of scene_imager can be chosen per
+deployment. The CB cube is also tried as float32 (save_dtype_cb).
+
+Real frames give the most meaningful numbers, pass a saved pair with --tl / --cb.
+Without them representative frames are taken from the simulated cams.
+
+Example:
+    python benchmark_tiff_codecs.py --tl example_images/thorlabs/img_0001_thorlabs.tif --cb example_images/cubert/img_0001_cubert.tif
+"""
+import os
+import json
+import time
+import argparse
+from datetime import timedelta
+import tempfile
+import numpy as np
+import tifffile
+from frame_writer import TIFF_CODECS, tiff_options
+
+
+## Representative frames from the simulated cams
+def simulated_frames(seed=0):
+    import camera_backends
+    from polar_processing import PolarStackProcessor
+
+    camera_backends.show_scene("benchmark")
+    cam_tl = camera_backends.SimulatedThorlabsCamera(latency_scale=0, seed=seed)
+    cam_tl.set_exposure(0.2)
+    raw = cam_tl.snap()
+    dark = raw.dtype.type(cam_tl.dark_level)
+    np.maximum(raw, dark, out=raw)
+    raw -= dark
+    tl = PolarStackProcessor((399, 1059, 1177, 1837)).process(raw)
+
+    acq = camera_backends.SimulatedCubertAcquisition(latency_scale=0, seed=seed + 1)
+    mesu, _ = acq.capture().get(timedelta(seconds=10))
+    proc = camera_backends.SimulatedCubertProcessing(latency_scale=0)
+    proc.apply(mesu)
+    cube = np.asarray(mesu.data["cube"].array).transpose(2, 0, 1).astype(np.float64)
+    cube = np.maximum(cube - acq.dark_level, 0)[:, 75:195, 116:236]
+    return tl, cube
+
+
+## Write and read a frame with one codec
+def time_codec(data, folder, compression, predictor, repeat):
+    path = os.path.join(folder, "frame.tif")
+    options = tiff_options(compression, predictor=predictor)
+
+    write_s = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        tifffile.imwrite(path, data, **options)
+        write_s.append(time.perf_counter() - t0)
+    size = os.path.getsize(path)
+
+    read_s = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        back = tifffile.imread(path)
+        read_s.append(time.perf_counter() - t0)
+    if not np.array_equal(back.reshape(data.shape), data):
+        raise RuntimeError(f"{compression} did not round-trip the frame.")
+
+    return {
+        "compression": compression,
+        "predictor": bool(predictor and compression is not None),
+        "size_mb": size / 1e6,
+        "ratio": data.nbytes / size,
+        "write_ms": 1e3 * float(np.median(write_s)),
+        "read_ms": 1e3 * float(np.median(read_s)),
+    }
+
+
+## Benchmark all codecs on one frame
+def benchmark_frame(label, data, repeat):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for compression in TIFF_CODECS:
+            for predictor in ((False,) if compression in (None, "packbits") else (False, True)):
+                try:
+                    r = time_codec(data, tmp, compression, predictor, repeat)
+                except Exception as e:
+                    print(f"{label}: {compression} failed: {e}")
+                    continue
+                r["frame"] = label
+                results.append(r)
+    return results
+
+
+def print_results(label, data, results):
+    print(f"\n{label}: shape {data.shape}, {data.dtype}, {data.nbytes / 1e6:.1f} MB")
+    print(f"{'codec':<10}{'predictor':>10}{'size MB':>10}{'ratio':>8}{'write ms':>10}{'read ms':>10}")
+    for r in results:
+        print(f"{str(r['compression']):<10}{str(r['predictor']):>10}{r['size_mb']:>10.2f}{r['ratio']:>8.2f}{r['write_ms']:>10.1f}{r['read_ms']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare TIFF codecs on Thorlabs and Cubert frames.")
+    parser.add_argument("--tl", help="Saved TL stack (.tif), simulated if not given.")
+    parser.add_argument("--cb", help="Saved CB cube (.tif), simulated if not given.")
+    parser.add_argument("--repeat", type=int, default=5, help="Writes/reads per codec, the median is reported.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Optional file the results are written to.")
+    args = parser.parse_args()
+
+    if args.tl is None or args.cb is None:
+        sim_tl, sim_cb = simulated_frames(args.seed)
+    tl = tifffile.imread(args.tl) if args.tl else sim_tl
+    cb = tifffile.imread(args.cb) if args.cb else sim_cb
+
+    frames = [("TL", tl), ("CB", cb)]
+    if cb.dtype == np.float64:
+        frames.append(("CB float32", cb.astype(np.float32)))
+
+    all_results = []
+    for label, data in frames:
+        results = benchmark_frame(label, data, args.repeat)
+        print_results(label, data, results)
+        all_results += results
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(all_results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import threading
+import numpy as np
+
+
+class BufferPool:
+    """
+    Pool of reusable numpy arrays keyed by shape and dtype.
+
+    The capture stages take their output arrays from the pool and give them back once
+    they are done with them, e.g. from the FrameWriter on_done callback after the frame
+    is on disk. Memory then stays flat over long runs instead of allocating several
+    full-size arrays per frame. Buffers are handed out uninitialized. Arrays that did not
+    come from the pool are ignored by release(), so they neither enter the pool nor change
+    the outstanding count.
+
+    Parameters:
+        max_per_key (int): Free buffers kept per (shape, dtype), extra ones are dropped.
+    """
+
+    def __init__(self, max_per_key=4):
+        self.max_per_key = max_per_key
+        self._free = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.dropped = 0
+        self.outstanding = 0
+        self._issued = set()  # id() of the buffers handed out and not yet released
+
+    def acquire(self, shape, dtype):
+        key = (tuple(shape), np.dtype(dtype))
+        with self._lock:
+            free = self._free.get(key)
+            self.outstanding += 1
+            if free:
+                self.hits += 1
+                buffer = free.pop()
+                self._issued.add(id(buffer))
+                return buffer
+            self.misses += 1
+        buffer = np.empty(key[0], dtype=key[1])
+        with self._lock:
+            self._issued.add(id(buffer))
+        return buffer
+
+    def release(self, buffer):
+        if buffer is None:
+            return
+        key = (buffer.shape, buffer.dtype)
+        with self._lock:
+            if id(buffer) not in self._issued:
+                return
+            self._issued.discard(id(buffer))
+            self.outstanding -= 1
+            free = self._free.setdefault(key, [])
+            if len(free) < self.max_per_key:
+                free.append(buffer)
+            else:
+                self.dropped += 1
+
+    def releaser(self, *buffers):
+        """Callback that releases buffers, usable as FrameWriter on_done."""
+        def release(error=None):
+            for b in buffers:
+                self.release(b)
+        return release
+
+    def stats(self):
+        with self._lock:
+            pooled = sum(len(v) for v in self._free.values())
+            pooled_mb = sum(b.nbytes for v in self._free.values() for b in v) / 1e6
+            return {"hits": self.hits, "misses": self.misses, "dropped": self.dropped,
+                    "outstanding": self.outstanding, "pooled": pooled, "pooled_mb": pooled_mb}
+
+    def report(self):
+        s = self.stats()
+        total = s["hits"] + s["misses"]
+        hit_rate = 100 * s["hits"] / total if total else 0
+        return (f"Buffer pool: {s['hits']} hits, {s['misses']} misses ({hit_rate:.1f}% hit rate), "
+                f"{s['outstanding']} in use, {s['pooled']} pooled ({s['pooled_mb']:.1f} MB), {s['dropped']} dropped")
@@ -0,0 +1,436 @@
+import os
+import time
+import platform
+import zlib
+import numpy as np
+
+from polar_processing import POLAR_LATTICE
+
+## Parameters
+# Driver folders of the acquisition PC, only used by the hardware backend on Windows
+dll_directories = [
+    r"C:\\Users\\menon\\Documents\\FTDI_drivers\\amd64",
+    r"C:\\Program Files\\Cuvis\\bin",
+    r"C:\\Users\\menon\\AppData\\Local\\Programs\\Python\\Python312\\Lib\\site-packages\\cuvis_il",
+]
+cuvis_dir = r"C:\\Program Files\\Cuvis"
+
+BACKENDS = ("hardware", "simulated")
+
+_drivers_loaded = False
+
+
+## Open the Thorlabs camera of the given backend
+def open_thorlabs_cam(backend, exposure_ms, roi, **sim_options):
+    """
+    Returns a camera with the pylablib ThorlabsTLCamera interface used by scene_imager
+    (snap, set_exposure, set_roi, close, ...).
+
+    Parameters:
+        backend (str): "hardware" or "simulated".
+        exposure_ms (float): Exposure time in ms.
+        roi (tuple): (hstart, hend, vstart, vend) in sensor pixels.
+        sim_options: Keyword arguments for SimulatedThorlabsCamera.
+    """
+    _check_backend(backend)
+    if backend == "simulated":
+        cam = SimulatedThorlabsCamera(**sim_options)
+    else:
+        _load_hardware_drivers()
+        from pylablib.devices import Thorlabs as tl
+        tl.list_cameras_tlcam()
+        cam = tl.ThorlabsTLCamera()
+    cam.set_exposure(exposure_ms * 1e-3)
+    cam.set_roi(*roi, hbin=1, vbin=1)
+    return cam
+
+
+## Open the Cubert camera of the given backend
+def open_cubert_cam(backend, integration_time_ms, distance_mm, export_dir, **sim_options):
+    """
+    Returns (acquisitionContext, processingContext, cubeExporter) with the cuvis interface
+    used by scene_imager. The simulated backend has no exporter and returns None for it.
+
+    Parameters:
+        backend (str): "hardware" or "simulated".
+        integration_time_ms (float): Integration time in ms.
+        distance_mm (float): Object distance in mm.
+        export_dir (str): Export folder of the cuvis cube exporter.
+        sim_options: Keyword arguments for SimulatedCubertAcquisition.
+    """
+    _check_backend(backend)
+    if backend == "simulated":
+        acquisitionContext = SimulatedCubertAcquisition(**sim_options)
+        processingContext = SimulatedCubertProcessing(latency_scale=acquisitionContext.latency_scale)
+        cubeExporter = None
+    else:
+        _load_hardware_drivers()
+        import cuvis
+        data_dir = os.getenv("CUVIS") if platform.system() == "Windows" else os.getenv("CUVIS_DATA")
+        factory_dir = os.path.join(data_dir, "factory")
+        userSettingsDir = os.path.join(data_dir, os.pardir, "settings")
+
+        settings = cuvis.General(userSettingsDir)
+        settings.set_log_level("info")
+
+        calibration = cuvis.Calibration(factory_dir)
+        processingContext = cuvis.ProcessingContext(calibration)
+        acquisitionContext = cuvis.AcquisitionContext(calibration)
+
+        saveArgs = cuvis.SaveArgs(export_dir=export_dir, allow_overwrite=True, allow_session_file=True)
+        cubeExporter = cuvis.CubeExporter(saveArgs)
+
+        while acquisitionContext.state == cuvis.HardwareState.Offline:
+            print(".", end="")
+            time.sleep(1)
+        print("\nCubert camera is online.")
+
+        acquisitionContext.operation_mode = cuvis.OperationMode.Software
+
+    acquisitionContext.integration_time = integration_time_ms
+    processingContext.calc_distance(distance_mm)
+    return acquisitionContext, processingContext, cubeExporter
+
+
+## Stream frames from the Thorlabs cam at its native frame rate, e.g. for a live view
+def stream_thorlabs_frames(cam, should_stop, timeout=5.0):
+    """Yields frames of a continuous acquisition until should_stop() returns True."""
+    cam.start_acquisition()
+    try:
+        while not should_stop():
+            cam.wait_for_frame(timeout=timeout)
+            frame = cam.read_newest_image()
+            if frame is not None:
+                yield frame
+    finally:
+        cam.stop_acquisition()
+
+
+## Re-arm the Thorlabs acquisition after a frame timeout, keeping the cam open
+def rearm_thorlabs_cam(cam):
+    cam.stop_acquisition()
+    cam.clear_acquisition()
+    return cam
+
+
+## Close and reopen the same Thorlabs cam handle, without re-enumerating the cams
+def reopen_thorlabs_cam(cam, exposure_ms, roi):
+    try:
+        cam.close()
+    except Exception:
+        pass
+    cam.open()
+    cam.set_exposure(exposure_ms * 1e-3)
+    cam.set_roi(*roi, hbin=1, vbin=1)
+    return cam
+
+
+## Wait until the Cubert camera is online again after a failed capture
+def wait_cubert_online(acquisitionContext, timeout_s=30.0):
+    if isinstance(acquisitionContext, SimulatedCubertAcquisition):
+        return acquisitionContext
+    import cuvis
+    t_end = time.monotonic() + timeout_s
+    while acquisitionContext.state == cuvis.HardwareState.Offline:
+        if time.monotonic() > t_end:
+            raise ConnectionError(f"Cubert camera not online after {timeout_s:.0f}s.")
+        time.sleep(0.5)
+    return acquisitionContext
+
+
+## Point the simulated cams at a new scene (e.g. the image shown on the display)
+def show_scene(name):
+    simulated_scene.show(name)
+
+
+def _check_backend(backend):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown camera backend '{backend}', expected one of {BACKENDS}.")
+
+
+def _load_hardware_drivers():
+    global _drivers_loaded
+    if _drivers_loaded:
+        return
+    if os.name == "nt":
+        for d in dll_directories:
+            os.add_dll_directory(d)
+        os.environ.setdefault("CUVIS", cuvis_dir)
+    _drivers_loaded = True
+
+
+class SimulatedScene:
+    """
+    Scene seen by both simulated cams. The scene content is derived from its name, so
+    the same display image always gives the same radiance, spectrum and polarization.
+    The name None is a covered lens (brightness 0), for dark frames.
+    """
+
+    def __init__(self):
+        self.name = None
+        self.seed = 0
+        self.brightness = 1.0
+        self.show("default")
+
+    def show(self, name):
+        self.name = name
+        self.seed = zlib.crc32(str(name).encode())
+        rng = np.random.default_rng(self.seed)
+        self.brightness = rng.uniform(0.3, 3.0) if name is not None else 0.0
+
+    def radiance(self, shape, dtype=np.float32):
+        """Smooth relative radiance map in [0, 1] of the given shape."""
+        rng = np.random.default_rng(self.seed)
+        coarse = rng.uniform(0.2, 1.0, size=(8, 8)).astype(dtype)
+        ry = -(-shape[0] // 8)
+        rx = -(-shape[1] // 8)
+        img = np.repeat(np.repeat(coarse, ry, axis=0), rx, axis=1)[:shape[0], :shape[1]]
+        yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+        img *= (0.75 + 0.25 * np.cos(2 * np.pi * xx / shape[1]) * np.cos(np.pi * yy / shape[0])).astype(dtype)
+        return img
+
+    def polarization(self):
+        """(degree, angle in rad) of linear polarization."""
+        rng = np.random.default_rng(self.seed + 1)
+        return rng.uniform(0.0, 0.6), rng.uniform(0, np.pi)
+
+    def spectrum(self, bands):
+        """Relative spectrum over the given number of bands."""
+        rng = np.random.default_rng(self.seed + 2)
+        x = np.linspace(0, 1, bands)
+        spec = np.zeros(bands)
+        for _ in range(3):
+            spec += rng.uniform(0.2, 1.0) * np.exp(-0.5 * ((x - rng.uniform(0, 1)) / rng.uniform(0.05, 0.3)) ** 2)
+        return spec / spec.max()
+
+
+simulated_scene = SimulatedScene()
+
+
+class SimulatedThorlabsCamera:
+    """
+    Stand-in for pylablib's ThorlabsTLCamera that produces 12-bit polarization mosaics.
+
+    Pixel values follow signal = rate * exposure with Malus-law modulation per polarizer
+    site, plus a dark bias, shot and read noise. snap() blocks for the exposure time
+    (times latency_scale) and the readout time.
+
+    Parameters:
+        sensor_shape (tuple): (height, width) of the sensor.
+        peak_rate (float): Counts per ms of the brightest pixel at brightness 1.
+        dark_level (float): Mean dark bias in counts.
+        read_noise (float): Read noise in counts.
+        readout_s (float): Readout time per frame in s.
+        latency_scale (float): Scales all waiting times, 0 returns frames immediately.
+        failure_rate (float): Probability that a snap times out.
+        disconnect_rate (float): Probability that a snap disconnects the cam until it is reopened.
+        seed (int): Seed of the noise generator.
+    """
+
+    def __init__(self, sensor_shape=(2048, 2448), peak_rate=14.0, dark_level=10.0, read_noise=2.5, readout_s=0.05,
+                 latency_scale=1.0, failure_rate=0.0, disconnect_rate=0.0, seed=None):
+        self.sensor_shape = sensor_shape
+        self.peak_rate = peak_rate
+        self.dark_level = dark_level
+        self.read_noise = read_noise
+        self.readout_s = readout_s
+        self.latency_scale = latency_scale
+        self.failure_rate = failure_rate
+        self.disconnect_rate = disconnect_rate
+        self._rng = np.random.default_rng(seed)
+        self._exposure = 0.1
+        self._roi = (0, sensor_shape[1], 0, sensor_shape[0], 1, 1)
+        self._opened = True
+        self._scene_key = None
+        self._rate = None
+        self._newest = None
+
+        # Fixed-pattern dark: bias with a few hot pixels
+        self._dark = np.full(sensor_shape, dark_level, dtype=np.float32)
+        n_hot = sensor_shape[0] * sensor_shape[1] // 50000
+        hot = self._rng.integers(0, self._dark.size, n_hot)
+        self._dark.flat[hot] += self._rng.uniform(200, 2000, n_hot).astype(np.float32)
+        self._dark_rate = np.zeros(sensor_shape, dtype=np.float32)
+        self._dark_rate.flat[hot] += self._rng.uniform(0.1, 2.0, n_hot).astype(np.float32)
+
+    def open(self):
+        self._opened = True
+
+    def close(self):
+        self._opened = False
+
+    def is_opened(self):
+        return self._opened
+
+    def set_exposure(self, exposure):
+        self._exposure = float(exposure)
+        return self._exposure
+
+    def get_exposure(self):
+        return self._exposure
+
+    def set_roi(self, hstart=0, hend=None, vstart=0, vend=None, hbin=1, vbin=1):
+        hend = self.sensor_shape[1] if hend is None else hend
+        vend = self.sensor_shape[0] if vend is None else vend
+        self._roi = (hstart, hend, vstart, vend, hbin, vbin)
+        return self._roi
+
+    def get_roi(self):
+        return self._roi
+
+    def start_acquisition(self):
+        self._check_opened()
+        self._newest = None
+
+    def stop_acquisition(self):
+        self._newest = None
+
+    def clear_acquisition(self):
+        self._newest = None
+
+    def wait_for_frame(self, timeout=5.0):
+        self._newest = self.snap(timeout)
+
+    def read_newest_image(self):
+        frame, self._newest = self._newest, None
+        return frame
+
+    def snap(self, timeout=5.0):
+        self._check_opened()
+        exposure_ms = self._exposure * 1e3
+        time.sleep((self._exposure + self.readout_s) * self.latency_scale)
+
+        if self._rng.random() < self.disconnect_rate:
+            self._opened = False
+            raise ConnectionError("Simulated TL cam disconnected.")
+        if self._rng.random() < self.failure_rate:
+            raise TimeoutError("Simulated TL frame timeout.")
+
+        signal = self._scene_rate() * exposure_ms
+        signal += self._dark + self._dark_rate * exposure_ms
+        noise = self._rng.standard_normal(signal.shape, dtype=np.float32)
+        noise *= np.sqrt(signal + self.read_noise ** 2)
+        signal += noise
+        np.clip(signal, 0, 4095, out=signal)
+
+        hstart, hend, vstart, vend, _, _ = self._roi
+        return signal[vstart:vend, hstart:hend].astype(np.uint16)
+
+    def _scene_rate(self):
+        # Mosaic of counts per ms, cached until the scene changes
+        key = (simulated_scene.seed, simulated_scene.brightness)
+        if key != self._scene_key:
+            dolp, aolp = simulated_scene.polarization()
+            rate = simulated_scene.radiance(self.sensor_shape) * (self.peak_rate * simulated_scene.brightness)
+            for angle, (oy, ox) in POLAR_LATTICE.items():
+                rate[oy::2, ox::2] *= 0.5 * (1 + dolp * np.cos(2 * (np.deg2rad(angle) - aolp)))
+            self._rate = rate
+            self._scene_key = key
+        return self._rate
+
+    def _check_opened(self):
+        if not self._opened:
+            raise ConnectionError("Simulated TL cam is not connected.")
+
+
+class _SimulatedCube:
+    def __init__(self, array):
+        self.array = array
+
+
+class SimulatedMeasurement:
+    """Stand-in for cuvis.Measurement. data['cube'] is only filled by processing."""
+
+    def __init__(self, raw, integration_time):
+        self.name = None
+        self.raw = raw
+        self.integration_time = integration_time
+        self.data = {}
+
+    def set_name(self, name):
+        self.name = name
+
+
+class _SimulatedAsyncMeasurement:
+    def __init__(self, acquisition, ready_at, measurement, error):
+        self._acquisition = acquisition
+        self._ready_at = ready_at
+        self._measurement = measurement
+        self._error = error
+
+    def get(self, timeout):
+        wait = self._ready_at - time.monotonic()
+        if wait > timeout.total_seconds():
+            time.sleep(timeout.total_seconds())
+            return None, "timeout"
+        time.sleep(max(0.0, wait))
+        if self._error is not None:
+            raise self._error
+        return self._measurement, "done"
+
+
+class SimulatedCubertAcquisition:
+    """
+    Stand-in for cuvis.AcquisitionContext that produces 12-bit hyperspectral cubes.
+
+    capture() returns immediately, the measurement becomes available once the
+    integration time (times latency_scale) and readout time have passed.
+
+    Parameters:
+        cube_shape (tuple): (height, width, bands) of the processed cube.
+        peak_rate (float): Counts per ms of the brightest pixel at brightness 1.
+        dark_level (float): Mean dark bias in counts.
+        read_noise (float): Read noise in counts.
+        readout_s (float): Readout time per cube in s.
+        latency_scale (float): Scales all waiting times, 0 returns cubes immediately.
+        failure_rate (float): Probability that a capture fails.
+        seed (int): Seed of the noise generator.
+    """
+
+    def __init__(self, cube_shape=(275, 290, 106), peak_rate=0.6, dark_level=80.0, read_noise=4.0, readout_s=0.2,
+                 latency_scale=1.0, failure_rate=0.0, seed=None):
+        self.cube_shape = cube_shape
+        self.peak_rate = peak_rate
+        self.dark_level = dark_level
+        self.read_noise = read_noise
+        self.readout_s = readout_s
+        self.latency_scale = latency_scale
+        self.failure_rate = failure_rate
+        self.state = "online"
+        self.operation_mode = "software"
+        self.integration_time = 100
+        self._rng = np.random.default_rng(seed)
+
+    def capture(self):
+        integration_s = self.integration_time * 1e-3
+        ready_at = time.monotonic() + (integration_s + self.readout_s) * self.latency_scale
+
+        if self._rng.random() < self.failure_rate:
+            return _SimulatedAsyncMeasurement(self, ready_at, None, RuntimeError("Simulated CB capture failed."))
+
+        h, w, bands = self.cube_shape
+        radiance = simulated_scene.radiance((h, w))
+        spectrum = simulated_scene.spectrum(bands).astype(np.float32)
+        signal = radiance[:, :, None] * spectrum[None, None, :] * (self.peak_rate * simulated_scene.brightness * self.integration_time)
+        signal += self.dark_level
+        signal += self._rng.standard_normal(signal.shape, dtype=np.float32) * np.sqrt(signal + self.read_noise ** 2)
+        np.clip(signal, 0, 4095, out=signal)  # 12-bit raw counts
+        mesu = SimulatedMeasurement(signal.astype(np.uint16), self.integration_time)
+        return _SimulatedAsyncMeasurement(self, ready_at, mesu, None)
+
+
+class SimulatedCubertProcessing:
+    """Stand-in for cuvis.ProcessingContext. apply() turns the raw data into data['cube']."""
+
+    def __init__(self, processing_s=0.3, latency_scale=1.0):
+        self.processing_s = processing_s
+        self.latency_scale = latency_scale
+        self.distance = None
+
+    def calc_distance(self, distance):
+        self.distance = distance
+
+    def apply(self, mesu):
+        time.sleep(self.processing_s * self.latency_scale)
+        mesu.data["cube"] = _SimulatedCube(mesu.raw)
+        return mesu
@@ -0,0 +1,142 @@
+import time
+
+# Error classes of classify_error()
+TIMEOUT = "timeout"
+DISCONNECT = "disconnect"
+OTHER = "other"
+
+
+## Sort a camera exception into timeout, disconnect or other
+def classify_error(error):
+    """
+    Timeouts (a frame did not arrive in time) usually only need the acquisition re-armed,
+    disconnects (USB glitch, cam gone) need the device reopened. pylablib and cuvis raise
+    their own exception types, so the class name and message are checked as well.
+    """
+    name = type(error).__name__.lower()
+    message = str(error).lower()
+    if isinstance(error, TimeoutError) or "timeout" in name or "timed out" in message or "timeout" in message:
+        return TIMEOUT
+    if isinstance(error, (ConnectionError, BrokenPipeError)) or "disconnect" in name or any(
+            s in message for s in ("disconnect", "not connected", "not opened", "no device", "usb")):
+        return DISCONNECT
+    return OTHER
+
+
+class RecoveryManager:
+    """
+    Recovers a camera after a failed frame with the cheapest step that works.
+
+    The steps, from cheap to expensive, are:
+        rearm(device)  -- e.g. stop and clear the acquisition, the handle stays open
+        reopen(device) -- close and reopen the same handle, restore exposure and ROI
+        reinit(device) -- full setup, re-enumerating the cams
+    Each returns the (possibly new) device. Timeouts start with rearm, disconnects with
+    reopen. A step is escalated once it failed attempts times in a row, or right away if
+    the step itself raises. reopen and reinit wait with exponential backoff first, so a
+    cam that needs a moment after a USB glitch is not hammered with reopen calls.
+
+    Counters of failures per error class, recovery steps and the time from the first
+    failure to the next good frame are kept for stats() and report().
+
+    Parameters:
+        name (str): Camera name for log messages, e.g. "TL".
+        rearm, reopen, reinit (callable): Recovery steps, None to skip a step.
+        rearm_attempts (int): Rearms in a row before reopening.
+        reopen_attempts (int): Reopens in a row before a full reinit.
+        base_delay_s (float): Backoff before the first reopen/reinit.
+        max_delay_s (float): Upper limit of the backoff.
+    """
+
+    def __init__(self, name, rearm=None, reopen=None, reinit=None, rearm_attempts=2, reopen_attempts=3,
+                 base_delay_s=0.2, max_delay_s=10.0):
+        self.name = name
+        self._steps = [("rearm", rearm, rearm_attempts), ("reopen", reopen, reopen_attempts), ("reinit", reinit, None)]
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self.reset()
+
+    def reset(self):
+        """Clear all counters."""
+        self.failures = {TIMEOUT: 0, DISCONNECT: 0, OTHER: 0}
+        self.steps = {"rearm": 0, "reopen": 0, "reinit": 0}
+        self.step_failures = 0
+        self.recoveries = 0
+        self.recovery_time_s = 0.0
+        self.max_recovery_time_s = 0.0
+        self._end_streak()
+
+    def recover(self, error, device):
+        """Handle a failed frame and return the device to continue with."""
+        kind = classify_error(error)
+        self.failures[kind] += 1
+        if self._failed_at is None:
+            self._failed_at = time.monotonic()
+        self._min_level = max(self._min_level, 0 if kind == TIMEOUT else 1)
+
+        level = self._choose()
+        if level is None:
+            return device
+        step, fn, _ = self._steps[level]
+        self._attempts[level] += 1
+
+        if step != "rearm":
+            delay = min(self.max_delay_s, self.base_delay_s * 2 ** self._backoffs)
+            self._backoffs += 1
+            print(f"{self.name}: {kind} ({error}), {step} in {delay:.1f}s.")
+            time.sleep(delay)
+        else:
+            print(f"{self.name}: {kind} ({error}), {step}.")
+
+        try:
+            device = fn(device)
+            self.steps[step] += 1
+        except Exception as e:
+            # Go straight to the next step with the next failure
+            self.step_failures += 1
+            self._min_level = level + 1
+            print(f"{self.name}: {step} failed: {e}")
+        return device
+
+    def succeeded(self):
+        """Call after every good frame, ends a failure streak."""
+        if self._failed_at is None:
+            return
+        elapsed = time.monotonic() - self._failed_at
+        self.recoveries += 1
+        self.recovery_time_s += elapsed
+        self.max_recovery_time_s = max(self.max_recovery_time_s, elapsed)
+        print(f"{self.name}: Recovered after {elapsed:.1f}s.")
+        self._end_streak()
+
+    def stats(self):
+        return {
+            "failures": dict(self.failures),
+            "steps": dict(self.steps),
+            "step_failures": self.step_failures,
+            "recoveries": self.recoveries,
+            "recovery_time_s": self.recovery_time_s,
+            "max_recovery_time_s": self.max_recovery_time_s,
+        }
+
+    def report(self):
+        f, s = self.failures, self.steps
+        mean = self.recovery_time_s / self.recoveries if self.recoveries else 0.0
+        return (f"{self.name} recovery: {f[TIMEOUT]} timeouts, {f[DISCONNECT]} disconnects, {f[OTHER]} other errors; "
+                f"{s['rearm']} rearms, {s['reopen']} reopens, {s['reinit']} reinits, {self.step_failures} failed steps; "
+                f"{self.recoveries} recoveries, mean {mean:.1f}s, max {self.max_recovery_time_s:.1f}s")
+
+    def _choose(self):
+        # Cheapest available step at or above the minimum level that has attempts left
+        available = [i for i, (_, fn, _) in enumerate(self._steps) if fn is not None]
+        for i in available:
+            if i >= self._min_level and (self._steps[i][2] is None or self._attempts[i] < self._steps[i][2]):
+                return i
+        # Out of attempts, keep retrying the most thorough step
+        return available[-1] if available else None
+
+    def _end_streak(self):
+        self._failed_at = None
+        self._min_level = 0
+        self._attempts = [0, 0, 0]
+        self._backoffs = 0
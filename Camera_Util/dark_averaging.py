@@ -1,36 +1,213 @@
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import numpy as np
 import tifffile
 
-def create_master_dark(input_folder, output_path):
+class DarkAccumulator:
+    """
+    Streaming per-pixel mean and variance of dark frames (Welford's algorithm).
+
+    Frames are added one at a time and only the running mean and sum of squared
+    deviations are kept, in float64, so memory does not grow with the number of frames.
+    The update works in two scratch buffers instead of allocating temporaries per frame.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self._m2 = None
+        self._delta = None
+        self._scratch = None
+
+    def add(self, frame):
+        frame = np.asarray(frame)
+        if self.mean is None:
+            self.mean = np.zeros(frame.shape)
+            self._m2 = np.zeros(frame.shape)
+            self._delta = np.empty(frame.shape)
+            self._scratch = np.empty(frame.shape)
+        elif frame.shape != self.mean.shape:
+            raise ValueError(f"Dark frame shape {frame.shape} does not match {self.mean.shape}.")
+
+        self.n += 1
+        np.subtract(frame, self.mean, out=self._delta)
+        np.multiply(self._delta, 1.0 / self.n, out=self._scratch)
+        self.mean += self._scratch
+        np.subtract(frame, self.mean, out=self._scratch)
+        self._scratch *= self._delta
+        self._m2 += self._scratch
+
+    @property
+    def variance(self):
+        """Per-pixel sample variance, 0 with fewer than two frames."""
+        if self.n < 2:
+            return np.zeros_like(self.mean)
+        return self._m2 / (self.n - 1)
+
+    @property
+    def std(self):
+        """Per-pixel temporal noise (read noise plus dark shot noise) in counts."""
+        return np.sqrt(self.variance)
+
+
+def create_master_dark(input_folder, output_path, noise_map=True):
     """
     Averages all TIFF images in the input folder to create a master dark frame and saves it as a NumPy array.
-    
+
+    The frames are read one at a time into a DarkAccumulator, so any number of full-sensor
+    or 106-band darks fit into memory. With noise_map the per-pixel noise (std over the
+    frames) is saved next to the master dark as <output_path>_noise.npy.
+
     Parameters:
         input_folder (str): Path to the folder containing dark frame TIFF images.
         output_path (str): Path to save the resulting master dark frame as a .npy file.
+        noise_map (bool): Also save the per-pixel noise map.
+
+    Returns:
+        (master_dark, noise): Mean and per-pixel std, None if no TIFFs were found.
     """
     # List all TIFF files in the folder
-    dark_files = [f for f in os.listdir(input_folder) if f.endswith('.tif')]
+    dark_files = sorted(f for f in os.listdir(input_folder) if f.endswith('.tif'))
     if not dark_files:
         print(f"No TIFF files found in {input_folder}")
-        return
+        return None
 
     print(f"Found {len(dark_files)} dark frame files in {input_folder}. Averaging...")
 
-    # Read all dark frame images
-    dark_frames = []
+    # Accumulate the dark frames one by one
+    accumulator = DarkAccumulator()
     for file in dark_files:
         filepath = os.path.join(input_folder, file)
-        img = tifffile.imread(filepath)
-        dark_frames.append(img)
+        accumulator.add(tifffile.imread(filepath))
 
-    # Compute the average dark frame
-    master_dark = np.mean(dark_frames, axis=0)
+    master_dark = accumulator.mean
+    noise = accumulator.std
 
     # Save the master dark frame as a NumPy array
+    save_master_dark(output_path, master_dark, noise if noise_map else None)
+    return master_dark, noise
+
+## Save a master dark as <output_path>.npy, and its noise map as <output_path>_noise.npy
+def save_master_dark(output_path, master_dark, noise=None):
     np.save(output_path, master_dark)
     print(f"Master dark frame saved to {output_path}.npy")
+    if noise is not None:
+        np.save(output_path + "_noise", noise)
+        print(f"Noise map saved to {output_path}_noise.npy, median noise {np.median(noise):.2f} counts")
+
+## Write dark TIFFs into a memory-mapped (N, pixels) stack on disk
+def stack_to_memmap(files, path):
+    """Reads the frames one at a time, only the memmap pages being written are in memory."""
+    first = tifffile.imread(files[0])
+    stack = np.lib.format.open_memmap(path, mode="w+", dtype=first.dtype, shape=(len(files), first.size))
+    stack[0] = first.ravel()
+    for i, file in enumerate(files[1:], start=1):
+        frame = tifffile.imread(file)
+        if frame.shape != first.shape:
+            raise ValueError(f"{file}: shape {frame.shape} does not match {first.shape}.")
+        stack[i] = frame.ravel()
+    stack.flush()
+    return stack, first.shape
+
+
+## Robust combination of one tile of pixels over all frames
+def combine_tile(data, method="sigma_clip", sigma=3.0, max_iters=5, min_std=0.5):
+    """
+    Returns (combined, noise) for data of shape (frames, pixels).
+
+    "median" is the exact per-pixel median. "sigma_clip" iteratively rejects samples more
+    than sigma robust standard deviations from the per-pixel median (cosmic rays, hot
+    transients) and averages the rest. The robust std is 1.4826 times the median absolute
+    deviation of the kept samples, at least min_std counts, so an outlier does not inflate
+    the threshold that should reject it (with the plain std a single outlier can never be
+    more than 3 std away in 9 frames or fewer). noise is the std of the samples that were kept.
+    """
+    data = data.astype(np.float32)
+    median = np.median(data, axis=0)
+    valid = np.ones(data.shape, dtype=bool)
+    if method == "sigma_clip":
+        for _ in range(max(1, max_iters)):
+            kept = np.where(valid, data, np.nan)
+            center = np.nanmedian(kept, axis=0)
+            scale = np.maximum(1.4826 * np.nanmedian(np.abs(kept - center), axis=0), min_std)
+            new_valid = np.abs(data - center) <= sigma * scale
+            if np.array_equal(new_valid, valid):
+                break
+            valid = new_valid
+
+    n = np.maximum(valid.sum(axis=0), 1)
+    mean = np.where(valid, data, 0).sum(axis=0, dtype=np.float64) / n
+    dev = np.where(valid, data - mean, 0)
+    std = np.sqrt((dev * dev).sum(axis=0, dtype=np.float64) / np.maximum(n - 1, 1))
+
+    combined = median if method == "median" else mean
+    return combined, std
+
+
+## Combine one tile of a (frames, pixels) stack into master_dark and noise
+def _combine_stack_tile(stack, master_dark, noise, start, tile_pixels, **kwargs):
+    stop = min(start + tile_pixels, stack.shape[1])
+    master_dark[start:stop], noise[start:stop] = combine_tile(stack[:, start:stop], **kwargs)
+
+
+def create_robust_master_dark(input_folder, output_path, method="sigma_clip", sigma=3.0, max_iters=5,
+                              tile_pixels=1 << 13, workers=None, scratch_dir=None, noise_map=True):
+    """
+    Sigma-clipped mean or exact median master dark, computed tile by tile out of core.
+
+    The darks are first copied into a memory-mapped stack on disk (in scratch_dir, deleted
+    afterwards). The pixels are then split into tiles of tile_pixels, and each tile of all
+    frames is combined on a pool of worker threads (numpy releases the GIL while sorting
+    and summing), so memory is bounded by workers * frames * tile_pixels whatever the
+    number of frames. Saved like create_master_dark, plus <output_path>_noise.npy.
+
+    Parameters:
+        input_folder (str): Path to the folder containing dark frame TIFF images.
+        output_path (str): Path to save the resulting master dark frame as a .npy file.
+        method (str): "sigma_clip" or "median".
+        sigma (float): Clipping threshold in robust standard deviations (from the MAD).
+        max_iters (int): Maximum clipping iterations.
+        tile_pixels (int): Pixels per tile.
+        workers (int): Worker threads, all cores by default.
+        scratch_dir (str): Folder of the temporary memmap, the system temp folder by default.
+        noise_map (bool): Also save the per-pixel noise map.
+
+    Returns:
+        (master_dark, noise): Combined frame and per-pixel std, None if no TIFFs were found.
+    """
+    if method not in ("sigma_clip", "median"):
+        raise ValueError(f"Unknown method {method!r}, use 'sigma_clip' or 'median'.")
+    dark_files = sorted(os.path.join(input_folder, f) for f in os.listdir(input_folder) if f.endswith('.tif'))
+    if not dark_files:
+        print(f"No TIFF files found in {input_folder}")
+        return None
+
+    print(f"Found {len(dark_files)} dark frame files in {input_folder}. Combining ({method})...")
+
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as tmp:
+        master_dark, noise, shape = _combine_memmap_stack(dark_files, os.path.join(tmp, "dark_stack.npy"), tile_pixels, workers,
+                                                          method=method, sigma=sigma, max_iters=max_iters)
+
+    master_dark = master_dark.reshape(shape)
+    noise = noise.reshape(shape)
+
+    save_master_dark(output_path, master_dark, noise if noise_map else None)
+    return master_dark, noise
+
+## Stack the darks into a memmap at path and combine it tile by tile
+def _combine_memmap_stack(files, path, tile_pixels, workers, **kwargs):
+    # The memmap is only referenced here, so it is closed on return and the scratch file can be deleted
+    stack, shape = stack_to_memmap(files, path)
+    n_pixels = stack.shape[1]
+    master_dark = np.empty(n_pixels)
+    noise = np.empty(n_pixels)
+    run_tile = partial(_combine_stack_tile, stack, master_dark, noise, tile_pixels=tile_pixels, **kwargs)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        # list() re-raises errors of the workers
+        list(pool.map(run_tile, range(0, n_pixels, tile_pixels)))
+    return master_dark, noise, shape
 
 # Paths for Thorlabs and Cubert dark frames
 thorlabs_dark_folder = r"C:\Users\menon\Documents\Camera_Operation\images\new_dark_frames\thorlabs"
@@ -38,7 +215,14 @@ cubert_dark_folder = r"C:\Users\menon\Documents\Camera_Operation\images\new_dark
 thorlabs_master_dark_path = r"C:\Users\menon\Documents\Camera_Operation\images\new_dark_frames\thorlabsthorlabs_display_masterdark"
 cubert_master_dark_path = r"C:\Users\menon\Documents\Camera_Operation\images\new_dark_frames\cubertcubert_display_masterdark"
 
+# "mean" (streaming), or "sigma_clip" / "median" (robust, out of core)
+combine_method = "mean"
+
 # Create master dark frames
-create_master_dark(thorlabs_dark_folder, thorlabs_master_dark_path)
-create_master_dark(cubert_dark_folder, cubert_master_dark_path)
+if __name__ == "__main__":
+    for folder, path in ((thorlabs_dark_folder, thorlabs_master_dark_path), (cubert_dark_folder, cubert_master_dark_path)):
+        if combine_method == "mean":
+            create_master_dark(folder, path)
+        else:
+            create_robust_master_dark(folder, path, method=combine_method)
 
@@ -0,0 +1,250 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import numpy as np
+import camera_backends
+from dark_averaging import DarkAccumulator, save_master_dark
+from dark_library import DarkLibrary
+from defect_map import DefectMap
+
+
+## Average Thorlabs dark frames at one exposure, without writing the frames
+def accumulate_thorlabs_dark(cam, exposure_ms, n_frames, recovery=None, should_stop=None, on_frame=None, max_failures=15):
+    """
+    Streams the cam at its native frame rate and adds the raw frames to a DarkAccumulator.
+
+    The accumulator update runs on a second thread while the next frame is exposed, so
+    the capture takes about n_frames exposures. Failed frames go through recovery (a
+    camera_recovery.RecoveryManager) and the stream is restarted.
+
+    Parameters:
+        cam: Thorlabs cam, see camera_backends.open_thorlabs_cam.
+        exposure_ms (float): Exposure time in ms.
+        n_frames (int): Frames to average.
+        recovery (RecoveryManager): Optional recovery of failed frames, errors are raised without it.
+        should_stop (callable): Optional, ends the capture early if it returns True.
+        on_frame (callable): Optional on_frame(frames_taken) after every frame.
+        max_failures (int): Failed frames before giving up.
+
+    Returns:
+        (accumulator, cam): accumulator is None if should_stop() ended the capture.
+    """
+    accumulator = DarkAccumulator()
+    taken = 0
+    failures = 0
+
+    def done():
+        return taken >= n_frames or (should_stop is not None and should_stop())
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="tl_dark") as worker:
+        pending = None
+        while not done():
+            try:
+                cam.set_exposure(exposure_ms * 1e-3)
+                for frame in camera_backends.stream_thorlabs_frames(cam, done):
+                    if recovery is not None:
+                        recovery.succeeded()
+                    if pending is not None:
+                        pending.result()
+                    pending = worker.submit(accumulator.add, frame)
+                    taken += 1
+                    if on_frame is not None:
+                        on_frame(taken)
+            except Exception as e:
+                failures += 1
+                if recovery is None or failures >= max_failures:
+                    raise
+                cam = recovery.recover(e, cam)
+        if pending is not None:
+            pending.result()
+
+    return (accumulator if taken >= n_frames else None), cam
+
+
+## Average processed Cubert dark cubes at one integration time, without writing the cubes
+def accumulate_cubert_dark(acquContext, procContext, integration_ms, n_frames, timeout_ms=None, recovery=None,
+                           should_stop=None, on_frame=None, max_failures=15):
+    """
+    Captures dark measurements and adds their processed cubes, in the (band, y, x) layout
+    of the Cubert master darks, to a DarkAccumulator.
+
+    Processing and the accumulator update of a measurement run on a second thread while
+    the next one is integrating, like the pipelined Cubert capture in scene_imager.
+
+    Parameters:
+        acquContext, procContext: Cubert contexts, see camera_backends.open_cubert_cam.
+        integration_ms (float): Integration time in ms.
+        n_frames (int): Cubes to average.
+        timeout_ms (float): Capture timeout, 1.5 * integration time + 1 s (at least 3 s) by default.
+        recovery, should_stop, on_frame, max_failures: As for accumulate_thorlabs_dark.
+
+    Returns:
+        The accumulator, None if should_stop() ended the capture.
+    """
+    if timeout_ms is None:
+        timeout_ms = max(3000, 1.5 * integration_ms + 1000)
+    acquContext.integration_time = integration_ms
+    accumulator = DarkAccumulator()
+    taken = 0
+    failures = 0
+
+    def add(mesu):
+        procContext.apply(mesu)
+        accumulator.add(np.asarray(mesu.data['cube'].array).transpose(2, 0, 1))
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="cb_dark") as worker:
+        pending = None
+        while taken < n_frames and not (should_stop is not None and should_stop()):
+            try:
+                mesu, res = acquContext.capture().get(timedelta(milliseconds=timeout_ms))
+                if mesu is None:
+                    raise TimeoutError(f"no measurement after {timeout_ms:.0f}ms ({res})")
+            except Exception as e:
+                failures += 1
+                if recovery is None or failures >= max_failures:
+                    raise
+                recovery.recover(e, acquContext)
+                continue
+            if recovery is not None:
+                recovery.succeeded()
+            if pending is not None:
+                pending.result()
+            pending = worker.submit(add, mesu)
+            taken += 1
+            if on_frame is not None:
+                on_frame(taken)
+        if pending is not None:
+            pending.result()
+
+    return accumulator if taken >= n_frames else None
+
+
+## Path of the master dark of one exposure, as written by capture_master_darks
+def master_dark_path(folder, name, exposure_ms):
+    return os.path.join(folder, f"{name}_{exposure_ms:g}ms.npy")
+
+
+## Master darks of one cam at several exposures, saved as <folder>/<name>_<exposure>ms.npy
+def capture_master_darks(accumulate, exposures_ms, folder, name, noise_map=True):
+    """
+    Takes the darks of every exposure with accumulate and saves only the master darks and
+    noise maps. With several exposures a DarkLibrary is fitted from the master darks and
+    saved as <folder>/<name>.npz, so auto exposure gets a dark for any exposure.
+
+    Parameters:
+        accumulate (callable): accumulate(exposure_ms) returns the DarkAccumulator of one
+            exposure, or None if the capture was cancelled.
+        exposures_ms (list): Exposures in ms.
+        folder (str): Output folder.
+        name (str): File name prefix, e.g. "thorlabs_masterdark".
+        noise_map (bool): Also save the per-pixel noise maps.
+
+    Returns:
+        Path of the library (several exposures) or master dark (one exposure) for
+        scene_imager.load_dark, None if the capture was cancelled.
+    """
+    os.makedirs(folder, exist_ok=True)
+    darks = {}
+    for exposure_ms in exposures_ms:
+        accumulator = accumulate(exposure_ms)
+        if accumulator is None:
+            return None
+        path = master_dark_path(folder, name, exposure_ms)
+        save_master_dark(path[:-len(".npy")], accumulator.mean, accumulator.std if noise_map else None)
+        darks[exposure_ms] = path
+
+    if len(darks) == 1:
+        return darks[exposures_ms[0]]
+    path = os.path.join(folder, name + ".npz")
+    DarkLibrary.fit(darks).save(path)
+    print(f"Dark library of {len(darks)} exposures saved to {path}")
+    return path
+
+
+## Capture master darks of both cams at the same time, with the lenses covered
+def capture_darks(cam_tl, acquContext, procContext, folder, exposures_tl, exposures_cb, n_frames_tl, n_frames_cb,
+                  name_tl="thorlabs_masterdark", name_cb="cubert_masterdark", defect_name_tl="thorlabs_defects",
+                  timeout_ms_cb=None, tl_recovery=None, cb_recovery=None, should_stop=None, on_progress=None):
+    """
+    Takes n_frames_tl / n_frames_cb frames per exposure and averages them on the fly. Only
+    the master darks and noise maps are written to folder, plus a dark library for several
+    exposures and the TL defect map from the longest TL exposure. Both cams run on their
+    own thread, so the capture takes about as long as the exposures of the slower cam.
+    The exposures of both cams are set back to their values from before the capture.
+
+    Parameters:
+        cam_tl, acquContext, procContext: TL cam and Cubert contexts, see camera_backends.
+        folder (str): Output folder.
+        exposures_tl, exposures_cb (list): Exposures in ms.
+        n_frames_tl, n_frames_cb (int): Frames averaged per exposure.
+        name_tl, name_cb, defect_name_tl (str): File name prefixes.
+        timeout_ms_cb (callable): Optional timeout_ms_cb(integration_ms) of a Cubert capture.
+        tl_recovery, cb_recovery (RecoveryManager): Optional recovery of failed frames.
+        should_stop (callable): Optional, cancels the capture if it returns True.
+        on_progress (callable): Optional on_progress(camera, exposure_ms, frame, n_frames) after every frame.
+
+    Returns:
+        (paths, cam_tl, defects_tl): {"tl": path, "cb": path} of the new darks (None if a cam
+        failed or the capture was cancelled) plus "defects_tl", the (possibly re-opened) TL
+        cam, and the DefectMap built from the TL darks, None without them.
+    """
+    exposure_s_tl = cam_tl.get_exposure()
+    integration_ms_cb = acquContext.integration_time
+
+    def progress(camera, exposure_ms, n_frames):
+        if on_progress is None:
+            return None
+        return lambda frame: on_progress(camera, exposure_ms, frame, n_frames)
+
+    def accumulate_tl(exposure_ms):
+        nonlocal cam_tl
+        accumulator, cam_tl = accumulate_thorlabs_dark(
+            cam_tl, exposure_ms, n_frames_tl, recovery=tl_recovery, should_stop=should_stop,
+            on_frame=progress("tl", exposure_ms, n_frames_tl))
+        return accumulator
+
+    def accumulate_cb(exposure_ms):
+        return accumulate_cubert_dark(
+            acquContext, procContext, exposure_ms, n_frames_cb,
+            timeout_ms=timeout_ms_cb(exposure_ms) if timeout_ms_cb is not None else None,
+            recovery=cb_recovery, should_stop=should_stop, on_frame=progress("cb", exposure_ms, n_frames_cb))
+
+    paths = {"tl": None, "cb": None}
+
+    def worker(key, accumulate, exposures, name):
+        try:
+            paths[key] = capture_master_darks(accumulate, exposures, folder, name)
+        except Exception as e:
+            print(f"{key.upper()}: Dark capture failed: {e}")
+
+    # The simulated cams image the scene on the simulated display, cover it like the lenses
+    simulated = isinstance(cam_tl, camera_backends.SimulatedThorlabsCamera)
+    if simulated:
+        scene = camera_backends.simulated_scene.name
+        camera_backends.show_scene(None)
+    try:
+        workers = [
+            threading.Thread(target=worker, args=("tl", accumulate_tl, exposures_tl, name_tl), name="tl_dark_capture"),
+            threading.Thread(target=worker, args=("cb", accumulate_cb, exposures_cb, name_cb), name="cb_dark_capture"),
+        ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+    finally:
+        if simulated:
+            camera_backends.show_scene(scene)
+        # Back to the imaging exposures
+        cam_tl.set_exposure(exposure_s_tl)
+        acquContext.integration_time = integration_ms_cb
+
+    defects_tl = None
+    if paths["tl"] is not None:
+        defects_tl = DefectMap.from_files(master_dark_path(folder, name_tl, max(exposures_tl)))
+        paths["defects_tl"] = os.path.join(folder, defect_name_tl + ".npz")
+        defects_tl.save(paths["defects_tl"])
+        print(f"TL: {defects_tl.summary()}, saved to {paths['defects_tl']}")
+
+    print(f"Darks: TL {paths['tl']}, CB {paths['cb']}")
+    return paths, cam_tl, defects_tl
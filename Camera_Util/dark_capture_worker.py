@@ -0,0 +1,41 @@
+import threading
+from PyQt5.QtCore import QObject, pyqtSignal
+
+
+class DarkCaptureWorker(QObject):
+    """
+    Captures master darks of both cams off the Qt main thread, shared by both Camera_GUIs.
+
+    capture_darks is the capture_darks(cam_tl, acquContext, procContext, should_stop,
+    on_progress) of the GUI's scene_imager. The lenses have to be covered. Progress is
+    reported per frame, the paths of the new darks are sent with finished. cancel() stops
+    after the current frame, without saving the darks of the exposure that was interrupted.
+    """
+    progress = pyqtSignal(str)
+    error = pyqtSignal(str)
+    finished = pyqtSignal(object)  # {"tl": path, "cb": path}, None for a cam that failed
+
+    def __init__(self, gui, capture_darks):
+        super().__init__()
+        self.cam_tl = gui.cam_tl
+        self.acquisitionContext = gui.acquisitionContext
+        self.processingContext = gui.processingContext
+        self.capture_darks = capture_darks
+        self._cancel = threading.Event()
+        self._status = {}
+
+    def cancel(self):
+        self._cancel.set()
+
+    def on_progress(self, camera, exposure_ms, frame, n_frames):
+        self._status[camera] = f"{camera.upper()} {exposure_ms:g}ms {frame}/{n_frames}"
+        self.progress.emit("Darks: " + ", ".join(self._status.values()))
+
+    def run(self):
+        paths = {"tl": None, "cb": None}
+        try:
+            paths, self.cam_tl = self.capture_darks(self.cam_tl, self.acquisitionContext, self.processingContext,
+                                                    should_stop=self._cancel.is_set, on_progress=self.on_progress)
+        except Exception as e:
+            self.error.emit(str(e))
+        self.finished.emit(paths)
@@ -0,0 +1,74 @@
+import zlib
+import numpy as np
+
+
+class DarkCorrector:
+    """
+    Saturating dark subtraction, max(frame - dark, 0), shared by the Thorlabs and Cubert paths.
+
+    The master dark is converted once into the working dtype instead of casting frame and
+    dark to float64 for every frame. apply() writes into an out= buffer (or into the frame
+    itself) without temporaries: for integer dtypes as max(frame, dark) - dark, which
+    cannot wrap around, for float dtypes as frame - dark clipped at 0.
+
+    Parameters:
+        master_dark (ndarray): Master dark frame in the same layout as the frames.
+        dtype (str or dtype): Working dtype, e.g. "float32", or "native" to use the dtype
+            of the frames (rounding the dark to integers for integer cams).
+        id (str): Optional id of the master dark, a checksum of it by default.
+    """
+
+    def __init__(self, master_dark, dtype="float32", id=None):
+        self.master_dark = np.asarray(master_dark)
+        self.dtype = None if isinstance(dtype, str) and dtype == "native" else np.dtype(dtype)
+        self._darks = {}
+        # Recorded with every frame it corrected
+        self.id = id if id is not None else f"{zlib.crc32(np.ascontiguousarray(self.master_dark).tobytes()):08x}"
+
+    def dark(self, dtype=None):
+        """Master dark converted to dtype (the working dtype by default), cached."""
+        if dtype is None:
+            dtype = self.dtype if self.dtype is not None else self.master_dark.dtype
+        dtype = np.dtype(dtype)
+        dark = self._darks.get(dtype)
+        if dark is None:
+            if np.issubdtype(dtype, np.integer):
+                info = np.iinfo(dtype)
+                dark = np.clip(np.rint(self.master_dark), info.min, info.max).astype(dtype)
+            else:
+                dark = self.master_dark.astype(dtype)
+            self._darks[dtype] = dark
+        return dark
+
+    def output_dtype(self, frame):
+        return self.dtype if self.dtype is not None else frame.dtype
+
+    def apply(self, frame, out=None, window=None):
+        """
+        Returns max(frame - dark, 0) in the working dtype.
+
+        Parameters:
+            frame (ndarray): Frame to correct. May be a view, e.g. a transposed cube.
+            out (ndarray): Optional output buffer of frame's shape, may be frame itself.
+            window (tuple): Optional index (e.g. tuple of slices) into the dark, for frames
+                that only cover part of the sensor.
+        """
+        dtype = self.output_dtype(frame)
+        dark = self.dark(dtype)
+        if window is not None:
+            dark = dark[window]
+        if out is None:
+            out = np.empty(frame.shape, dtype=dtype)
+
+        if np.issubdtype(dtype, np.integer):
+            np.maximum(frame, dark, out=out, casting="unsafe")
+            np.subtract(out, dark, out=out)
+        else:
+            np.subtract(frame, dark, out=out, casting="unsafe")
+            np.maximum(out, 0, out=out)
+        return out
+
+    def apply_inplace(self, frame):
+        """apply() writing into frame itself if it already has the working dtype."""
+        out = frame if self.output_dtype(frame) == frame.dtype and frame.flags.writeable else None
+        return self.apply(frame, out=out)
@@ -0,0 +1,146 @@
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+import numpy as np
+from dark_correction import DarkCorrector
+
+
+class DarkLibrary:
+    """
+    Per-pixel dark model dark(t) = bias + rate * t, fitted from master darks at several exposures.
+
+    Auto exposure picks a different exposure for every scene, while a single master dark
+    is only right at the exposure it was taken with. The library fits bias and dark
+    current rate per pixel once, and then gives a dark for any exposure. Darks and their
+    DarkCorrectors are kept in a small LRU cache keyed by the exposure rounded to
+    quantum_ms, so repeated exposures are a dictionary lookup.
+
+    Parameters:
+        bias (ndarray): Per-pixel dark at zero exposure in counts.
+        rate (ndarray): Per-pixel dark current in counts per ms.
+        exposures_ms (list): Exposures the model was fitted from, for reference.
+        quantum_ms (float): Exposures closer than this share a cached dark.
+        cache_size (int): Number of cached darks.
+    """
+
+    def __init__(self, bias, rate, exposures_ms=(), quantum_ms=1.0, cache_size=4):
+        self.bias = np.asarray(bias, dtype=np.float32)
+        self.rate = np.asarray(rate, dtype=np.float32)
+        self.exposures_ms = sorted(exposures_ms)
+        self.quantum_ms = quantum_ms
+        self.cache_size = cache_size
+        self.id = f"{zlib.crc32(self.bias.tobytes() + self.rate.tobytes()):08x}"
+        self._cache = OrderedDict()  # rounded exposure -> (dark, {dtype: DarkCorrector})
+        self._lock = threading.Lock()
+
+    @classmethod
+    def fit(cls, darks, channel=None, **kwargs):
+        """
+        Least-squares fit of bias and rate per pixel.
+
+        Parameters:
+            darks (dict): {exposure_ms: master dark or path of a .npy master dark}. The
+                darks are read one at a time, only running sums are kept.
+            channel (int): Channel of (channel, y, x) master darks to use, e.g. 0 for TL.
+            kwargs: Passed to DarkLibrary.
+        """
+        exposures = sorted(darks)
+        if not exposures:
+            raise ValueError("DarkLibrary.fit needs at least one master dark.")
+        t_mean = float(np.mean(exposures))
+        sum_d = sum_td = None
+        for t in exposures:
+            dark = darks[t]
+            dark = np.load(dark) if isinstance(dark, str) else np.asarray(dark)
+            if channel is not None:
+                dark = dark[channel]
+            if sum_d is None:
+                sum_d = np.zeros(dark.shape)
+                sum_td = np.zeros(dark.shape)
+            sum_d += dark
+            sum_td += (t - t_mean) * dark
+
+        mean_d = sum_d / len(exposures)
+        stt = sum((t - t_mean) ** 2 for t in exposures)
+        # A single exposure gives no rate, the dark is then the same for every exposure
+        rate = sum_td / stt if stt > 0 else np.zeros_like(mean_d)
+        bias = mean_d - rate * t_mean
+        return cls(bias, rate, exposures_ms=exposures, **kwargs)
+
+    @classmethod
+    def from_folder(cls, folder, channel=None, **kwargs):
+        """Fits the master darks <name>_<exposure>ms.npy of a folder (noise maps are skipped)."""
+        darks = {}
+        for f in os.listdir(folder):
+            m = re.search(r"_(\d+(?:\.\d+)?)ms\.npy$", f)
+            if m:
+                darks[float(m.group(1))] = os.path.join(folder, f)
+        return cls.fit(darks, channel=channel, **kwargs)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with np.load(path) as f:
+            return cls(f["bias"], f["rate"], exposures_ms=f["exposures_ms"].tolist(), **kwargs)
+
+    def save(self, path):
+        np.savez(path, bias=self.bias, rate=self.rate, exposures_ms=np.asarray(self.exposures_ms, dtype=np.float64))
+
+    @property
+    def shape(self):
+        return self.bias.shape
+
+    def dark(self, exposure_ms):
+        """Dark frame (float32) for exposure_ms, from the cache if possible."""
+        return self._entry(exposure_ms)[0]
+
+    def window_dark(self, exposure_ms, window, dtype=None):
+        """
+        Dark of only window (y1, y2, x1, x2) for exposure_ms, not cached.
+
+        For metering while auto exposure searches: every iteration has a new exposure, and
+        evaluating the model over the metering window is a small fraction of the cost of
+        a full-sensor dark. Integer dtypes are rounded and clipped like DarkCorrector.dark.
+        """
+        y1, y2, x1, x2 = window
+        dark = self.rate[y1:y2, x1:x2] * np.float32(self._key(exposure_ms) * self.quantum_ms)
+        dark += self.bias[y1:y2, x1:x2]
+        np.maximum(dark, 0, out=dark)
+        if dtype is None:
+            return dark
+        dtype = np.dtype(dtype)
+        if np.issubdtype(dtype, np.integer):
+            np.rint(dark, out=dark)
+            np.minimum(dark, np.iinfo(dtype).max, out=dark)
+        return dark.astype(dtype)
+
+    def corrector(self, exposure_ms, dtype="float32"):
+        """DarkCorrector for exposure_ms, cached together with the dark."""
+        key, (dark, correctors) = self._key(exposure_ms), self._entry(exposure_ms)
+        with self._lock:
+            corrector = correctors.get(dtype)
+            if corrector is None:
+                corrector = DarkCorrector(dark, dtype=dtype, id=f"{self.id}@{key * self.quantum_ms:g}ms")
+                correctors[dtype] = corrector
+        return corrector
+
+    def _key(self, exposure_ms):
+        return int(round(exposure_ms / self.quantum_ms))
+
+    def _entry(self, exposure_ms):
+        key = self._key(exposure_ms)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+                return entry
+        # Outside the lock, a few ms per new exposure
+        dark = self.rate * np.float32(key * self.quantum_ms)
+        dark += self.bias
+        np.maximum(dark, 0, out=dark)
+        with self._lock:
+            entry = self._cache.setdefault(key, (dark, {}))
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return entry
@@ -8,16 +8,19 @@ from matplotlib.backends.backend_qt5agg import (
     FigureCanvasQTAgg as FigureCanvas
 )
 from matplotlib.figure import Figure
-import numpy as np
-import tifffile
-from scene_imager import setup_thorlabs_cam, take_and_save_thorlabs_image, setup_cubert_cam, take_and_save_cubert_image, setup_pygame_display, display_image
+from scene_imager import setup_thorlabs_cam, take_and_save_thorlabs_image, setup_cubert_cam, take_and_save_cubert_image, setup_pygame_display
 import scene_imager as si
+from dark_capture_worker import DarkCaptureWorker
+import camera_backends
+from polar_processing import sublattice_view
+from preview import decimate, PreviewRenderer
 from PyQt5.QtGui import QPixmap, QImage
 from PyQt5.QtCore import Qt
-from PyQt5.QtCore import QTimer, Qt
+from PyQt5.QtCore import QTimer, Qt, QThread, QObject, pyqtSignal
 from PyQt5.QtGui import QColor, QFont, QPalette
 import pygame
 import ctypes
+import threading
 
 if os.name == "nt":
     ctypes.windll.kernel32.SetThreadExecutionState(0x80000002)  # ES_CONTINUOUS | ES_SYSTEM_REQUIRED | ES_DISPLAY_REQUIRED
@@ -29,6 +32,144 @@ img_size_y = 240*2.5
 img_offset_x = 0
 img_offset_y = 0
 
+# Preview rendering, see preview.PreviewRenderer
+preview_gamma = 1.0
+preview_percentiles_tl = None  # e.g. (1, 99.5) to stretch dim scenes, None shows the full 12-bit range
+preview_percentiles_cb = None  # None stretches min..max
+
+class CaptureWorker(QObject):
+    """
+    Runs a single capture or a whole dataset run off the Qt main thread.
+
+    All camera and pygame calls happen on the worker thread. Progress, previews and
+    errors are reported back to the GUI through signals. Previews are decimated copies
+    of the frames in memory, sent before the frames are written. cancel() stops a dataset
+    run after the pair that is currently being taken.
+    """
+    progress = pyqtSignal(int, int, str)  # image number, total (0 if unknown), image name
+    preview = pyqtSignal(str, str, object)  # image name, "tl" or "cb", decimated frame
+    error = pyqtSignal(str)
+    finished = pyqtSignal(bool)  # True if a dataset run went through all images
+
+    def __init__(self, gui, img_name, data_folder):
+        super().__init__()
+        self.folder_path = gui.folder_path
+        self.cam_tl = gui.cam_tl
+        self.acquisitionContext = gui.acquisitionContext
+        self.processingContext = gui.processingContext
+        self.dark_cal_tl = gui.dark_cal_tl
+        self.dark_cal_cb = gui.dark_cal_cb
+        self.img_name = img_name
+        self.data_folder = data_folder
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def run(self):
+        dataset_done = False
+        si.preview_callback = self.preview.emit
+        try:
+            if self.data_folder is None:
+                self.capture_single()
+            else:
+                dataset_done = self.capture_dataset()
+        except Exception as e:
+            self.error.emit(str(e))
+        finally:
+            si.preview_callback = None
+        self.finished.emit(dataset_done)
+
+    def capture_single(self):
+        self.progress.emit(1, 1, self.img_name)
+
+        # Capture Thorlabs image
+        tl_success, self.cam_tl = take_and_save_thorlabs_image(
+            img_name=self.img_name, dark_cal=self.dark_cal_tl, cam_tl=self.cam_tl
+        )
+
+        # Capture Cubert image
+        if tl_success:
+            take_and_save_cubert_image(
+                img_name=self.img_name, dark_cal=self.dark_cal_cb,
+                acquContext=self.acquisitionContext, procContext=self.processingContext
+            )
+        # The CB preview is sent once the measurement is processed, a cube failing the SNR check is taken again
+        si.retry_failed_cubert(self.dark_cal_cb, self.acquisitionContext, self.processingContext, wait=True)
+
+    def capture_dataset(self):
+        # Skip images that are already in the manifest of an earlier, interrupted run
+        manifest = si.open_session_manifest(os.path.join(self.folder_path, "session_manifest.jsonl"))
+
+        # Set up the pygame display and images
+        scrn, images_disp = setup_pygame_display(display_x, display_y, img_size_x, img_size_y, self.data_folder, skip=manifest.completed_names())
+        print("Pygame setup done.")
+        total = len(images_disp)
+
+        def on_pair(img_num, img_name, tl_success, cb_success):
+            self.progress.emit(img_num, total, img_name)
+
+        try:
+            self.cam_tl, _ = si.run_dataset(
+                scrn, images_disp, self.cam_tl, self.dark_cal_tl, self.acquisitionContext, self.processingContext, self.dark_cal_cb,
+                should_stop=self._cancel.is_set, on_pair=on_pair
+            )
+        finally:
+            # Pairs are only recorded once written, so flush before closing the manifest
+            si.wait_for_saves()
+            si.close_session_manifest()
+            pygame.quit()
+
+        si.print_pair_summary()
+        print(si.exposure_controller_tl.summary())
+        print(si.buffer_pool.report())
+        print(si.tl_recovery.report())
+        print(si.cb_recovery.report())
+        return not self._cancel.is_set()
+
+
+class LiveViewWorker(QObject):
+    """
+    Streams the Thorlabs cam to the GUI for alignment, at the cam's native frame rate.
+
+    Frames are not dark subtracted or demosaiced. The 0 degree sub-lattice of the raw
+    mosaic is decimated to the preview size and sent as an array. A new frame is only
+    sent once the GUI has drawn the previous one (frame_shown()), so a slow GUI drops
+    frames instead of queueing them.
+    """
+    frame = pyqtSignal(object)  # decimated frame
+    error = pyqtSignal(str)
+    finished = pyqtSignal()
+
+    def __init__(self, cam_tl, exposure_ms, max_size=(500, 500)):
+        super().__init__()
+        self.cam_tl = cam_tl
+        self.exposure_ms = exposure_ms
+        self.max_size = max_size
+        self._stop = threading.Event()
+        self._shown = threading.Event()
+        self._shown.set()
+
+    def stop(self):
+        self._stop.set()
+
+    def frame_shown(self):
+        self._shown.set()
+
+    def run(self):
+        try:
+            self.cam_tl.set_exposure(self.exposure_ms * 1e-3)
+            for raw in camera_backends.stream_thorlabs_frames(self.cam_tl, self._stop.is_set):
+                if not self._shown.is_set():
+                    continue
+                self._shown.clear()
+                height, width = raw.shape
+                self.frame.emit(decimate(sublattice_view(raw, (0, height, 0, width), 0), self.max_size))
+        except Exception as e:
+            self.error.emit(str(e))
+        self.finished.emit()
+
+
 class CameraGUI(QWidget):   
     def __init__(self):
         super().__init__()
@@ -45,6 +186,12 @@ class CameraGUI(QWidget):
         self.countdown_timer.timeout.connect(self.update_countdown)
         self.remaining_seconds = 0
         self.auto_mode_active = False  # Track if auto mode is active
+        self.capture_thread = None  # QThread running the current capture
+        self.capture_worker = None
+        self.live_thread = None  # QThread running the live view
+        self.live_worker = None
+        self.tl_renderer = PreviewRenderer(bit_depth=12, gamma=preview_gamma, percentiles=preview_percentiles_tl)
+        self.cb_renderer = PreviewRenderer(bit_depth=12, gamma=preview_gamma, percentiles=preview_percentiles_cb)
 
         # Variables to store dark calibration file paths
         self.dark_cal_tl = None
@@ -135,6 +282,27 @@ class CameraGUI(QWidget):
         auto_layout.addWidget(auto_button)
         countdown_layout.addLayout(auto_layout)
 
+        # Live view of the Thorlabs cam for alignment
+        self.live_button = QPushButton("Live View")
+        self.live_button.setCheckable(True)
+        self.live_button.clicked.connect(self.toggle_live_view)
+        countdown_layout.addWidget(self.live_button)
+
+        # Master darks of both cams, with the lenses covered
+        dark_capture_button = QPushButton("Capture Darks")
+        dark_capture_button.clicked.connect(self.capture_darks)
+        countdown_layout.addWidget(dark_capture_button)
+
+        # Capture progress and cancel
+        progress_layout = QHBoxLayout()
+        self.progress_label = QLabel("Idle")
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel_capture)
+        progress_layout.addWidget(self.progress_label)
+        progress_layout.addWidget(self.cancel_button)
+        countdown_layout.addLayout(progress_layout)
+
         main_layout.addLayout(countdown_layout)
         self.setLayout(main_layout)
 
@@ -144,6 +312,8 @@ class CameraGUI(QWidget):
     def initCameras(self):
         self.cam_tl = setup_thorlabs_cam()
         self.acquisitionContext, self.processingContext, _ = setup_cubert_cam()
+        si.load_defect_map()
+        si.start_frame_writer()
 
     def select_folder(self):
         folder = QFileDialog.getExistingDirectory(self, "Select Folder")
@@ -153,12 +323,16 @@ class CameraGUI(QWidget):
             si.cubert_image_folder = os.path.join(folder, "cubert")
             os.makedirs(si.thorlabs_image_folder, exist_ok=True)
             os.makedirs(si.cubert_image_folder, exist_ok=True)
+            si.dark_folder = os.path.join(folder, "darks")
+            # Frames saved from now on are indexed in the catalog of the new folder
+            si.frame_catalog_path = os.path.join(folder, "frame_catalog.sqlite")
+            si.close_frame_catalog()
             self.folder_input.setText(folder)
 
     def select_dark_cal_tl(self):
         file, _ = QFileDialog.getOpenFileName(self, "Select Thorlabs Dark Cal File", "", "All Files (*.*)")
         if file:
-            self.dark_cal_tl = np.load(file)
+            self.dark_cal_tl = si.load_dark(file)
             self.dark_cal_tl_label.setText(f"Thorlabs Dark Cal: {os.path.basename(file)}")
         else:
             self.dark_cal_tl = None
@@ -167,7 +341,7 @@ class CameraGUI(QWidget):
         
         file, _ = QFileDialog.getOpenFileName(self, "Select Cubert Dark Cal File", "", "All Files (*.*)")
         if file:
-            self.dark_cal_cb = np.load(file)
+            self.dark_cal_cb = si.load_dark(file)
             self.dark_cal_cb_label.setText(f"Cubert Dark Cal: {os.path.basename(file)}")
         else:
             self.dark_cal_cb = None
@@ -185,150 +359,163 @@ class CameraGUI(QWidget):
             print("Please select a folder to save images.")
             return
 
+        if self.capture_thread is not None:
+            print("Capture already running.")
+            return
+
+        if self.live_thread is not None:
+            print("Stop the live view before capturing.")
+            return
+
         if self.auto_mode_active:
             self.countdown_label.setText("Imaging")
             self.update_countdown_color(imaging=True)
             self.countdown_timer.stop()
 
-        img_name = f"image_{self.image_counter}"
-
-        if self.data_sel_folder is None:
-            # Capture Thorlabs image
-            tl_success, self.cam_tl = take_and_save_thorlabs_image(
-                img_name=img_name, dark_cal=self.dark_cal_tl, cam_tl=self.cam_tl
-            )
+        # Run the capture on a worker thread so the UI stays responsive
+        self.capture_thread = QThread()
+        self.capture_worker = CaptureWorker(self, f"image_{self.image_counter}", self.data_sel_folder)
+        self.capture_worker.moveToThread(self.capture_thread)
+        self.capture_thread.started.connect(self.capture_worker.run)
+        self.capture_worker.progress.connect(self.on_capture_progress)
+        self.capture_worker.preview.connect(self.on_capture_preview)
+        self.capture_worker.error.connect(self.on_capture_error)
+        self.capture_worker.finished.connect(self.on_capture_finished)
+        self.capture_worker.finished.connect(self.capture_thread.quit)
+        self.capture_thread.finished.connect(self.on_capture_thread_finished)
+
+        self.cancel_button.setEnabled(True)
+        self.progress_label.setText("Capturing...")
+        self.capture_thread.start()
+
+    def capture_darks(self):
+        if self.capture_thread is not None:
+            print("Capture already running.")
+            return
 
-            # Capture Cubert image
-            if tl_success:
-                take_and_save_cubert_image(
-                    img_name=img_name, dark_cal=self.dark_cal_cb,
-                    acquContext=self.acquisitionContext, procContext=self.processingContext
-                )
-            print("debug")
-            tl_path = os.path.join(self.folder_path, f"thorlabs/{img_name}_thorlabs.tif")
-            cb_path = os.path.join(self.folder_path, f"cubert/{img_name}_cubert.tif")
-
-            if os.path.exists(tl_path):
-                self.display_image(tl_path, self.tl_label, channel=0, max_size=(500, 500), tl_flag = True)
-            if os.path.exists(cb_path):
-                self.display_image(cb_path, self.cb_label, channel=0, max_size=(500, 500), tl_flag = False)
-            print("debug_2")
-            self.image_counter += 1
+        if self.live_thread is not None:
+            print("Stop the live view before capturing darks.")
+            return
 
-            if self.auto_mode_active:
-                print("debug_3")
-                interval = int(self.interval_input.text())
-                self.remaining_seconds = interval
-                self.countdown_timer.start(1000)
-                print("debug_4")
+        # Shares the capture thread slot, so darks, captures and the live view exclude each other
+        self.capture_thread = QThread()
+        self.capture_worker = DarkCaptureWorker(self, si.capture_darks)
+        self.capture_worker.moveToThread(self.capture_thread)
+        self.capture_thread.started.connect(self.capture_worker.run)
+        self.capture_worker.progress.connect(self.progress_label.setText)
+        self.capture_worker.error.connect(self.on_capture_error)
+        self.capture_worker.finished.connect(self.on_darks_finished)
+        self.capture_worker.finished.connect(self.capture_thread.quit)
+        self.capture_thread.finished.connect(self.on_capture_thread_finished)
+
+        self.cancel_button.setEnabled(True)
+        self.progress_label.setText("Capturing darks...")
+        self.capture_thread.start()
+
+    def on_darks_finished(self, paths):
+        self.cam_tl = self.capture_worker.cam_tl
+        self.cancel_button.setEnabled(False)
+
+        # Use the new darks right away
+        if paths["tl"] is not None:
+            self.dark_cal_tl = si.load_dark(paths["tl"])
+            self.dark_cal_tl_label.setText(f"Thorlabs Dark Cal: {os.path.basename(paths['tl'])}")
+        if paths["cb"] is not None:
+            self.dark_cal_cb = si.load_dark(paths["cb"])
+            self.dark_cal_cb_label.setText(f"Cubert Dark Cal: {os.path.basename(paths['cb'])}")
+        done = paths["tl"] is not None and paths["cb"] is not None
+        self.progress_label.setText("Darks captured" if done else "Dark capture incomplete")
+
+    def on_capture_thread_finished(self):
+        # Only drop the references once the thread has actually stopped
+        self.capture_thread.deleteLater()
+        self.capture_worker.deleteLater()
+        self.capture_thread = None
+        self.capture_worker = None
+
+    def cancel_capture(self):
+        if self.capture_worker is not None:
+            self.capture_worker.cancel()
+            self.progress_label.setText("Cancelling after current pair...")
+            self.cancel_button.setEnabled(False)
+
+    def on_capture_progress(self, img_num, total, img_name):
+        total_text = f"/{total}" if total else ""
+        self.progress_label.setText(f"Image {img_num}{total_text}: {img_name}")
+
+    def on_capture_preview(self, img_name, camera, img):
+        if camera == "tl":
+            self.display_image(img, self.tl_label, channel=0, max_size=si.preview_size, tl_flag = True)
         else:
-            # Set up the pygame display and images
-            scrn, images_disp = setup_pygame_display(display_x, display_y, img_size_x, img_size_y, self.data_sel_folder)
-            print("Pygame setup done.")
-
-            # Wait a few seconds so the monitor can update
-            pygame.time.wait(1000)
-
-            img_num = 1
-
-            # Loop over all loaded display images
-            for img_disp in images_disp:
-
-                # Display image
-                print(f"Image #{img_num}")
-                img_name = display_image(img_disp=img_disp, scrn=scrn)
-
-                # Taking and saving photo with Thorlabs cam
-                tl_success, self.cam_tl = take_and_save_thorlabs_image(
-                    img_name=img_name, dark_cal=self.dark_cal_tl, cam_tl=self.cam_tl
-                )
-
-                # Taking and saving photo with Cubert cam
-                if tl_success:
-                    take_and_save_cubert_image(
-                        img_name=img_name, dark_cal=self.dark_cal_cb,
-                        acquContext=self.acquisitionContext, procContext=self.processingContext)
-                    
-                tl_path = os.path.join(self.folder_path, f"thorlabs/{img_name}_thorlabs.tif")
-                cb_path = os.path.join(self.folder_path, f"cubert/{img_name}_cubert.tif")
-
-                if os.path.exists(tl_path):
-                    self.display_image(tl_path, self.tl_label, channel=0, max_size=(500, 500), tl_flag = True)
-                if os.path.exists(cb_path):
-                    self.display_image(cb_path, self.cb_label, channel=0, max_size=(500, 500), tl_flag = False)
-
-
-                # wait a second
-                pygame.time.wait(1000)
-
+            self.display_image(img, self.cb_label, channel=0, max_size=si.preview_size, tl_flag = False)
 
+    def toggle_live_view(self):
+        if self.live_thread is not None:
+            self.live_worker.stop()
+            self.live_button.setEnabled(False)
+            return
 
-                img_num += 1
+        if self.capture_thread is not None:
+            print("Capture running, live view not started.")
+            self.live_button.setChecked(False)
+            return
 
+        self.live_thread = QThread()
+        self.live_worker = LiveViewWorker(self.cam_tl, si.exposure_time_tl, max_size=si.preview_size)
+        self.live_worker.moveToThread(self.live_thread)
+        self.live_thread.started.connect(self.live_worker.run)
+        self.live_worker.frame.connect(self.on_live_frame)
+        self.live_worker.error.connect(self.on_capture_error)
+        self.live_worker.finished.connect(self.live_thread.quit)
+        self.live_thread.finished.connect(self.on_live_thread_finished)
+        self.live_button.setChecked(True)
+        self.live_thread.start()
+
+    def on_live_frame(self, img):
+        self.display_image(img, self.tl_label, channel=0, max_size=si.preview_size, tl_flag = True)
+        if self.live_worker is not None:
+            self.live_worker.frame_shown()
+
+    def on_live_thread_finished(self):
+        self.live_thread.deleteLater()
+        self.live_worker.deleteLater()
+        self.live_thread = None
+        self.live_worker = None
+        self.live_button.setChecked(False)
+        self.live_button.setEnabled(True)
+
+    def on_capture_error(self, message):
+        print(f"Capture error: {message}")
+        self.progress_label.setText(f"Error: {message}")
+
+    def on_capture_finished(self, dataset_done):
+        self.cam_tl = self.capture_worker.cam_tl
+        self.cancel_button.setEnabled(False)
+
+        if dataset_done:
             print("✅ All images captured. Exiting program.")
+            self.close()
+            return
 
-        sys.exit(0)
-            
+        if self.data_sel_folder is None:
+            self.image_counter += 1
+            self.progress_label.setText(f"Captured image_{self.image_counter - 1}")
 
-    def display_image(self, path, label, channel=0, max_size=(500, 500), tl_flag=True):
-        img = tifffile.imread(path)
+        if self.auto_mode_active:
+            interval = int(self.interval_input.text())
+            self.remaining_seconds = interval
+            self.countdown_timer.start(1000)
 
-        # Define crop coordinates
-        if tl_flag:
-            #crop_coords = ((1250, 1910), (510, 1170))  # Thorlabs crop
-            y1 = 399
-            y2 = 1059
-            x1 = 1177
-            x2 = 1837
-        else:
-            #crop_coords = ((136, 256), (89, 209))  # Cubert crop
-            y1 = 75
-            y2 = 195
-            x1 = 116
-            x2 = 236
-        # Crop the image
-        #img = img[:, y1:y2, x1:x2]
-
-        #print("Cropped Shape:", img.shape)
-
-        # if tl_flag:
-        #     # Get max, average, and SNR values for each channel
-        #     max_pixel_values = [np.max(img[i]) for i in range(img.shape[0])]
-        #     avrg_pixel_values = [np.average(img[i]) for i in range(img.shape[0])]
-        #     std_pixel_values = [np.std(img[i]) for i in range(img.shape[0])]
-            
-        #     # Compute SNR for each channel (Mean / Standard Deviation)
-        #     snr_values = [(avrg_pixel_values[i] / std_pixel_values[i]) if std_pixel_values[i] != 0 else float('inf')
-        #                 for i in range(img.shape[0])]
-
-        #     # Print max values for each channel
-        #     for i, max_val in enumerate(max_pixel_values):
-        #         print(f"Channel {i} Max Pixel Value: {max_val}")
-
-        #     # Print average values for each channel
-        #     for i, ave_val in enumerate(avrg_pixel_values):
-        #         print(f"Channel {i} Average: {ave_val}")
-
-        #     # Print SNR for each channel
-        #     for i, snr_val in enumerate(snr_values):
-        #         print(f"Channel {i} SNR: {snr_val}")
-
-        # else:
-        #     print("Cropped Max Pixel Value:", np.max(img))
-        #     print("Cropped Average Pixel Value:", np.average(img))
-
-    
+    def display_image(self, img, label, channel=0, max_size=(500, 500), tl_flag=True):
         # Select channel if multi-channel image
         if img.ndim > 2:
             img = img[channel] if channel < img.shape[0] else img[0]  # Ensure valid channel selection
 
-        # Normalize image to 8-bit grayscale
-        if img.dtype == np.uint16 and np.max(img) <= 4095:
-            img_normalized = ((img / 4095) * 255).astype(np.uint8)
-        else:
-            img_normalized = ((img - np.min(img)) / (np.max(img) - np.min(img)) * 255).astype(np.uint8)
+        # Convert to 8-bit grayscale through the renderer's lookup table
+        renderer = self.tl_renderer if tl_flag else self.cb_renderer
+        img_normalized = renderer.render(img)
 
-        # Convert to QImage
+        # Convert to QImage, straight on the contiguous uint8 buffer, fromImage makes the only copy
         height, width = img_normalized.shape
         bytes_per_line = width
         qimg = QImage(img_normalized.data, width, height, bytes_per_line, QImage.Format_Grayscale8)
@@ -373,9 +560,20 @@ class CameraGUI(QWidget):
             self.countdown_timer.stop()
             self.countdown_label.setText("Imaging")
             self.update_countdown_color(imaging=True)
+            # The countdown restarts once the capture worker has finished
             self.capture_images()
-            self.remaining_seconds = int(self.interval_input.text())
-            self.countdown_timer.start(1000)
+
+    def closeEvent(self, event):
+        if self.live_thread is not None:
+            self.live_worker.stop()
+            self.live_thread.quit()
+            self.live_thread.wait()
+        if self.capture_thread is not None:
+            self.capture_worker.cancel()
+            self.capture_thread.quit()
+            self.capture_thread.wait()
+        si.stop_frame_writer()
+        super().closeEvent(event)
 
     def update_countdown_color(self, remaining_seconds=0, imaging=False):
         palette = self.countdown_label.palette()
@@ -0,0 +1,198 @@
+"""
+End-to-end benchmark of the scene_imager capture loop against the simulated cams.
+
+Runs run_dataset() over synthetic display images and reports pairs/minute plus p50/p95
+latency of every pipeline stage (display, settle, snap, demosaic, dark subtraction, SNR,
+Cubert processing, write). Every run is appended to a JSON-lines history file (by default
+~/.camera_util/acquisition_history.jsonl, outside the source tree) together
+with the git commit, and compared to the last run with the same settings, so slowdowns
+between commits show up as regressions.
+
+Example:
+    python benchmark_acquisition.py --images 20 --latency-scale 0.1
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+# Must be set before scene_imager / pygame are imported
+os.environ.setdefault("CAMERA_BACKEND", "simulated")
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import numpy as np
+import pygame
+import scene_imager as si
+
+# Outside the source tree, so benchmark runs never leave files in the repo
+default_history = os.path.join(os.path.expanduser("~"), ".camera_util", "acquisition_history.jsonl")
+
+
+## Create synthetic display images
+def make_display_images(folder, n, size=(640, 480), seed=0):
+    rng = np.random.default_rng(seed)
+    for i in range(n):
+        pixels = rng.integers(0, 256, size=(size[0] // 16, size[1] // 16, 3), dtype=np.uint8)
+        surface = pygame.transform.scale(pygame.surfarray.make_surface(pixels), size)
+        pygame.image.save(surface, os.path.join(folder, f"bench_{i:05d}.png"))
+
+
+## Run the capture loop once and collect the results
+def run_benchmark(n_images, latency_scale, paired, async_write, settle_ms, seed=0, failure_rate=0.0, disconnect_rate=0.0):
+    si.camera_backend = "simulated"
+    si.sim_options_tl = dict(latency_scale=latency_scale, seed=seed, failure_rate=failure_rate, disconnect_rate=disconnect_rate)
+    si.sim_options_cb = dict(latency_scale=latency_scale, seed=seed + 1, failure_rate=failure_rate)
+    si.paired_capture = paired
+    si.async_write = async_write
+    si.settle_time_ms = settle_ms
+    si.stage_timer.reset()
+    si.tl_recovery.reset()
+    si.cb_recovery.reset()
+    si.reset_pair_log()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        display_folder = os.path.join(tmp, "display")
+        si.thorlabs_image_folder = os.path.join(tmp, "thorlabs")
+        si.cubert_image_folder = os.path.join(tmp, "cubert")
+        si.pair_log_path = os.path.join(tmp, "pair_timestamps.csv")
+        si.session_manifest_path = os.path.join(tmp, "session_manifest.jsonl")
+        si.dataset_store_path = os.path.join(tmp, "dataset.h5")
+        si.frame_catalog_path = os.path.join(tmp, "frame_catalog.sqlite")
+        si.close_frame_catalog()
+        for folder in (display_folder, si.thorlabs_image_folder, si.cubert_image_folder):
+            os.makedirs(folder)
+
+        pygame.init()
+        make_display_images(display_folder, n_images, seed=seed)
+
+        cam_tl = si.setup_thorlabs_cam()
+        acquisitionContext, processingContext, _ = si.setup_cubert_cam()
+
+        # Flat master darks at the simulated dark level
+        roi = si.roi_tl
+        dark_tl = np.full((1, roi[3] - roi[2], roi[1] - roi[0]), cam_tl.dark_level)
+        h, w, bands = acquisitionContext.cube_shape
+        dark_cb = np.full((bands, h, w), acquisitionContext.dark_level)
+
+        scrn, images_disp = si.setup_pygame_display(si.display_x, si.display_y, si.img_size_x, si.img_size_y, display_folder)
+        si.start_frame_writer()
+
+        t0 = time.perf_counter()
+        cam_tl, n_complete = si.run_dataset(scrn, images_disp, cam_tl, dark_tl, acquisitionContext, processingContext, dark_cb)
+        si.stop_frame_writer()
+        elapsed = time.perf_counter() - t0
+
+        cam_tl.close()
+        pygame.quit()
+
+    return {
+        "pairs": n_complete,
+        "images": n_images,
+        "elapsed_s": elapsed,
+        "pairs_per_min": 60 * n_complete / elapsed if elapsed > 0 else 0,
+        "stages": si.stage_timer.summary(),
+        "buffer_pool": si.buffer_pool.stats(),
+        "recovery": {"tl": si.tl_recovery.stats(), "cb": si.cb_recovery.stats()},
+    }
+
+
+## Current git commit of the repo, marked dirty if there are local changes
+def git_commit():
+    try:
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=cwd, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=cwd, capture_output=True, text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+## Compare against the last run with the same config
+def find_regressions(entry, history_path, threshold, min_delta_ms=1.0):
+    previous = None
+    if os.path.exists(history_path):
+        with open(history_path) as f:
+            for line in f:
+                try:
+                    old = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if old.get("config") == entry["config"]:
+                    previous = old
+    if previous is None:
+        return None, []
+
+    regressions = []
+    old_rate = previous["result"]["pairs_per_min"]
+    new_rate = entry["result"]["pairs_per_min"]
+    if old_rate > 0 and new_rate < old_rate * (1 - threshold):
+        regressions.append(f"pairs/min {old_rate:.2f} -> {new_rate:.2f}")
+    for stage, new in entry["result"]["stages"].items():
+        old = previous["result"]["stages"].get(stage)
+        if old is None:
+            continue
+        for key in ("p50_ms", "p95_ms"):
+            if new[key] > old[key] * (1 + threshold) and new[key] - old[key] > min_delta_ms:
+                regressions.append(f"{stage} {key} {old[key]:.2f} -> {new[key]:.2f}")
+    return previous, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the scene_imager capture loop on simulated cams.")
+    parser.add_argument("--images", type=int, default=10, help="Number of display images / pairs.")
+    parser.add_argument("--latency-scale", type=float, default=0.1, help="Scale of simulated exposure/readout times.")
+    parser.add_argument("--sequential", action="store_true", help="Capture TL then CB instead of paired capture.")
+    parser.add_argument("--sync-write", action="store_true", help="Write TIFFs in the capture loop.")
+    parser.add_argument("--settle-ms", type=int, default=si.settle_time_ms, help="Wait after every pair in ms.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Probability of a simulated frame timeout / failed capture.")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="Probability of a simulated TL disconnect per frame.")
+    parser.add_argument("--history", default=default_history, help="JSON-lines file the results are appended to.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown reported as regression.")
+    parser.add_argument("--no-save", action="store_true", help="Do not append this run to the history.")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 on regressions.")
+    args = parser.parse_args()
+
+    config = {
+        "images": args.images,
+        "latency_scale": args.latency_scale,
+        "paired": not args.sequential,
+        "async_write": not args.sync_write,
+        "settle_ms": args.settle_ms,
+        "seed": args.seed,
+    }
+    # Only in the config when used, so fault-free runs still compare to older history entries
+    if args.failure_rate or args.disconnect_rate:
+        config.update(failure_rate=args.failure_rate, disconnect_rate=args.disconnect_rate)
+    result = run_benchmark(args.images, args.latency_scale, config["paired"], config["async_write"], args.settle_ms, args.seed,
+                           args.failure_rate, args.disconnect_rate)
+    entry = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": git_commit(), "config": config, "result": result}
+
+    print(f"\n{result['pairs']}/{result['images']} pairs in {result['elapsed_s']:.1f}s, {result['pairs_per_min']:.2f} pairs/min")
+    print(si.stage_timer.report())
+    print(si.buffer_pool.report())
+    print(si.tl_recovery.report())
+    print(si.cb_recovery.report())
+
+    previous, regressions = find_regressions(entry, args.history, args.threshold)
+    if previous is not None:
+        print(f"\nCompared to {previous['commit']} ({previous['timestamp']}):")
+        for r in regressions:
+            print(f"  REGRESSION {r}")
+        if not regressions:
+            print("  no regressions")
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+        with open(args.history, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
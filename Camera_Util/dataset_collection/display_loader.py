@@ -0,0 +1,107 @@
+import os
+import queue
+import struct
+import threading
+import pygame
+
+
+class DisplayImageLoader:
+    """
+    Streams the display images of a dataset folder as scaled pygame Surfaces.
+
+    Images are decoded and scaled on a background thread, at most prefetch images ahead
+    of the capture loop, instead of all of them up front. Iterating yields the same
+    (surface, rect, name) tuples setup_pygame_display used to return in its list.
+
+    With cache_dir set, every scaled image is also stored there as raw RGB pixels, so
+    later sessions with the same display size skip decoding and scaling completely.
+
+    Parameters:
+        img_path (str): Folder with the .jpg/.png display images.
+        size (tuple): (width, height) the images are scaled into, keeping their ratio.
+        prefetch (int): Number of images decoded ahead.
+        cache_dir (str): Optional folder for pre-scaled images.
+        skip (set): Optional image names to leave out.
+    """
+
+    def __init__(self, img_path, size, prefetch=8, cache_dir=None, skip=None):
+        self.img_path = img_path
+        self.size = (round(size[0]), round(size[1]))
+        self.prefetch = prefetch
+        self.cache_dir = cache_dir
+        skip = skip or set()
+        self.names = sorted(f for f in os.listdir(img_path) if (f.endswith('.jpg') or f.endswith('.png')) and f not in skip)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        items = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        loader = threading.Thread(target=self._load_all, args=(items, stop), name="display_loader", daemon=True)
+        loader.start()
+
+        try:
+            for _ in self.names:
+                item = items.get()
+                if isinstance(item, Exception):
+                    raise item
+                surface, rect, name = item
+                # Match the display pixel format once, on the thread that owns the display
+                if pygame.display.get_surface() is not None:
+                    surface = surface.convert()
+                yield surface, rect, name
+        finally:
+            stop.set()
+
+    def _load_all(self, items, stop):
+        for name in self.names:
+            try:
+                item = self._load(name)
+            except Exception as e:
+                item = e
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+            if stop.is_set() or isinstance(item, Exception):
+                return
+
+    def _load(self, name):
+        cache_path = self._cache_path(name) if self.cache_dir else None
+        if cache_path and os.path.exists(cache_path):
+            scaled_image = self._read_cache(cache_path)
+        else:
+            image = pygame.image.load(os.path.join(self.img_path, name))
+            iwidth, iheight = image.get_size()
+            scale = min(self.size[0] / iwidth, self.size[1] / iheight)
+            new_size = (round(iwidth * scale), round(iheight * scale))
+            scaled_image = pygame.transform.scale(image, new_size)
+            if cache_path:
+                self._write_cache(cache_path, scaled_image)
+
+        image_rect = scaled_image.get_rect(center=(self.size[0] // 2, self.size[1] // 2))
+        return scaled_image, image_rect, name
+
+    def _cache_path(self, name):
+        # Source size and mtime in the key, so edited images are re-scaled
+        st = os.stat(os.path.join(self.img_path, name))
+        return os.path.join(self.cache_dir, f"{name}.{st.st_size}_{st.st_mtime_ns}.{self.size[0]}x{self.size[1]}.rgb")
+
+    @staticmethod
+    def _read_cache(path):
+        with open(path, "rb") as f:
+            w, h = struct.unpack("<II", f.read(8))
+            return pygame.image.frombytes(f.read(), (w, h), "RGB")
+
+    @staticmethod
+    def _write_cache(path, surface):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(struct.pack("<II", *surface.get_size()))
+            f.write(pygame.image.tobytes(surface, "RGB"))
+        os.replace(tmp, path)
@@ -0,0 +1,225 @@
+import os
+import queue
+import threading
+from contextlib import nullcontext
+import numpy as np
+
+# Per-sample metadata, one row per TL/CB pair
+sample_fields = {
+    "name": None,  # source display image, string dtype of the backend
+    "timestamp": np.float64,  # capture start of the pair (unix time)
+    "tl_exposure_ms": np.float64,
+    "cb_exposure_ms": np.float64,
+}
+
+
+class PairedStore:
+    """
+    Chunked container for a whole dataset of TL/CB pairs, instead of two TIFF files per pair.
+
+    Holds the resizable datasets "tl" (N, 5, 660, 660) and "cb" (N, 106, 120, 120) and the
+    per-sample arrays in sample_fields, all aligned on the first axis. Every sample is one
+    compressed chunk, so a single pair can be read without decompressing its neighbours.
+    The image datasets are created with the shape and dtype of the first pair.
+
+    The sample name is written last, so a pair that was interrupted while being appended
+    is cut off again when the store is reopened. Appending a name that is already in the
+    store overwrites that sample.
+
+    Parameters:
+        path (str): .h5 file (backend "hdf5") or directory store (backend "zarr").
+        backend (str): "hdf5" (needs h5py) or "zarr" (needs zarr < 3).
+        compression_level (int): gzip level for hdf5, zstd level for zarr.
+    """
+
+    def __init__(self, path, backend="hdf5", compression_level=4):
+        self.path = path
+        self.backend = backend
+        self.compression_level = compression_level
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        if backend == "hdf5":
+            import h5py
+            self._h5py = h5py
+            self._root = h5py.File(path, "a")
+        elif backend == "zarr":
+            import zarr
+            import numcodecs
+            self._numcodecs = numcodecs
+            self._root = zarr.open_group(path, mode="a")
+        else:
+            raise ValueError(f"Unknown store backend {backend!r}, use 'hdf5' or 'zarr'.")
+
+        # Samples with a name are complete, drop a torn last sample
+        self.index = {}
+        if "name" in self._root:
+            for i, name in enumerate(self._root["name"][:]):
+                name = name.decode() if isinstance(name, bytes) else str(name)
+                if not name:
+                    break
+                self.index[name] = i
+        self._n = len(self.index)
+        for key in self._root:
+            self._root[key].resize((self._n,) + self._root[key].shape[1:])
+
+    def __len__(self):
+        return self._n
+
+    def names(self):
+        return set(self.index)
+
+    def append(self, name, tl, cb, timestamp, tl_exposure_ms, cb_exposure_ms):
+        """Append one pair and return its sample index."""
+        if "tl" not in self._root:
+            self._create("tl", tl.shape, tl.dtype, compress=True)
+            self._create("cb", cb.shape, cb.dtype, compress=True)
+            self._create("name", (), None)
+            for field, dtype in sample_fields.items():
+                if dtype is not None:
+                    self._create(field, (), dtype)
+
+        i = self.index.get(name, self._n)
+        if i == self._n:
+            for key in self._root:
+                self._root[key].resize((self._n + 1,) + self._root[key].shape[1:])
+            self._n += 1
+
+        self._root["tl"][i] = tl
+        self._root["cb"][i] = cb
+        self._root["timestamp"][i] = timestamp
+        self._root["tl_exposure_ms"][i] = tl_exposure_ms
+        self._root["cb_exposure_ms"][i] = cb_exposure_ms
+        self._root["name"][i] = name
+        if self.backend == "hdf5":
+            self._root.flush()
+        self.index[name] = i
+        return i
+
+    def close(self):
+        if self.backend == "hdf5" and self._root.id.valid:
+            self._root.close()
+
+    def _create(self, key, sample_shape, dtype, compress=False):
+        shape = (self._n,) + tuple(sample_shape)
+        chunks = (1,) + tuple(sample_shape) if compress else (1024,)
+        if self.backend == "hdf5":
+            if dtype is None:
+                dtype = self._h5py.string_dtype()
+            options = dict(compression="gzip", compression_opts=self.compression_level, shuffle=True) if compress else {}
+            self._root.create_dataset(key, shape=shape, maxshape=(None,) + tuple(sample_shape), chunks=chunks, dtype=dtype, **options)
+        else:
+            if dtype is None:
+                dtype = "<U256"
+            compressor = self._numcodecs.Blosc(cname="zstd", clevel=self.compression_level, shuffle=self._numcodecs.Blosc.SHUFFLE) if compress else None
+            self._root.create_dataset(key, shape=shape, chunks=chunks, dtype=dtype, compressor=compressor)
+
+
+class PairedStoreWriter:
+    """
+    Collects the TL and CB frames of each pair and appends complete pairs to a PairedStore.
+
+    The TL and CB images of a pair are finished at different times on different threads,
+    but the store needs them together. submit() holds a frame until the other camera's
+    frame of the same name arrives, then a single background thread appends the pair.
+    on_done(error) of both frames is called once the pair is in the store, the same way
+    FrameWriter calls it once a TIFF is on disk. discard() drops a pair where one camera
+    failed, its frames are given back through on_done with an error.
+
+    Parameters:
+        store (PairedStore): Store the pairs are appended to.
+        max_in_flight (int): Complete pairs queued for appending before submit() blocks.
+        timer (StageTimer): Optional timer that records every append as stage "store_append".
+    """
+
+    def __init__(self, store, max_in_flight=4, timer=None):
+        self.store = store
+        self.timer = timer
+        self._lock = threading.Lock()
+        self._held = {}  # name -> {camera: (data, info, on_done)}
+        self._discarded = set()
+        self._queue = queue.Queue(maxsize=max_in_flight)
+        self.errors = []
+        self.pairs_written = 0
+        self._worker = threading.Thread(target=self._run, name="paired_store_writer", daemon=True)
+        self._worker.start()
+
+    def submit(self, name, camera, data, info, on_done=None):
+        """Hold the "tl" or "cb" frame of pair name. data must not be modified until on_done."""
+        with self._lock:
+            if name in self._discarded:
+                pair = None
+            else:
+                pair = self._held.setdefault(name, {})
+                pair[camera] = (data, info, on_done)
+                if "tl" not in pair or "cb" not in pair:
+                    return
+                del self._held[name]
+
+        if pair is None:
+            self._finish(on_done, RuntimeError(f"pair {name} was discarded"))
+            return
+        self._queue.put((name, pair))
+
+    def discard(self, name):
+        """Drop pair name because one of its cams failed."""
+        with self._lock:
+            self._discarded.add(name)
+            pair = self._held.pop(name, {})
+        for data, info, on_done in pair.values():
+            self._finish(on_done, RuntimeError(f"pair {name} is incomplete"))
+
+    def flush(self):
+        """Block until every complete pair is in the store."""
+        self._queue.join()
+
+    def close(self):
+        """Append the outstanding pairs, drop unpaired frames and close the store."""
+        self.flush()
+        self._queue.put(None)
+        self._worker.join()
+        with self._lock:
+            names = list(self._held)
+        for name in names:
+            self.discard(name)
+        self.store.close()
+        print(f"Store: {self.pairs_written} pairs appended to {self.store.path}, {len(self.errors)} failed.")
+        return self.errors
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+
+            name, pair = item
+            tl, tl_info, tl_done = pair["tl"]
+            cb, cb_info, cb_done = pair["cb"]
+            error = None
+            try:
+                with self.timer.stage("store_append") if self.timer is not None else nullcontext():
+                    i = self.store.append(name, tl, cb, timestamp=min(tl_info["t_start"], cb_info["t_start"]),
+                                          tl_exposure_ms=tl_info["exposure_ms"], cb_exposure_ms=cb_info["exposure_ms"])
+                for info in (tl_info, cb_info):
+                    info["path"] = self.store.path
+                    info["store_index"] = i
+                self.pairs_written += 1
+            except Exception as e:
+                error = e
+                self.errors.append((name, e))
+                print(f"Store: Failed to append {name}: {e}")
+
+            self._finish(tl_done, error)
+            self._finish(cb_done, error)
+            self._queue.task_done()
+
+    @staticmethod
+    def _finish(on_done, error):
+        try:
+            if on_done is not None:
+                on_done(error)
+        except Exception as e:
+            print(f"Store: on_done callback failed: {e}")
@@ -1,21 +1,40 @@
 import os
-os.add_dll_directory(r"C:\\Users\\menon\\Documents\\FTDI_drivers\\amd64")
-os.add_dll_directory(r"C:\\Program Files\\Cuvis\\bin")
-os.add_dll_directory(r"C:\\Users\\menon\\AppData\\Local\\Programs\\Python\\Python312\\Lib\\site-packages\\cuvis_il")
-os.environ["CUVIS"] = r"C:\\Program Files\\Cuvis"
-
-import pylablib as pll
-from pylablib.devices import Thorlabs as tl
-import cuvis
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 import time
-import platform
+import threading
+import csv
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 import tifffile
 import numpy as np
-import polanalyser as pa
 import pygame
+from frame_writer import FrameWriter, tiff_options
+from exposure_control import ExposureController
+from polar_processing import meter_window, PolarStackProcessor
+import camera_backends
+from dark_correction import DarkCorrector
+from dark_library import DarkLibrary
+from stage_timing import StageTimer
+from display_loader import DisplayImageLoader
+from session_manifest import SessionManifest
+from buffer_pool import BufferPool
+from frame_stats import frame_stats, count_saturated
+from paired_store import PairedStore, PairedStoreWriter
+from frame_catalog import FrameCatalog
+from camera_recovery import RecoveryManager
+from preview import decimate
+import dark_capture
+from defect_map import DefectMap
 
 ## Parameters
+# "hardware" for the rig, "simulated" to run without cams (e.g. CAMERA_BACKEND=simulated on Linux)
+camera_backend = os.environ.get("CAMERA_BACKEND", "hardware")
+sim_options_tl = {}  # e.g. dict(latency_scale=0.1, failure_rate=0.01), see camera_backends
+sim_options_cb = {}
+
 thorlabs_image_folder = 'example_images//thorlabs'
 cubert_image_folder = 'example_images//cubert'
 display_image_folder = r"E:\NASA_HSI\image_datasets\flickr_dataset\flickr30k_images\flickr30k_images"
@@ -27,19 +46,122 @@ img_size_x = 426*2.5
 img_size_y = 240*2.5
 img_offset_x = 0
 img_offset_y = 0
+display_prefetch = 8  # display images decoded ahead of the capture loop
+display_cache_dir = None  # e.g. 'example_images//display_cache' to keep pre-scaled images between sessions
+
+settle_time_ms = 1000  # wait after each pair so the monitor can update
+
+# In-memory previews: preview_callback(img_name, camera, frame) gets a decimated channel of every
+# frame before it is written, e.g. Camera_GUI shows it without reading the TIFF back
+preview_callback = None
+preview_size = (500, 500)  # (width, height)
+preview_channel_tl = 0
+preview_channel_cb = 0
+
+# Per-stage latency bookkeeping (snap, demosaic, write, ...), see stage_timing
+stage_timer = StageTimer()
+
+# Reused frame buffers (TL polarization stacks, CB cubes and crops), given back once the writer is done
+buffer_pool = BufferPool(max_per_key=8)  # up to max_frames_in_flight buffers per shape can be waiting for the writer
 
 exposure_time_tl = 450 # in ms
 exposure_time_cb = 4500 # in ms
 
+# Thorlabs auto-exposure: predictive solver, warm-started from the previous scene
+max_exposure_iterations_tl = 30
+exposure_controller_tl = ExposureController(target=4050, tolerance=100, saturation=4095, initial_exposure=exposure_time_tl)
+
 # Additional parameters for Thorlabs cam
 do_dark_subtract_tl = True
 path_dark_tl = "C:\\Users\\menon\\Documents\\Camera_Operation\\images\\dark_frame\\thorlabs\\thorlabs_masterdark.npy"  
 roi_tl = (0, 2448, 0, 2048)
+# Hot/noisy/stuck pixel correction of the raw TL mosaic before demosaicing, see defect_map
+do_defect_correct_tl = True
+path_defects_tl = "C:\\Users\\menon\\Documents\\Camera_Operation\\images\\dark_frame\\thorlabs\\thorlabs_defects.npz"
+defects_tl = None
+crop_tl = (399, 1059, 1177, 1837)  # (y1, y2, x1, x2)
+tl_processor = PolarStackProcessor(crop_tl, timer=stage_timer, pool=buffer_pool)
+saturation_tl = 4095  # raw pixels at or above this level, before dark subtraction, are counted as saturated
 
 # Additional parameters for Cubert cam
 do_dark_subtract_cb = True
 path_dark_cb = "C:\\Users\\menon\\Documents\\Camera_Operation\\images\\dark_frame\\cubert\\cubert_masterdark.npy"
 distance_cb = 800  # in mm
+min_snr_cb = 0.05  # cubes with a lower SNR are rejected
+saturation_cb = 4095  # raw counts of the 12-bit Cubert sensor, cube pixels at or above this level are counted as saturated
+cubert_timeout_factor = 1.5  # capture timeout = factor * integration time + overhead
+cubert_timeout_overhead_ms = 1000
+cubert_min_timeout_ms = 3000
+cubert_retry_wait_s = 0.5  # first backoff after a failed capture, doubled while captures keep failing
+
+# Camera recovery: re-arm after timeouts, reopen with backoff after disconnects, see camera_recovery
+tl_recovery = RecoveryManager("TL", rearm=camera_backends.rearm_thorlabs_cam,
+                              reopen=lambda cam: camera_backends.reopen_thorlabs_cam(cam, exposure_time_tl, roi_tl),
+                              reinit=lambda cam: reinit_thorlabs_cam(cam))
+cb_recovery = RecoveryManager("CB", reopen=camera_backends.wait_cubert_online, base_delay_s=cubert_retry_wait_s)
+
+# Pipelined Cubert mode: process measurement k on a worker while measurement k+1 is captured
+pipelined_cubert = True
+max_cubert_pending = 2  # measurements waiting for processing before the capture blocks
+cubert_worker = None
+_cubert_pending = []
+_cubert_retry = []  # images whose pipelined cube failed the SNR check, re-captured by retry_failed_cubert()
+_discarded_pairs = set()  # pairs dropped with discard_pair(), their cubes are not re-captured
+
+# Background TIFF writer, so slow disk writes do not stall the cams
+async_write = True
+max_frames_in_flight = 8
+writer_threads = 2
+frame_writer = None
+
+# TIFF compression per cam (None, 'zlib', 'zstd', 'lzma', 'lzw'), compare them with benchmark_tiff_codecs.py
+# zstd, lzw and the predictor for float frames need imagecodecs (pip install imagecodecs), checked by start_frame_writer()
+tiff_compression_tl = None
+tiff_compression_cb = None
+tiff_predictor = True  # horizontal / floating-point predictor for compressed TIFFs
+tiff_compression_level = None
+save_dtype_cb = None  # e.g. 'float32' to store float64 cubes at half the size, None keeps the processing dtype
+
+# Optional single container for the whole dataset instead of TIFF pairs, see paired_store
+dataset_store = None  # None (TIFF pairs), 'hdf5' or 'zarr'
+dataset_store_path = 'example_images//dataset.h5'
+store_writer = None
+
+# Working dtype of the dark subtraction, "native" keeps the camera's integer dtype
+dark_dtype_tl = "native"
+dark_dtype_cb = "float32"
+_dark_correctors = []  # (master dark, dtype, DarkCorrector)
+_dark_lock = threading.Lock()
+
+# Paired capture: drive both cams at the same time while a display image is shown
+paired_capture = True
+pair_log_path = 'example_images//pair_timestamps.csv'
+pair_log_size = 1000  # recent pairs kept in memory, pair_log_path has all of them
+pair_log = deque(maxlen=pair_log_size)
+_pair_totals = {"pairs": 0, "complete": 0, "overlap_s": 0.0, "start": None, "end": None}
+exposure_windows = {}  # camera -> (start, end) of its last exposure, the accepted one after a successful capture
+
+# Session manifest: journal of completed pairs, used to resume an interrupted run
+session_manifest_path = 'example_images//session_manifest.jsonl'
+session_manifest = None
+_pending_pairs = {}
+_pending_lock = threading.Lock()
+
+# Frame catalog: SQLite index of every saved frame (exposure, statistics, dark id, ...), see frame_catalog
+use_frame_catalog = True
+frame_catalog_path = 'example_images//frame_catalog.sqlite'  # opened with the first saved frame
+frame_catalog = None
+_catalog_lock = threading.Lock()
+
+# Dark capture with the lenses covered, see capture_darks()
+dark_folder = 'example_images//darks'
+dark_name_tl = 'thorlabs_masterdark'
+dark_name_cb = 'cubert_masterdark'
+defect_name_tl = 'thorlabs_defects'  # defect map built from the longest TL dark exposure
+dark_exposures_tl = [exposure_time_tl]  # in ms, darks at several exposures are fitted into a dark library (.npz)
+dark_exposures_cb = [exposure_time_cb]
+dark_frames_tl = 50  # frames averaged per exposure
+dark_frames_cb = 20
 
 ## Main function
 def main():
@@ -48,143 +170,253 @@ def main():
     print("TL setup done.")
 
     # Get Thorlabs masterdark calibration frame
-    dark_calibration_tl = np.load(path_dark_tl) if do_dark_subtract_tl else None
+    dark_calibration_tl = load_dark(path_dark_tl) if do_dark_subtract_tl else None
     print(dark_calibration_tl.shape)
 
+    # Get the Thorlabs defect map
+    load_defect_map()
+
     # Setup the Cubert cam
     acquisitionContext, processingContext, cubeExporter = setup_cubert_cam()
     print("CB setup done.")
 
     # Calibrate the Cubert cam
-    dark_calibration_cb = np.load(path_dark_cb) if do_dark_subtract_cb else None
+    dark_calibration_cb = load_dark(path_dark_cb) if do_dark_subtract_cb else None
+
+    # Skip images that are already in the manifest of an earlier, interrupted run
+    manifest = open_session_manifest()
 
     # Set up the pygame display and images
-    scrn, images_disp = setup_pygame_display(display_x, display_y, img_size_x, img_size_y, display_image_folder)
+    scrn, images_disp = setup_pygame_display(display_x, display_y, img_size_x, img_size_y, display_image_folder, skip=manifest.completed_names())
     print("Pygame setup done.")
 
+    # Start the background TIFF writer
+    start_frame_writer()
+
+    # Capture one TL/CB pair per display image
+    cam_tl, _ = run_dataset(scrn, images_disp, cam_tl, dark_calibration_tl, acquisitionContext, processingContext, dark_calibration_cb)
+
+    print("\nDataset creation finished. Quitting.")
+    stop_frame_writer()
+    close_session_manifest()
+    print_pair_summary()
+    print(exposure_controller_tl.summary())
+    print(stage_timer.report())
+    print(buffer_pool.report())
+    print(tl_recovery.report())
+    print(cb_recovery.report())
+    cam_tl.close()
+    pygame.quit()
+
+
+## Capture loop over all display images
+def run_dataset(scrn, images_disp, cam_tl, dark_cal_tl, acquContext, procContext, dark_cal_cb, should_stop=None, on_pair=None):
+    """
+    Shows every display image and takes one TL/CB pair of it.
+
+    should_stop() is checked between pairs and ends the loop if it returns True.
+    on_pair(img_num, img_name, tl_success, cb_success) is called after every pair.
+
+    Returns:
+        (cam_tl, n_complete): the (possibly re-opened) TL cam and the number of complete pairs.
+        With pipelined_cubert a pair counts as complete once its CB measurement was captured,
+        unless the cube fails the SNR check and its re-capture fails too.
+    """
     # Wait a few seconds so the monitor can update
-    pygame.time.wait(1000)
+    with stage_timer.stage("settle"):
+        pygame.time.wait(settle_time_ms)
 
     img_num = 1
+    n_complete = 0
+    cancelled = False
+
+    # Recently shown images, so a scene whose pipelined cube failed the SNR check can be shown again
+    recent = {}
+
+    def show_again(img_name):
+        img_disp = recent.get(img_name)
+        if img_disp is None or cancelled:
+            return False
+        display_image(img_disp=img_disp, scrn=scrn)
+        pygame.time.wait(settle_time_ms)
+        return True
 
     # Loop over all loaded display images
     for img_disp in images_disp:
+        if should_stop is not None and should_stop():
+            print("Capture cancelled.")
+            cancelled = True
+            break
 
         # Display image
         print(f"Image #{img_num}")
-        img_name = display_image(img_disp=img_disp, scrn=scrn)
-
-        # Taking and saving photo with Thorlabs cam
-        tl_success, cam_tl = take_and_save_thorlabs_image(img_name=img_name, dark_cal=dark_calibration_tl, cam_tl=cam_tl)
-
-        # Taking and saving photo with Cubert cam
-        if tl_success:
-            take_and_save_cubert_image(img_name=img_name, dark_cal=dark_calibration_cb, acquContext=acquisitionContext, procContext=processingContext)
-        else:
-            print("Skipping CB image because TL imaging was unsuccessful.")
+        with stage_timer.stage("display"):
+            img_name = display_image(img_disp=img_disp, scrn=scrn)
+        recent[img_name] = img_disp
+        while len(recent) > max_cubert_pending + 2:
+            del recent[next(iter(recent))]
+
+        with stage_timer.stage("pair"):
+            if paired_capture:
+                # Taking and saving photos with both cams at the same time
+                tl_success, cb_success, cam_tl = take_and_save_pair(
+                    img_name=img_name, dark_cal_tl=dark_cal_tl, dark_cal_cb=dark_cal_cb,
+                    cam_tl=cam_tl, acquContext=acquContext, procContext=procContext
+                )
+            else:
+                # Taking and saving photo with Thorlabs cam
+                tl_success, cam_tl = take_and_save_thorlabs_image(img_name=img_name, dark_cal=dark_cal_tl, cam_tl=cam_tl)
+
+                # Taking and saving photo with Cubert cam
+                cb_success = False
+                if tl_success:
+                    cb_success = take_and_save_cubert_image(img_name=img_name, dark_cal=dark_cal_cb, acquContext=acquContext, procContext=procContext)
+                else:
+                    print("Skipping CB image because TL imaging was unsuccessful.")
+        n_complete += tl_success and cb_success
+        if not (tl_success and cb_success):
+            discard_pair(img_name)
+        if on_pair is not None:
+            on_pair(img_num, img_name, tl_success, cb_success)
+
+        # Cubes of earlier scenes that failed the SNR check on the Cubert worker
+        n_complete -= retry_failed_cubert(dark_cal_cb, acquContext, procContext, show=show_again)
 
         # wait a second
-        pygame.time.wait(1000)
+        with stage_timer.stage("settle"):
+            pygame.time.wait(settle_time_ms)
 
         img_num += 1
 
-                # test if pygame should stop
+        # test if pygame should stop
         for e in pygame.event.get():
             if e.type == pygame.QUIT or e.type == pygame.KEYDOWN:
                 print("Quitting.")
-                pygame.quit()
-
-    print("\nDataset creation finished. Quitting.")
-    cam_tl.close()
-    pygame.quit()
-
-
-    # Wait for user input to capture images
-    while True:
-        input("Press Enter to capture images...")
-        img_name = str(img_num)
-
-        # Capture and save Thorlabs image
-        tl_success, cam_tl = take_and_save_thorlabs_image(
-            img_name=img_name, dark_cal=dark_calibration_tl, cam_tl=cam_tl
-        )
-
-        # Capture and save Cubert image if Thorlabs image was successful
-        if tl_success:
-            take_and_save_cubert_image(
-                img_name=img_name, dark_cal=dark_calibration_cb,
-                acquContext=acquisitionContext, procContext=processingContext
-            )
-        else:
-            print("Skipping CB image because TL imaging was unsuccessful.")
-
-        print("\nImage capture complete. Press Ctrl+C to quit.")
-        img_num += 1
-
-    cam_tl.close()
+                cancelled = True
+                break
+        if cancelled:
+            break
 
+    n_complete -= retry_failed_cubert(dark_cal_cb, acquContext, procContext, show=show_again, wait=True)
+    with _pending_lock:
+        _discarded_pairs.clear()
+    return cam_tl, n_complete
 
 ## Setup Thorlabs camera
 def setup_thorlabs_cam():
-    tl.list_cameras_tlcam()
-    cam = tl.ThorlabsTLCamera()
-    cam.set_exposure(exposure_time_tl * 1e-3)
-    cam.set_roi(*roi_tl, hbin=1, vbin=1)
-    return cam
+    return camera_backends.open_thorlabs_cam(camera_backend, exposure_time_tl, roi_tl, **sim_options_tl)
+
+## Full re-initialization of the Thorlabs cam, last step of tl_recovery
+def reinit_thorlabs_cam(cam_tl):
+    try:
+        cam_tl.close()
+    except Exception:
+        pass
+    return setup_thorlabs_cam()
 
 ## Take Thorlabs image, auto-adjust exposure, apply dark calibration, and save as TIFF
-def take_and_save_thorlabs_image(img_name, dark_cal, cam_tl, max_target=4050, tolerance=100):
+def take_and_save_thorlabs_image(img_name, dark_cal, cam_tl, max_target=4050, tolerance=100, sync=None):
+    """
+    sync is an optional callable, e.g. the wait() of a barrier shared with the CB capture.
+    It is called once auto exposure has converged, and the accepted exposure is then taken
+    again, so the saved TL frame is exposed together with the other cam.
+    """
     imaging_failed_counter = 0
     success = False
     global exposure_time_tl
+    t_start = time.time()
+
+    # Start from the exposure that worked for the previous scene
+    exposure_time_tl = exposure_controller_tl.start(target=max_target, tolerance=tolerance)
+    cam_tl.set_exposure(exposure_time_tl * 1e-3)
 
     while imaging_failed_counter < 15:
+        if exposure_controller_tl.iteration >= max_exposure_iterations_tl:
+            exposure_controller_tl.give_up()
+            break
+
         print(f"TL: Taking {exposure_time_tl}ms exposure with TL cam...")
 
         try:
-            # Capture Image
-            img_tl = cam_tl.snap() - dark_cal[0] if do_dark_subtract_tl and dark_cal is not None else cam_tl.snap()
-            img_tl = np.maximum(img_tl, 0)
-
-            # Convert to multi-channel polarized image
-            img_tl_pol = pa.demosaicing(img_raw=img_tl, code=pa.COLOR_PolarMono)
-            img_tl_pol = np.append(img_tl_pol, [img_tl], axis=0)
-
-            # Crop region (from Camera_GUI.py)
-            y1, y2, x1, x2 = 399, 1059, 1177, 1837
-            img_tl_pol_cropped = img_tl_pol[:, y1:y2, x1:x2]
-
-            # Get max pixel value for Channel 3
-            max_pixel = np.max(img_tl_pol_cropped[0])
-            print(f"Exposure: {exposure_time_tl}ms, Channel 0 Max: {max_pixel}")
-
-            # Adjust step size dynamically
-            step_size = max(1, abs(max_pixel - max_target) // 10)
-
-            # Adjust exposure dynamically
-            if max_target - tolerance <= max_pixel <= max_target:
+            # Defect map of the sensor, its pixels are ignored for metering and replaced before demosaicing
+            defects = defects_tl if do_defect_correct_tl else None
+
+            # Capture raw image
+            with stage_timer.stage("tl_snap"):
+                t_exposure = time.time()
+                img_raw = cam_tl.snap()
+                exposure_windows["tl"] = (t_exposure, time.time())
+            tl_recovery.succeeded()
+
+            # Meter Channel 0 directly on the raw mosaic inside the crop window
+            with stage_timer.stage("tl_meter"):
+                # Saturation is checked on the raw pixels, a clipped pixel reads below 4095 after dark subtraction
+                dark_meter = metering_dark_tl(dark_cal, exposure_time_tl, img_raw.dtype) if do_dark_subtract_tl and dark_cal is not None else None
+                max_pixel, saturated = meter_window(img_raw, crop_tl, dark=dark_meter, angle=0,
+                                                    mask=defects.mask if defects is not None else None,
+                                                    saturation=exposure_controller_tl.saturation)
+            print(f"Exposure: {exposure_time_tl}ms, Channel 0 Max: {max_pixel}{' (saturated)' if saturated else ''}")
+
+            # Jump to the predicted exposure, or stop if in target range
+            success, exposure_time_tl = exposure_controller_tl.update(exposure_time_tl, max_pixel, saturated=saturated)
+            if success:
                 print(f"✅ Optimal exposure found: {exposure_time_tl}ms")
-                success = True
-                break  # Exit loop if within target range
-            elif max_pixel > max_target:
-                exposure_time_tl = max(1, exposure_time_tl - step_size)  # Reduce exposure
-            else:
-                exposure_time_tl = exposure_time_tl + step_size  # Increase exposure
+                break
 
             # Apply new exposure
             cam_tl.set_exposure(exposure_time_tl * 1e-3)
 
-        except:
+        except Exception as e:
             imaging_failed_counter += 1
-            print(f"TL: Imaging failed. Restarting cam. Counter {imaging_failed_counter}")
-            cam_tl.close()
-            cam_tl = setup_thorlabs_cam()
+            print(f"TL: Imaging failed. Counter {imaging_failed_counter}")
+            with stage_timer.stage("tl_recovery"):
+                cam_tl = tl_recovery.recover(e, cam_tl)
+
+    if success and sync is not None:
+        try:
+            sync()
+            with stage_timer.stage("tl_snap"):
+                t_exposure = time.time()
+                img_raw = cam_tl.snap()
+                exposure_windows["tl"] = (t_exposure, time.time())
+            tl_recovery.succeeded()
+        except threading.BrokenBarrierError:
+            print("TL: Sync barrier broken, no synchronized image taken.")
+            success = False
+        except Exception as e:
+            print(f"TL: Synchronized snap failed: {e}")
+            with stage_timer.stage("tl_recovery"):
+                cam_tl = tl_recovery.recover(e, cam_tl)
+            success = False
 
     if success:
+        # Full-sensor dark only for the accepted exposure (the same one unless dark_cal is a dark library)
+        dark_tl = get_dark_corrector(dark_cal, dark_dtype_tl, tl=True, exposure_ms=exposure_time_tl) if do_dark_subtract_tl and dark_cal is not None else None
+
+        # Crop, dark subtract and demosaic only the crop window of the accepted frame
+        img_tl_pol_cropped = tl_processor.process(img_raw, dark=dark_tl, defects=defects)
+
+        with stage_timer.stage("tl_stats"):
+            stats_tl = frame_stats(img_tl_pol_cropped, per_channel=True)
+            stats = stats_tl.combined()
+            # Clipped pixels are counted on the raw window, the dark subtracted stack never reaches saturation_tl
+            y1, y2, x1, x2 = crop_tl
+            stats.saturated = count_saturated(img_raw[y1:y2, x1:x2], saturation_tl,
+                                              mask=defects.mask[y1:y2, x1:x2] if defects is not None else None)
+        print(f"TL: Saving image as TIFF. Shape: {img_tl_pol_cropped.shape}, {stats}, Channel max: {stats_tl.max}")
+
         path = os.path.join(thorlabs_image_folder, f"{img_name}_thorlabs.tif")
-        tifffile.imwrite(path, img_tl_pol_cropped, photometric='minisblack')
-        exposure_time_tl = 255
-        print(f"TL: Saved image as TIFF. Shape: {img_tl_pol_cropped.shape}, Max: {np.max(img_tl_pol_cropped[0])}, Min: {np.min(img_tl_pol_cropped[0])}, Avg: {np.average(img_tl_pol_cropped[3])}, SNR: {snr(img_tl_pol_cropped)}")
+        tl_info = {"path": path, "shape": img_tl_pol_cropped.shape, "dtype": str(img_tl_pol_cropped.dtype),
+                   "exposure_ms": exposure_time_tl, "iterations": exposure_controller_tl.iteration,
+                   "t_start": t_start, "capture_s": time.time() - t_start, **stats.as_dict(),
+                   "crop": crop_tl, "dark_id": dark_tl.id if dark_tl is not None else None}
+
+        def on_saved(error):
+            tl_processor.release(img_tl_pol_cropped)
+            mark_saved(img_name, "tl", error, tl_info)
+
+        send_preview(img_name, "tl", img_tl_pol_cropped[preview_channel_tl])
+        save_frame(img_name, "tl", path, img_tl_pol_cropped, tl_info, on_done=on_saved, compression=tiff_compression_tl)
     else:
         print("TL: No image to save.")
 
@@ -194,74 +426,310 @@ def take_and_save_thorlabs_image(img_name, dark_cal, cam_tl, max_target=4050, to
 
 ## Setup Cubert camera
 def setup_cubert_cam():
-    data_dir = os.getenv("CUVIS") if platform.system() == "Windows" else os.getenv("CUVIS_DATA")
-    factory_dir = os.path.join(data_dir, "factory")
-    userSettingsDir = os.path.join(data_dir, os.pardir, "settings")
-
-    settings = cuvis.General(userSettingsDir)
-    settings.set_log_level("info")
-
-    calibration = cuvis.Calibration(factory_dir)
-    processingContext = cuvis.ProcessingContext(calibration)
-    acquisitionContext = cuvis.AcquisitionContext(calibration)
-
-    saveArgs = cuvis.SaveArgs(export_dir=cubert_image_folder, allow_overwrite=True, allow_session_file=True)
-    cubeExporter = cuvis.CubeExporter(saveArgs)
-
-    while acquisitionContext.state == cuvis.HardwareState.Offline:
-        print(".", end="")
-        time.sleep(1)
-    print("\nCubert camera is online.")
-
-    acquisitionContext.operation_mode = cuvis.OperationMode.Software
-    acquisitionContext.integration_time = exposure_time_cb
-    processingContext.calc_distance(distance_cb)
-
-    return acquisitionContext, processingContext, cubeExporter
+    return camera_backends.open_cubert_cam(camera_backend, exposure_time_cb, distance_cb, cubert_image_folder, **sim_options_cb)
 
 ## Take Cubert image, apply dark calibration, and save as TIFF
-def take_and_save_cubert_image(img_name, dark_cal, acquContext, procContext):
+def take_and_save_cubert_image(img_name, dark_cal, acquContext, procContext, pipelined=None):
+    """
+    With pipelined_cubert only the capture happens here. Processing and saving run on the
+    Cubert worker while the next capture is already being taken, so the return value only
+    says whether the capture succeeded. A measurement that fails the SNR check later is
+    queued for retry_failed_cubert(). pipelined overrides pipelined_cubert.
+    """
+    if pipelined is None:
+        pipelined = pipelined_cubert
     imaging_failed_counter = 0
-    saved = False
+    t_start = time.time()
 
     while imaging_failed_counter < 15:
-        time.sleep(0.5)
-        print(f"CB: Taking {exposure_time_cb}ms exposure with CB cam...")
-        try:
-            am = acquContext.capture()
-            mesu, res = am.get(timedelta(milliseconds=3000))
-        except:
-            mesu = None
+        mesu = capture_cubert_measurement(img_name, acquContext)
+        if mesu is None:
             imaging_failed_counter += 1
             print(f"CB: Imaging failed. Counter: {imaging_failed_counter}")
+            continue
 
-        if mesu is not None:
-            mesu.set_name(f"{img_name}_cubert")
-            procContext.apply(mesu)
-            data_array = np.array(mesu.data['cube'].array)
-            data_array = data_array.transpose(2, 0, 1)
-            if do_dark_subtract_cb and dark_cal is not None:
-                data_array = np.maximum(data_array.astype(float) - dark_cal.astype(float), 0)
-            if snr(data_array) > 0.05:
-                path = os.path.join(cubert_image_folder, f"{img_name}_cubert.tif")
-                # Crop region for Cubert image
-                y1, y2 = 75, 195
-                x1, x2 = 116, 236
-                data_array_cropped = data_array[:, y1:y2, x1:x2]  # Crop spatial dimensions
-                tifffile.imwrite(path, data_array_cropped, photometric='minisblack')
-                print(f"CB: Saved image as TIFF. Shape: {data_array_cropped.shape}, Max: {np.max(data_array_cropped)}, Min: {np.min(data_array_cropped)}, Avg: {np.average(data_array_cropped)}, SNR: {snr(data_array_cropped)}")
-                saved = True
-                break
-            else:
-                imaging_failed_counter += 1
-                print(f"CB: Image saving failed. Counter: {imaging_failed_counter}")
-        else:
-            imaging_failed_counter += 1
-            print(f"CB: Image saving failed. Counter: {imaging_failed_counter}")
+        if pipelined:
+            submit_cubert_processing(img_name, mesu, dark_cal, procContext, t_start, imaging_failed_counter + 1)
+            return True
+
+        if process_and_save_cubert(img_name, mesu, dark_cal, procContext, t_start, imaging_failed_counter + 1):
+            return True
+        imaging_failed_counter += 1
+        print(f"CB: Image saving failed. Counter: {imaging_failed_counter}")
+
+    return False
 
+## Capture one Cubert measurement, None if the capture failed or timed out
+def capture_cubert_measurement(img_name, acquContext):
+    # Timeout follows the integration time instead of a fixed value
+    timeout_ms = cubert_timeout_ms(exposure_time_cb)
+    print(f"CB: Taking {exposure_time_cb}ms exposure with CB cam...")
+    try:
+        with stage_timer.stage("cb_capture"):
+            t_exposure = time.time()
+            am = acquContext.capture()
+            mesu, res = am.get(timedelta(milliseconds=timeout_ms))
+            exposure_windows["cb"] = (t_exposure, time.time())
+        if mesu is None:
+            raise TimeoutError(f"no measurement after {timeout_ms:.0f}ms ({res})")
+    except Exception as e:
+        print(f"CB: Capture failed: {e}")
+        # Waits with backoff, and for the cam to come back online after a disconnect
+        with stage_timer.stage("cb_recovery"):
+            cb_recovery.recover(e, acquContext)
+        return None
+
+    cb_recovery.succeeded()
+    mesu.set_name(f"{img_name}_cubert")
+    return mesu
+
+## Capture timeout of a Cubert measurement
+def cubert_timeout_ms(integration_ms):
+    return max(cubert_min_timeout_ms, integration_ms * cubert_timeout_factor + cubert_timeout_overhead_ms)
+
+## Process a Cubert measurement, apply dark calibration and save it if the SNR check passes
+def process_and_save_cubert(img_name, mesu, dark_cal, procContext, t_start, attempts):
+    with stage_timer.stage("cb_process"):
+        procContext.apply(mesu)
+    # Crop region for Cubert image
+    y1, y2 = 75, 195
+    x1, x2 = 116, 236
+    with stage_timer.stage("cb_dark_subtract"):
+        cube = np.asarray(mesu.data['cube'].array).transpose(2, 0, 1)
+        # Clipped pixels are counted on the raw counts, before dark subtraction
+        n_saturated = count_saturated(cube[:, y1:y2, x1:x2], saturation_cb) if saturation_cb is not None else None
+        corrector = None
+        if do_dark_subtract_cb and dark_cal is not None:
+            # Saturating subtract straight from the cuvis buffer into a pooled float32 array
+            corrector = get_dark_corrector(dark_cal, dark_dtype_cb, exposure_ms=exposure_time_cb)
+            data_array = corrector.apply(cube, out=buffer_pool.acquire(cube.shape, corrector.output_dtype(cube)))
+        else:
+            data_array = buffer_pool.acquire(cube.shape, cube.dtype)
+            np.copyto(data_array, cube)
+    with stage_timer.stage("cb_snr"):
+        snr_ok = frame_stats(data_array).snr > min_snr_cb
+    if not snr_ok:
+        buffer_pool.release(data_array)
+        return False
+
+    path = os.path.join(cubert_image_folder, f"{img_name}_cubert.tif")
+    # Crop region copied into its own buffer (in save_dtype_cb) so the full cube can be reused right away
+    save_dtype = data_array.dtype if save_dtype_cb is None else np.dtype(save_dtype_cb)
+    data_array_cropped = buffer_pool.acquire((data_array.shape[0], y2 - y1, x2 - x1), save_dtype)
+    np.copyto(data_array_cropped, data_array[:, y1:y2, x1:x2])
+    buffer_pool.release(data_array)
+    with stage_timer.stage("cb_stats"):
+        stats = frame_stats(data_array_cropped)
+        stats.saturated = n_saturated
+    print(f"CB: Saving image as TIFF. Shape: {data_array_cropped.shape}, {stats}")
+    cb_info = {"path": path, "shape": data_array_cropped.shape, "dtype": str(data_array_cropped.dtype),
+               "exposure_ms": exposure_time_cb, "attempts": attempts,
+               "t_start": t_start, "capture_s": time.time() - t_start, **stats.as_dict(),
+               "crop": (y1, y2, x1, x2), "dark_id": corrector.id if corrector is not None else None}
+
+    def on_saved(error):
+        buffer_pool.release(data_array_cropped)
+        mark_saved(img_name, "cb", error, cb_info)
+
+    send_preview(img_name, "cb", data_array_cropped[preview_channel_cb])
+    save_frame(img_name, "cb", path, data_array_cropped, cb_info, on_done=on_saved, compression=tiff_compression_cb)
+    return True
+
+## Hand a captured measurement to the Cubert worker
+def submit_cubert_processing(img_name, mesu, dark_cal, procContext, t_start, attempts):
+    global cubert_worker
+    if cubert_worker is None:
+        cubert_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cb_processing")
+
+    # Wait for the oldest measurement if processing falls behind
+    while len(_cubert_pending) >= max_cubert_pending:
+        _cubert_pending.pop(0).result()
+
+    _cubert_pending.append(cubert_worker.submit(_process_cubert_job, img_name, mesu, dark_cal, procContext, t_start, attempts))
+
+def _process_cubert_job(img_name, mesu, dark_cal, procContext, t_start, attempts):
+    try:
+        saved = process_and_save_cubert(img_name, mesu, dark_cal, procContext, t_start, attempts)
+    except Exception as e:
+        print(f"CB: Processing {img_name} failed: {e}")
+        saved = False
+    if not saved:
+        print(f"CB: {img_name} failed the SNR check after capture, queued for re-capture.")
+        with _pending_lock:
+            _cubert_retry.append(img_name)
     return saved
 
-def setup_pygame_display(X, Y, img_size_x, img_size_y, img_path):
+## Re-capture the Cubert images that failed the SNR check on the Cubert worker
+def retry_failed_cubert(dark_cal, acquContext, procContext, show=None, wait=False):
+    """
+    Without the pipeline a cube that fails the SNR check is re-captured right away. With
+    pipelined_cubert the check runs while the next scene is already being captured, so
+    the failed images are re-captured here, without the pipeline and with the usual retries.
+
+    Parameters:
+        show (callable): Optional show(img_name) that puts the scene back on screen. If it
+            returns False the re-capture is skipped and the pair is dropped.
+        wait (bool): First wait for the measurements still on the Cubert worker.
+
+    Returns:
+        Number of pairs that had counted as complete and are now dropped. Pairs already
+        dropped with discard_pair() are skipped and not counted.
+    """
+    if wait:
+        wait_for_cubert_pipeline()
+    with _pending_lock:
+        names = [name for name in _cubert_retry if name not in _discarded_pairs]
+        del _cubert_retry[:]
+
+    failed = 0
+    for img_name in names:
+        if show is not None and not show(img_name):
+            print(f"CB: Re-capture of {img_name} skipped, pair is not recorded.")
+        else:
+            print(f"CB: Re-capturing {img_name} after the failed SNR check.")
+            if take_and_save_cubert_image(img_name, dark_cal, acquContext, procContext, pipelined=False):
+                continue
+            print(f"CB: Re-capture of {img_name} failed, pair is not recorded.")
+        discard_pair(img_name)
+        failed += 1
+    return failed
+
+## Block until all captured Cubert measurements are processed and handed to the writer
+def wait_for_cubert_pipeline():
+    while _cubert_pending:
+        _cubert_pending.pop(0).result()
+
+## Block until every captured image is on disk
+def wait_for_saves():
+    wait_for_cubert_pipeline()
+    if frame_writer is not None:
+        frame_writer.flush()
+    if store_writer is not None:
+        store_writer.flush()
+
+## Take Thorlabs and Cubert images at the same time on worker threads
+def take_and_save_pair(img_name, dark_cal_tl, dark_cal_cb, cam_tl, acquContext, procContext, barrier_timeout=30):
+    """
+    Runs take_and_save_thorlabs_image and take_and_save_cubert_image concurrently.
+
+    The TL worker runs auto exposure first. Once it has converged, both workers meet at a
+    barrier and the final TL frame and the CB measurement are exposed at the same time.
+    If TL auto exposure fails the barrier is broken and no CB measurement is taken.
+    Start/end timestamps of each capture and of the exposure of each saved frame are
+    appended to pair_log and pair_log_path, and pairs whose exposures do not overlap are
+    reported.
+
+    Returns:
+        (tl_success, cb_success, cam_tl)
+    """
+    barrier = threading.Barrier(2, timeout=barrier_timeout)
+    results = {"tl": (False, cam_tl), "cb": False}
+    times = {}
+    exposure_windows.pop("tl", None)
+    exposure_windows.pop("cb", None)
+    synced = threading.Event()
+
+    def sync_tl():
+        synced.set()
+        barrier.wait()
+
+    def worker(key, capture_fn, **kwargs):
+        times[f"{key}_start"] = time.time()
+        try:
+            # CB waits for the end of TL auto exposure, TL calls barrier.wait itself through sync
+            if key == "cb":
+                barrier.wait()
+            results[key] = capture_fn(**kwargs)
+        except threading.BrokenBarrierError:
+            print(f"{key.upper()}: Sync barrier broken, no image taken.")
+        except Exception as e:
+            print(f"{key.upper()}: Capture worker failed: {e}")
+        finally:
+            # Releases CB if TL gave up before reaching the barrier
+            if key == "tl" and not synced.is_set():
+                barrier.abort()
+            times[f"{key}_end"] = time.time()
+
+    workers = [
+        threading.Thread(target=worker, args=("tl", take_and_save_thorlabs_image),
+                         kwargs=dict(img_name=img_name, dark_cal=dark_cal_tl, cam_tl=cam_tl, sync=sync_tl), name="tl_capture"),
+        threading.Thread(target=worker, args=("cb", take_and_save_cubert_image),
+                         kwargs=dict(img_name=img_name, dark_cal=dark_cal_cb, acquContext=acquContext, procContext=procContext), name="cb_capture"),
+    ]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    tl_success, cam_tl = results["tl"]
+    cb_success = results["cb"]
+    if tl_success != cb_success:
+        print(f"Pair {img_name} incomplete. TL: {tl_success}, CB: {cb_success}")
+
+    record_pair(img_name, tl_success, cb_success, times, exposures={camera: exposure_windows.get(camera) for camera in ("tl", "cb")})
+    return tl_success, cb_success, cam_tl
+
+## Record per-pair timestamps and exposure overlap
+def record_pair(img_name, tl_success, cb_success, times, exposures):
+    """
+    times holds the start/end of both capture calls (auto exposure, retries and saving
+    included), exposures the (start, end) of the exposure of each saved frame or None.
+    The overlap is that of the two exposures, 0 if a camera has no frame.
+    """
+    tl_exposure, cb_exposure = exposures["tl"] or (None, None), exposures["cb"] or (None, None)
+    overlap = 0.0
+    if tl_exposure[0] is not None and cb_exposure[0] is not None:
+        overlap = max(0.0, min(tl_exposure[1], cb_exposure[1]) - max(tl_exposure[0], cb_exposure[0]))
+    entry = {
+        "name": img_name,
+        "tl_success": tl_success,
+        "cb_success": cb_success,
+        "tl_start": times["tl_start"],
+        "tl_end": times["tl_end"],
+        "cb_start": times["cb_start"],
+        "cb_end": times["cb_end"],
+        "tl_exposure_start": tl_exposure[0],
+        "tl_exposure_end": tl_exposure[1],
+        "cb_exposure_start": cb_exposure[0],
+        "cb_exposure_end": cb_exposure[1],
+        "overlap_s": overlap,
+    }
+    pair_log.append(entry)
+    _pair_totals["pairs"] += 1
+    _pair_totals["complete"] += bool(tl_success and cb_success)
+    _pair_totals["overlap_s"] += overlap
+    if _pair_totals["start"] is None:
+        _pair_totals["start"] = min(times["tl_start"], times["cb_start"])
+    _pair_totals["end"] = max(times["tl_end"], times["cb_end"])
+    print(f"Pair {img_name}: TL {times['tl_end'] - times['tl_start']:.2f}s, CB {times['cb_end'] - times['cb_start']:.2f}s, exposure overlap {overlap:.2f}s")
+    if tl_success and cb_success and overlap == 0:
+        print(f"⚠️ Pair {img_name}: TL and CB exposures did not overlap.")
+
+    if pair_log_path:
+        new_file = not os.path.exists(pair_log_path)
+        with open(pair_log_path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(entry.keys()))
+            if new_file:
+                writer.writeheader()
+            writer.writerow(entry)
+
+## Print pairs/hour over all recorded pairs
+def print_pair_summary():
+    n_pairs = _pair_totals["pairs"]
+    if not n_pairs:
+        return
+    n_complete = _pair_totals["complete"]
+    duration = _pair_totals["end"] - _pair_totals["start"]
+    avg_overlap = _pair_totals["overlap_s"] / n_pairs
+    pairs_per_hour = n_complete / duration * 3600 if duration > 0 else 0
+    print(f"Pairs: {n_complete}/{n_pairs} complete, {pairs_per_hour:.1f} pairs/hour, avg. exposure overlap {avg_overlap:.2f}s")
+
+## Forget the recorded pairs, e.g. before a new run in the same process
+def reset_pair_log():
+    pair_log.clear()
+    _pair_totals.update(pairs=0, complete=0, overlap_s=0.0, start=None, end=None)
+
+def setup_pygame_display(X, Y, img_size_x, img_size_y, img_path, skip=None):
     # Pygame and display setup
     pygame.init()
     try:
@@ -270,21 +738,9 @@ def setup_pygame_display(X, Y, img_size_x, img_size_y, img_path):
         print("No second monitor available, using main monitor.")
         scrn = pygame.display.set_mode((X, Y), pygame.FULLSCREEN)
 
-    def transformScaleKeepRatio(image, size):
-        iwidth, iheight = image.get_size()
-        scale = min(size[0] / iwidth, size[1] / iheight)
-        new_size = (round(iwidth * scale), round(iheight * scale))
-        scaled_image = pygame.transform.scale(image, new_size)
-        image_rect = scaled_image.get_rect(center = (size[0] // 2, size[1] // 2))
-        return scaled_image, image_rect
-
-    # Load images
-    images = []
-    filenames = sorted([f for f in os.listdir(img_path) if f.endswith('.jpg') | f.endswith('.png')], reverse=False)
-    print("Filenames:", filenames)
-    for name in filenames:
-        img = pygame.image.load(os.path.join(img_path, name))
-        images.append((*transformScaleKeepRatio(img, (img_size_x, img_size_y)), name))
+    # Images are decoded and scaled lazily on a background thread, see display_loader
+    images = DisplayImageLoader(img_path, (img_size_x, img_size_y), prefetch=display_prefetch, cache_dir=display_cache_dir, skip=skip)
+    print(f"Found {len(images)} display images" + (f", skipping {len(skip)} already captured." if skip else "."))
 
     return scrn, images
 
@@ -295,9 +751,211 @@ def display_image(img_disp, scrn):
     scrn.blit(img_data, img_center) # image data, image center
     pygame.display.flip()
     pygame.display.set_caption(img_name) # image name
+    if camera_backend == "simulated":
+        camera_backends.show_scene(img_name)
     print(f"\nShowing image {img_name} on display.")
     return img_name
 
+## Open the session manifest, resuming the journal of an earlier run at the same path
+def open_session_manifest(path=None):
+    global session_manifest
+    close_session_manifest()
+    path = path or session_manifest_path
+    session_manifest = SessionManifest(path)
+    if len(session_manifest):
+        print(f"Session manifest: {len(session_manifest)} pairs already captured, resuming.")
+    return session_manifest
+
+def close_session_manifest():
+    global session_manifest
+    # Pairs with only one image on disk cannot complete any more, log and drop them
+    with _pending_lock:
+        incomplete = list(_pending_pairs.items())
+        _pending_pairs.clear()
+    for img_name, pair in incomplete:
+        saved = [camera.upper() for camera in ("tl", "cb") if camera in pair]
+        print(f"Pair {img_name} incomplete at the end of the session (saved: {', '.join(saved) or 'none'}), not recorded.")
+    if session_manifest is not None:
+        session_manifest.close()
+    session_manifest = None
+
+## Record a saved frame in the frame catalog, opened on first use so every save path is indexed
+def record_frame(img_name, camera, info):
+    global frame_catalog
+    if not use_frame_catalog:
+        return
+    try:
+        with _catalog_lock:
+            if frame_catalog is None:
+                frame_catalog = FrameCatalog(frame_catalog_path)
+            catalog = frame_catalog
+        catalog.record(img_name, camera, **info)
+    except Exception as e:
+        print(f"{camera.upper()}: Cataloging {img_name} failed: {e}")
+
+## Close the frame catalog, the next saved frame reopens it (e.g. at a new frame_catalog_path)
+def close_frame_catalog():
+    global frame_catalog
+    with _catalog_lock:
+        if frame_catalog is not None:
+            frame_catalog.close()
+        frame_catalog = None
+
+## Record a frame in the frame catalog, and its pair in the session manifest once both images are on disk
+def mark_saved(img_name, camera, error, info):
+    if error is not None:
+        print(f"{camera.upper()}: Saving {img_name} failed, pair is not recorded: {error}")
+    else:
+        record_frame(img_name, camera, info)
+    if session_manifest is None:
+        return
+    with _pending_lock:
+        pair = _pending_pairs.setdefault(img_name, {"failed": False})
+        pair[camera] = info
+        pair["failed"] |= error is not None
+        if "tl" not in pair or "cb" not in pair:
+            return
+        del _pending_pairs[img_name]
+    if not pair["failed"]:
+        session_manifest.record(img_name, tl=pair["tl"], cb=pair["cb"])
+
+## Load a master dark (.npy) or an exposure-indexed dark library (.npz, see dark_library)
+def load_dark(path):
+    return DarkLibrary.load(path) if path.endswith(".npz") else np.load(path)
+
+## Load the TL defect map used by take_and_save_thorlabs_image, None if there is none
+def load_defect_map(path=None):
+    global defects_tl
+    path = path or path_defects_tl
+    defects_tl = None
+    if not do_defect_correct_tl:
+        return None
+    if os.path.exists(path):
+        defects_tl = DefectMap.load(path)
+        print(f"TL: {defects_tl.summary()}")
+    else:
+        print(f"TL: No defect map at {path}, capture darks to create one.")
+    return defects_tl
+
+## Dark for metering the TL crop window, of a dark library only the window is evaluated
+def metering_dark_tl(dark_cal, exposure_ms, dtype):
+    """
+    Auto exposure meters at a new exposure on every iteration, so a full-sensor dark per
+    iteration would cost far more than the metering itself. Returns the dark of only
+    crop_tl for a dark library, the cached full-sensor dark for a single master dark.
+    """
+    if isinstance(dark_cal, DarkLibrary):
+        return dark_cal.window_dark(exposure_ms, crop_tl, dtype)
+    return get_dark_corrector(dark_cal, dark_dtype_tl, tl=True).dark(dtype)
+
+## Dark corrector for a master dark, converted to the working dtype only once
+def get_dark_corrector(dark_cal, dtype, tl=False, exposure_ms=None):
+    # A dark library gives the dark for the exposure of the frame
+    if isinstance(dark_cal, DarkLibrary):
+        return dark_cal.corrector(exposure_ms, dtype)
+    with _dark_lock:
+        for cal, dt, corrector in _dark_correctors:
+            if cal is dark_cal and dt == dtype:
+                return corrector
+        # TL master darks are raw frames, or (channel, y, x) stacks whose channel 0 is subtracted from the raw frame
+        corrector = DarkCorrector(dark_cal[0] if tl and dark_cal.ndim == 3 else dark_cal, dtype=dtype)
+        _dark_correctors.append((dark_cal, dtype, corrector))
+        del _dark_correctors[:-4]
+        return corrector
+
+## Capture master darks of both cams at the same time, with the lenses covered
+def capture_darks(cam_tl, acquContext, procContext, should_stop=None, on_progress=None):
+    """
+    dark_capture.capture_darks with the dark_* settings of this module. The new TL defect
+    map is used from the next frame on.
+
+    on_progress(camera, exposure_ms, frame, n_frames) is called after every frame.
+
+    Returns:
+        (paths, cam_tl): {"tl": path, "cb": path} of the new darks for load_dark (None if
+        a cam failed or the capture was cancelled), plus "defects_tl", the TL defect map
+        built from them, and the (possibly re-opened) TL cam.
+    """
+    global defects_tl
+    paths, cam_tl, defects = dark_capture.capture_darks(
+        cam_tl, acquContext, procContext, dark_folder, dark_exposures_tl, dark_exposures_cb, dark_frames_tl, dark_frames_cb,
+        name_tl=dark_name_tl, name_cb=dark_name_cb, defect_name_tl=defect_name_tl, timeout_ms_cb=cubert_timeout_ms,
+        tl_recovery=tl_recovery, cb_recovery=cb_recovery, should_stop=should_stop, on_progress=on_progress)
+    if defects is not None:
+        defects_tl = defects
+    return paths, cam_tl
+
+## Start the background TIFF writer, or the dataset store writer
+def start_frame_writer():
+    global frame_writer, store_writer
+    if dataset_store is not None:
+        if store_writer is None:
+            store = PairedStore(dataset_store_path, backend=dataset_store)
+            if len(store):
+                print(f"Store: {len(store)} pairs already in {dataset_store_path}.")
+            store_writer = PairedStoreWriter(store, timer=stage_timer)
+        return store_writer
+    # Reject TIFF codecs that cannot be written here before the first frame is lost to them
+    for compression in (tiff_compression_tl, tiff_compression_cb):
+        tiff_options(compression, predictor=tiff_predictor, level=tiff_compression_level)
+    if async_write and frame_writer is None:
+        frame_writer = FrameWriter(max_in_flight=max_frames_in_flight, num_workers=writer_threads, timer=stage_timer)
+    return frame_writer
+
+## Flush outstanding writes, stop the writer and return failed writes
+def stop_frame_writer():
+    global frame_writer, store_writer
+    errors = frame_writer.close() if frame_writer is not None else []
+    frame_writer = None
+    if store_writer is not None:
+        errors += store_writer.close()
+        store_writer = None
+    close_frame_catalog()
+    return errors
+
+## Save one image of a pair, into the dataset store if it is open and as TIFF otherwise
+def save_frame(img_name, camera, path, data, info, on_done=None, compression=None):
+    if store_writer is not None:
+        with stage_timer.stage("write_submit"):
+            store_writer.submit(img_name, camera, data, info, on_done=on_done)
+        return
+    save_tiff(path, data, on_done=on_done, compression=compression)
+
+## Hand a decimated copy of a frame to the preview callback, the frame itself may go back to the buffer pool
+def send_preview(img_name, camera, img):
+    if preview_callback is None:
+        return
+    try:
+        with stage_timer.stage("preview"):
+            preview_callback(img_name, camera, decimate(img, preview_size))
+    except Exception as e:
+        print(f"{camera.upper()}: Preview of {img_name} failed: {e}")
+
+## Drop the held image of a pair whose other image failed
+def discard_pair(img_name):
+    with _pending_lock:
+        _discarded_pairs.add(img_name)
+    if store_writer is not None:
+        store_writer.discard(img_name)
+
+## Save TIFF, in the background if the frame writer is running
+def save_tiff(path, data, on_done=None, compression=None):
+    options = tiff_options(compression, predictor=tiff_predictor, level=tiff_compression_level, dtype=data.dtype)
+    if frame_writer is not None:
+        with stage_timer.stage("write_submit"):
+            frame_writer.submit(path, data, on_done=on_done, **options)
+        return
+
+    error = None
+    try:
+        with stage_timer.stage("write"):
+            tifffile.imwrite(path, data, **options)
+    except Exception as e:
+        error = e
+        print(f"Failed to write {path}: {e}")
+    if on_done is not None:
+        on_done(error)
+
 ## Calculate SNR
 def snr(img, axis=None, ddof=0):
     img = np.asanyarray(img)
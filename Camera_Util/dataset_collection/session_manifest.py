@@ -0,0 +1,69 @@
+import os
+import json
+import time
+import threading
+
+
+class SessionManifest:
+    """
+    Append-only journal of the TL/CB pairs of a dataset session that are safely on disk.
+
+    Every record is one JSON line that is flushed and fsync'ed before record() returns,
+    so after a crash the manifest lists exactly the pairs that were completed. A torn
+    last line from a crash during the write is ignored when the manifest is reopened.
+
+    Parameters:
+        path (str): Path of the .jsonl manifest, created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries = {}
+
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry["name"]] = entry
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+        # Terminate a torn last line, so the next record starts on its own line
+        if self._file.tell() > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b"\n"
+            if torn:
+                self._file.write("\n")
+                self._file.flush()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def is_done(self, name):
+        return name in self.entries
+
+    def completed_names(self):
+        return set(self.entries)
+
+    def record(self, name, **fields):
+        """Append a completed pair and make sure it is on disk."""
+        entry = {"name": name, "t_recorded": time.time(), **fields}
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.entries[name] = entry
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
@@ -0,0 +1,178 @@
+import os
+import numpy as np
+from polar_processing import POLAR_LATTICE
+
+
+## Offsets (dy, dx) of the same-polarizer pixels on the square ring at distance r (r even)
+def _lattice_ring(r):
+    return np.array([(dy, dx) for dy in range(-r, r + 1, 2) for dx in range(-r, r + 1, 2)
+                     if max(abs(dy), abs(dx)) == r])
+
+
+## Robust (median, std) of a sub-lattice, std from the median absolute deviation
+def _robust_stats(values):
+    median = np.median(values)
+    return median, 1.4826 * np.median(np.abs(values - median))
+
+
+class DefectMap:
+    """
+    Hot, noisy and stuck pixels of the Thorlabs polarization mosaic, and their correction.
+
+    Neighbouring mosaic pixels sit behind different polarizers, so a defect is replaced by
+    the mean of the good pixels of its own polarizer angle: the 8 pixels 2 pixels away in
+    the 2x2 superpixel lattice, or the 16 pixels 4 pixels away if all of those are defects
+    too. Left in the frame, a hot pixel is spread into all four channels by demosaicing.
+
+    Neighbour indices and weights are computed once per frame window and cached, so
+    correct() is a gather, a weighted sum and a scatter over the defects only, with no
+    pass over the frame.
+
+    Parameters:
+        shape (tuple): Sensor shape (height, width).
+        hot, noisy, stuck (ndarray): Flat sensor indices of each defect class.
+    """
+
+    def __init__(self, shape, hot=(), noisy=(), stuck=()):
+        self.shape = tuple(int(s) for s in shape)
+        self.hot = np.asarray(hot, dtype=np.int64)
+        self.noisy = np.asarray(noisy, dtype=np.int64)
+        self.stuck = np.asarray(stuck, dtype=np.int64)
+        self.indices = np.unique(np.concatenate([self.hot, self.noisy, self.stuck]))
+        self._mask = None
+        self._kernels = {}  # window -> (targets, sources, weights)
+
+    @classmethod
+    def from_dark(cls, master_dark, noise=None, hot_sigma=8.0, noise_factor=5.0, stuck_factor=0.1, min_std=0.5):
+        """
+        Finds the defects of a raw master dark and its noise map (see dark_averaging).
+
+        Every polarizer sub-lattice is compared with its own median:
+            hot:   dark level more than hot_sigma robust std (from the MAD) above the median
+            noisy: temporal noise above noise_factor times the median noise
+            stuck: temporal noise below stuck_factor times the median noise, a pixel that
+                   does not fluctuate over the dark frames is dead or stuck
+
+        Parameters:
+            master_dark (ndarray): Raw (height, width) master dark, at the longest exposure
+                that is used, where hot pixels stand out most.
+            noise (ndarray): Optional per-pixel noise map, needed for noisy and stuck pixels.
+            hot_sigma (float): Hot pixel threshold in robust std.
+            noise_factor (float): Noisy pixel threshold relative to the median noise.
+            stuck_factor (float): Stuck pixel threshold relative to the median noise.
+            min_std (float): Lower limit of the robust std in counts, for very flat darks.
+        """
+        dark = np.asarray(master_dark, dtype=np.float32)
+        if dark.ndim != 2:
+            raise ValueError(f"Defect map needs a raw (height, width) master dark, got shape {dark.shape}.")
+        hot = np.zeros(dark.shape, dtype=bool)
+        noisy = np.zeros(dark.shape, dtype=bool)
+        stuck = np.zeros(dark.shape, dtype=bool)
+
+        for oy, ox in POLAR_LATTICE.values():
+            sub = dark[oy::2, ox::2]
+            median, std = _robust_stats(sub)
+            hot[oy::2, ox::2] = sub > median + hot_sigma * max(std, min_std)
+            if noise is None:
+                continue
+            sub_noise = np.asarray(noise, dtype=np.float32)[oy::2, ox::2]
+            median_noise = np.median(sub_noise)
+            if median_noise > 0:
+                noisy[oy::2, ox::2] = sub_noise > noise_factor * median_noise
+                stuck[oy::2, ox::2] = sub_noise < stuck_factor * median_noise
+
+        return cls(dark.shape, np.flatnonzero(hot), np.flatnonzero(noisy & ~hot), np.flatnonzero(stuck))
+
+    @classmethod
+    def from_files(cls, dark_path, **kwargs):
+        """from_dark() of a master dark .npy, with its <name>_noise.npy if it exists."""
+        noise_path = os.path.splitext(dark_path)[0] + "_noise.npy"
+        noise = np.load(noise_path) if os.path.exists(noise_path) else None
+        return cls.from_dark(np.load(dark_path), noise, **kwargs)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f["shape"], f["hot"], f["noisy"], f["stuck"])
+
+    def save(self, path):
+        np.savez(path, shape=np.asarray(self.shape), hot=self.hot, noisy=self.noisy, stuck=self.stuck)
+
+    def __len__(self):
+        return len(self.indices)
+
+    @property
+    def mask(self):
+        """Boolean sensor mask of all defects, cached."""
+        if self._mask is None:
+            mask = np.zeros(self.shape, dtype=bool)
+            mask.flat[self.indices] = True
+            self._mask = mask
+        return self._mask
+
+    def summary(self):
+        return (f"Defect map: {len(self)} pixels ({len(self.hot)} hot, {len(self.noisy)} noisy, "
+                f"{len(self.stuck)} stuck), {len(self) / (self.shape[0] * self.shape[1]):.4%} of the sensor")
+
+    def correct(self, frame, window=None):
+        """
+        Replaces the defects of a raw frame in place and returns it.
+
+        Parameters:
+            frame (ndarray): C-contiguous raw mosaic of the full sensor or of window.
+            window (tuple): (y1, y2, x1, x2) of the sensor covered by frame, the full sensor by default.
+        """
+        if window is None:
+            window = (0, self.shape[0], 0, self.shape[1])
+        window = tuple(int(v) for v in window)
+        if frame.shape != (window[1] - window[0], window[3] - window[2]):
+            raise ValueError(f"Frame shape {frame.shape} does not match window {window}.")
+        if not frame.flags.c_contiguous:
+            raise ValueError("Defect correction needs a C-contiguous frame.")
+
+        targets, sources, weights = self._kernel(window)
+        if len(targets) == 0:
+            return frame
+        flat = frame.reshape(-1)
+        values = np.einsum("ij,ij->i", flat[sources], weights)
+        if np.issubdtype(frame.dtype, np.integer):
+            np.rint(values, out=values)
+        flat[targets] = values
+        return frame
+
+    def _kernel(self, window):
+        kernel = self._kernels.get(window)
+        if kernel is None:
+            kernel = self._build_kernel(window)
+            self._kernels[window] = kernel
+        return kernel
+
+    def _build_kernel(self, window):
+        y1, y2, x1, x2 = window
+        height, width = y2 - y1, x2 - x1
+        ys, xs = np.unravel_index(self.indices, self.shape)
+        inside = (ys >= y1) & (ys < y2) & (xs >= x1) & (xs < x2)
+        ys, xs = ys[inside] - y1, xs[inside] - x1
+        mask = self.mask[y1:y2, x1:x2]
+
+        # Same-polarizer neighbours inside the window that are not defects themselves
+        sources, valid = [], []
+        for r in (2, 4):
+            ring = _lattice_ring(r)
+            ny = ys[:, None] + ring[:, 0]
+            nx = xs[:, None] + ring[:, 1]
+            ok = (ny >= 0) & (ny < height) & (nx >= 0) & (nx < width)
+            ny, nx = np.clip(ny, 0, height - 1), np.clip(nx, 0, width - 1)
+            ok &= ~mask[ny, nx]
+            sources.append(ny * width + nx)
+            valid.append(ok)
+        # The outer ring only for defects without a good pixel in the inner one
+        valid[1] &= ~valid[0].any(axis=1, keepdims=True)
+        sources = np.concatenate(sources, axis=1)
+        valid = np.concatenate(valid, axis=1)
+
+        # Defects without any good neighbour are left as they are
+        count = valid.sum(axis=1)
+        keep = count > 0
+        weights = (valid[keep] / count[keep, None]).astype(np.float32)
+        return ys[keep] * width + xs[keep], sources[keep], weights
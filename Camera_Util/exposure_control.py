@@ -0,0 +1,122 @@
+class ExposureController:
+    """
+    Auto-exposure solver that jumps to the exposure time predicted by a linear sensor model.
+
+    The metered statistic (e.g. the max pixel of a channel) is modelled as
+    stat = offset + gain * exposure. After the first frame the gain is estimated through
+    the origin (dark-subtracted data), after two unsaturated frames offset and gain are fit
+    through the two latest samples. Saturated frames carry no usable slope, so the solver
+    bisects between the brightest unsaturated and the darkest saturated exposure instead.
+    The converged exposure of one scene is the starting point for the next one.
+
+    Parameters:
+        target (float): Upper end of the accepted statistic range.
+        tolerance (float): Width of the accepted range below target.
+        saturation (float): Statistic at or above which a frame counts as saturated.
+        min_exposure (float): Shortest allowed exposure in ms.
+        max_exposure (float): Longest allowed exposure in ms.
+        initial_exposure (float): Exposure in ms used for the very first scene.
+    """
+
+    def __init__(self, target=4050, tolerance=100, saturation=4095, min_exposure=1, max_exposure=10000, initial_exposure=255):
+        self.target = target
+        self.tolerance = tolerance
+        self.saturation = saturation
+        self.min_exposure = min_exposure
+        self.max_exposure = max_exposure
+        self.exposure = initial_exposure
+
+        self.iterations = []  # iterations-to-converge of every converged scene
+        self.failed_scenes = 0
+        self.iteration = 0
+        self._samples = []
+        self._lo = None
+        self._hi = None
+
+    def start(self, target=None, tolerance=None):
+        """Begin a new scene and return the exposure for its first frame (warm start)."""
+        if target is not None:
+            self.target = target
+        if tolerance is not None:
+            self.tolerance = tolerance
+        self.iteration = 0
+        self._samples = []
+        self._lo = None  # longest exposure known to be below the target range
+        self._hi = None  # shortest exposure known to be above the target range
+        return self.exposure
+
+    def update(self, exposure, stat, saturated=None):
+        """
+        Feed the statistic measured at exposure.
+
+        saturated says whether the frame clipped. It defaults to stat >= saturation, which
+        only works for a statistic on raw data: after dark subtraction a clipped pixel
+        reads saturation minus its dark level, so callers metering dark-subtracted data
+        pass the flag from the raw frame (see polar_processing.meter_window). A saturated
+        frame is never accepted and gives no model sample.
+
+        Returns:
+            (converged, next_exposure): converged is True if stat is inside the target
+            range, in which case next_exposure is the accepted exposure.
+        """
+        self.iteration += 1
+        stat = float(stat)
+        if saturated is None:
+            saturated = stat >= self.saturation
+
+        if not saturated and self.target - self.tolerance <= stat <= self.target:
+            self.exposure = exposure
+            self.iterations.append(self.iteration)
+            print(f"AE: Converged to {exposure}ms in {self.iteration} iteration(s).")
+            return True, exposure
+
+        if saturated or stat > self.target:
+            self._hi = exposure if self._hi is None else min(self._hi, exposure)
+        else:
+            self._lo = exposure if self._lo is None else max(self._lo, exposure)
+
+        if not saturated:
+            self._samples.append((exposure, stat))
+            next_exposure = self._predict(self.target - self.tolerance / 2)
+        else:
+            next_exposure = None
+
+        # Bisect if saturated, if the model failed, or if the prediction leaves the bracket
+        if next_exposure is None or not self._in_bracket(next_exposure):
+            if self._lo is not None and self._hi is not None:
+                next_exposure = (self._lo + self._hi) / 2
+            elif self._hi is not None:
+                next_exposure = self._hi / 2
+            else:
+                next_exposure = self._lo * 2
+
+        next_exposure = round(min(self.max_exposure, max(self.min_exposure, next_exposure)), 2)
+        return False, next_exposure
+
+    def give_up(self):
+        """Mark the current scene as not converged. The next scene starts from the last good exposure."""
+        self.failed_scenes += 1
+        print(f"AE: No convergence after {self.iteration} iteration(s).")
+
+    def summary(self):
+        n = len(self.iterations)
+        avg = sum(self.iterations) / n if n else 0
+        return f"AE: {n} scene(s) converged, avg. {avg:.2f} iterations, max {max(self.iterations, default=0)}, {self.failed_scenes} failed."
+
+    def _predict(self, aim):
+        (e1, s1) = self._samples[-1]
+        if len(self._samples) >= 2:
+            (e0, s0) = self._samples[-2]
+            if e1 != e0 and (s1 - s0) / (e1 - e0) > 0:
+                gain = (s1 - s0) / (e1 - e0)
+                return e1 + (aim - s1) / gain
+        if s1 <= 0 or e1 <= 0:
+            return None
+        return e1 * aim / s1
+
+    def _in_bracket(self, exposure):
+        if self._lo is not None and exposure <= self._lo:
+            return False
+        if self._hi is not None and exposure >= self._hi:
+            return False
+        return True
@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+# Columns of the frames table besides name and camera, filled from the info dict of a frame
+frame_columns = {
+    "path": "TEXT",
+    "store_index": "INTEGER",
+    "shape": "TEXT",
+    "dtype": "TEXT",
+    "exposure_ms": "REAL",
+    "iterations": "INTEGER",
+    "attempts": "INTEGER",
+    "t_start": "REAL",
+    "capture_s": "REAL",
+    "min": "REAL",
+    "max": "REAL",
+    "mean": "REAL",
+    "std": "REAL",
+    "snr": "REAL",
+    "saturated": "INTEGER",
+    "crop": "TEXT",
+    "dark_id": "TEXT",
+    "t_recorded": "REAL",
+}
+
+
+class FrameCatalog:
+    """
+    SQLite catalog with one row per saved frame, for selecting training data by query.
+
+    Every frame that reaches the disk is recorded with its camera, path, shape, exposure,
+    timings, statistics, crop window and the id of the master dark it was corrected with.
+    The pairs view joins the TL and CB row of every image, so e.g.
+
+        catalog.select_pairs("tl_snr > 2 AND cb_snr > 2 AND tl_saturated = 0")
+
+    returns the matching image names without opening a single TIFF. The columns used for
+    selection are indexed.
+
+    Parameters:
+        path (str): Path of the .sqlite file, created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # Frames are recorded from the writer threads
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+
+        columns = ", ".join(f"{c} {t}" for c, t in frame_columns.items())
+        with self._db:
+            self._db.execute(f"CREATE TABLE IF NOT EXISTS frames (name TEXT NOT NULL, camera TEXT NOT NULL, {columns}, PRIMARY KEY (name, camera))")
+            for column in ("camera", "snr", "saturated", "exposure_ms", "t_start", "dark_id"):
+                self._db.execute(f"CREATE INDEX IF NOT EXISTS frames_{column} ON frames ({column})")
+            self._db.execute("""
+                CREATE VIEW IF NOT EXISTS pairs AS
+                SELECT tl.name AS name,
+                       tl.path AS tl_path, cb.path AS cb_path,
+                       tl.exposure_ms AS tl_exposure_ms, cb.exposure_ms AS cb_exposure_ms,
+                       tl.snr AS tl_snr, cb.snr AS cb_snr,
+                       tl.max AS tl_max, cb.max AS cb_max,
+                       tl.saturated AS tl_saturated, cb.saturated AS cb_saturated,
+                       tl.dark_id AS tl_dark_id, cb.dark_id AS cb_dark_id,
+                       MIN(tl.t_start, cb.t_start) AS t_start
+                FROM frames AS tl JOIN frames AS cb ON tl.name = cb.name
+                WHERE tl.camera = 'tl' AND cb.camera = 'cb'
+            """)
+
+    def record(self, name, camera, **info):
+        """Insert or replace the row of one frame. Keys of info that are not columns are ignored."""
+        row = {c: info.get(c) for c in frame_columns}
+        row["t_recorded"] = time.time()
+        for c in ("shape", "crop"):
+            if row[c] is not None:
+                row[c] = json.dumps(list(row[c]))
+        if row["dtype"] is not None:
+            row["dtype"] = str(row["dtype"])
+
+        columns = ["name", "camera"] + list(row)
+        placeholders = ", ".join("?" * len(columns))
+        with self._lock, self._db:
+            self._db.execute(f"INSERT OR REPLACE INTO frames ({', '.join(columns)}) VALUES ({placeholders})",
+                             [name, camera] + list(row.values()))
+
+    def query(self, sql, params=()):
+        """Run a read-only query and return the rows as dicts."""
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, r)) for r in cursor.fetchall()]
+
+    def select_pairs(self, where="1", params=()):
+        """Names of the pairs matching a condition on the columns of the pairs view."""
+        return [r["name"] for r in self.query(f"SELECT name FROM pairs WHERE {where} ORDER BY t_start", params)]
+
+    def __len__(self):
+        return self.query("SELECT COUNT(*) AS n FROM frames")[0]["n"]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,117 @@
+import numpy as np
+
+
+class FrameStats:
+    """
+    Min, max, mean, std, SNR and saturation count of a frame, overall or per channel.
+
+    Returned by frame_stats(). With per_channel=True every attribute is an array with one
+    value per channel (first axis), and combined() gives the statistics of the whole frame.
+    snr is mean / std, 0 where std is 0, like snr() in scene_imager.
+    """
+
+    def __init__(self, n, minimum, maximum, mean, m2, saturated=None):
+        self.n = n
+        self.min = minimum
+        self.max = maximum
+        self.mean = mean
+        self._m2 = m2  # sum of squared deviations from the mean
+        self.std = np.sqrt(m2 / n)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.snr = np.where(self.std == 0, 0, mean / self.std)
+        self.saturated = saturated
+
+    def channel(self, i):
+        """Statistics of channel i of per-channel stats."""
+        return FrameStats(self.n, self.min[i], self.max[i], self.mean[i], self._m2[i],
+                          None if self.saturated is None else self.saturated[i])
+
+    def combined(self):
+        """Statistics over all channels, merged without another pass over the data."""
+        if np.ndim(self.mean) == 0:
+            return self
+        n = self.n * np.size(self.mean)
+        mean = np.mean(self.mean)
+        m2 = np.sum(self._m2 + self.n * (self.mean - mean) ** 2)
+        saturated = None if self.saturated is None else int(np.sum(self.saturated))
+        return FrameStats(n, np.min(self.min), np.max(self.max), mean, m2, saturated)
+
+    def as_dict(self):
+        """Overall statistics as plain Python numbers, e.g. for the manifest and the catalog."""
+        s = self.combined()
+        return {"min": float(s.min), "max": float(s.max), "mean": float(s.mean), "std": float(s.std),
+                "snr": float(s.snr), "saturated": s.saturated}
+
+    def __str__(self):
+        s = f"Max: {self.max}, Min: {self.min}, Avg: {self.mean}, Std: {self.std}, SNR: {self.snr}"
+        if self.saturated is not None:
+            s += f", Saturated: {self.saturated}"
+        return s
+
+
+## Fused statistics of a frame
+def frame_stats(data, saturation=None, per_channel=False, chunk_bytes=1 << 20):
+    """
+    Computes min, max, mean, std, SNR and the saturation count of data in one pass.
+
+    The frame is walked in chunks of about chunk_bytes, and every statistic is taken from
+    a chunk while it is still in cache, instead of separate np.max / np.min / np.mean /
+    np.std calls that each read the whole frame from memory. Sums are accumulated in
+    float64 around a per-channel shift, so the std does not lose precision on large frames.
+
+    Parameters:
+        data (ndarray): Frame or stack, channels on the first axis.
+        saturation (float): Optional level, pixels at or above it are counted as saturated.
+        per_channel (bool): Statistics per channel (first axis) instead of over the frame.
+        chunk_bytes (int): Approximate size of the chunks.
+    """
+    data = np.asarray(data)
+    flat = data.reshape(data.shape[0] if per_channel and data.ndim > 1 else 1, -1)
+    channels, n = flat.shape
+    if n == 0:
+        raise ValueError("frame_stats of an empty frame")
+
+    step = max(1, chunk_bytes // max(1, channels * flat.itemsize))
+    minimum = maximum = None
+    shift = flat[:, :1].astype(np.float64)
+    total = np.zeros(channels)
+    total_sq = np.zeros(channels)
+    saturated = np.zeros(channels, dtype=np.int64) if saturation is not None else None
+
+    for i in range(0, n, step):
+        chunk = flat[:, i:i + step]
+        cmin, cmax = chunk.min(axis=1), chunk.max(axis=1)
+        minimum = cmin if minimum is None else np.minimum(minimum, cmin)
+        maximum = cmax if maximum is None else np.maximum(maximum, cmax)
+        d = chunk - shift
+        total += d.sum(axis=1)
+        total_sq += np.einsum("ij,ij->i", d, d)
+        if saturated is not None:
+            saturated += np.count_nonzero(chunk >= saturation, axis=1)
+
+    mean_d = total / n
+    m2 = np.maximum(total_sq - n * mean_d ** 2, 0)
+    mean = shift[:, 0] + mean_d
+
+    if not per_channel or data.ndim <= 1:
+        return FrameStats(n, minimum[0], maximum[0], mean[0], m2[0], None if saturated is None else int(saturated[0]))
+    return FrameStats(n, minimum, maximum, mean, m2, saturated)
+
+
+## Number of clipped pixels of a raw frame
+def count_saturated(raw, saturation, mask=None):
+    """
+    Counts the pixels of raw at or above saturation, on the raw counts before dark
+    subtraction. A dark subtracted pixel that clipped reads saturation - dark, so the
+    processed frame cannot be used for this.
+
+    Parameters:
+        raw (ndarray): Raw frame or window of it.
+        saturation (float): Raw full-scale level.
+        mask (ndarray): Optional boolean mask of the same shape, masked pixels (e.g. stuck
+            defects) are not counted.
+    """
+    clipped = np.asarray(raw) >= saturation
+    if mask is not None:
+        clipped &= ~mask
+    return int(np.count_nonzero(clipped))
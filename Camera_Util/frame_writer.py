@@ -0,0 +1,177 @@
+import io
+import threading
+import queue
+import time
+from contextlib import nullcontext
+import numpy as np
+import tifffile
+
+# TIFF codecs for tiff_options(), names as understood by tifffile (zlib is deflate).
+# tifffile writes zlib and lzma by itself, zstd, lzw, packbits and the floating-point
+# predictor need the imagecodecs package (pip install imagecodecs).
+TIFF_CODECS = (None, "zlib", "zstd", "lzma", "lzw", "packbits")
+_codec_support = {}  # (compression, predictor, dtype kind) -> error message, None if it works
+
+
+## Whether tifffile can write a codec in this environment
+def codec_error(compression, predictor=True, dtype=None):
+    """
+    Writes a small frame with the codec into memory, once per codec and dtype kind, and
+    returns the error message, None if the codec works. dtype None checks both integer
+    and float frames.
+    """
+    kinds = ("u", "f") if dtype is None else ("f" if np.dtype(dtype).kind == "f" else "u",)
+    for kind in kinds:
+        key = (compression, bool(predictor), kind)
+        if key not in _codec_support:
+            try:
+                tifffile.imwrite(io.BytesIO(), np.zeros((8, 8), np.float32 if kind == "f" else np.uint16),
+                                 **_tiff_options(compression, predictor, None))
+                _codec_support[key] = None
+            except Exception as e:
+                _codec_support[key] = f"{type(e).__name__}: {e}"
+        if _codec_support[key] is not None:
+            return _codec_support[key]
+    return None
+
+
+## tifffile.imwrite arguments for a codec
+def tiff_options(compression=None, predictor=True, level=None, dtype=None):
+    """
+    Keyword arguments for tifffile.imwrite / FrameWriter.submit.
+
+    Codecs that cannot be written here are rejected with a ValueError, in the calling
+    thread, instead of failing later inside the background writer where the frame would
+    be lost. Call it once at startup to check the settings.
+
+    Parameters:
+        compression (str): One of TIFF_CODECS, None writes uncompressed.
+        predictor (bool): Use the horizontal predictor for integer frames and the
+            floating-point predictor for float frames, which helps smooth images compress.
+        level (int): Optional compression level of the codec.
+        dtype: dtype of the frames, None checks the codec for integer and float frames.
+    """
+    if compression not in TIFF_CODECS:
+        raise ValueError(f"Unknown TIFF compression {compression!r}, use one of {TIFF_CODECS}.")
+    error = codec_error(compression, predictor, dtype)
+    if error is not None:
+        raise ValueError(f"TIFF compression {compression!r}{' with predictor' if predictor else ''} is not "
+                         f"available ({error}), install imagecodecs or choose another codec.")
+    return _tiff_options(compression, predictor, level)
+
+
+def _tiff_options(compression, predictor, level):
+    options = {"photometric": "minisblack"}
+    if compression is not None:
+        options["compression"] = compression
+        if predictor and compression != "packbits":
+            options["predictor"] = True
+        if level is not None:
+            options["compressionargs"] = {"level": level}
+    return options
+
+
+class FrameWriter:
+    """
+    Writes TIFF frames in the background so the capture loop does not wait on the disk.
+
+    Frames are put on a queue that is drained by a small pool of writer threads. At most
+    max_in_flight frames can be queued or in the middle of being written; submit() blocks
+    once that limit is reached, which keeps memory bounded if the disk falls behind.
+
+    Parameters:
+        max_in_flight (int): Maximum number of frames that are queued or being written.
+        num_workers (int): Number of writer threads.
+        timer (StageTimer): Optional timer that records every write as stage "write".
+    """
+
+    def __init__(self, max_in_flight=8, num_workers=2, timer=None):
+        self.max_in_flight = max_in_flight
+        self.timer = timer
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self.errors = []  # (path, exception) for every failed write
+        self.frames_written = 0
+        self.stall_time = 0.0  # seconds submit() spent waiting for a free slot
+
+        self._workers = [threading.Thread(target=self._run, name=f"frame_writer_{i}", daemon=True) for i in range(num_workers)]
+        for w in self._workers:
+            w.start()
+
+    def submit(self, path, data, on_done=None, **imwrite_kwargs):
+        """
+        Queue a frame for writing. Blocks while max_in_flight frames are outstanding.
+
+        The caller must not modify data until on_done(error) has been called. error is
+        None if the write succeeded and the raised exception otherwise.
+        """
+        if self._closed:
+            raise RuntimeError("FrameWriter is closed.")
+
+        t0 = time.perf_counter()
+        self._slots.acquire()
+        waited = time.perf_counter() - t0
+        with self._lock:
+            self.stall_time += waited
+        if waited > 0.1:
+            print(f"Writer: Waited {waited:.2f}s for a free slot ({self.max_in_flight} frames in flight).")
+
+        self._queue.put((path, data, on_done, imwrite_kwargs))
+
+    def flush(self):
+        """Block until every submitted frame has been written."""
+        self._queue.join()
+
+    def close(self):
+        """Flush all outstanding frames, stop the writer threads and report errors."""
+        if self._closed:
+            return self.errors
+        self.flush()
+        self._closed = True
+        for _ in self._workers:
+            self._queue.put(None)
+        for w in self._workers:
+            w.join()
+
+        print(f"Writer: {self.frames_written} frames written, {len(self.errors)} failed, {self.stall_time:.1f}s stalled.")
+        for path, e in self.errors:
+            print(f"Writer: Failed to write {path}: {e}")
+        return self.errors
+
+    @property
+    def in_flight(self):
+        return self._queue.unfinished_tasks
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+
+            path, data, on_done, imwrite_kwargs = item
+            error = None
+            try:
+                with self.timer.stage("write") if self.timer is not None else nullcontext():
+                    tifffile.imwrite(path, data, **imwrite_kwargs)
+            except Exception as e:
+                error = e
+
+            with self._lock:
+                if error is None:
+                    self.frames_written += 1
+                else:
+                    self.errors.append((path, error))
+                    print(f"Writer: Failed to write {path}: {error}")
+
+            try:
+                if on_done is not None:
+                    on_done(error)
+            except Exception as e:
+                print(f"Writer: on_done callback for {path} failed: {e}")
+            finally:
+                self._slots.release()
+                self._queue.task_done()
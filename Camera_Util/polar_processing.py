@@ -0,0 +1,155 @@
+from contextlib import nullcontext
+import numpy as np
+import polanalyser as pa
+from buffer_pool import BufferPool
+
+# Position (row, col) of each polarizer angle in the 2x2 superpixel of the Thorlabs
+# polarization sensor, as assumed by pa.demosaicing with pa.COLOR_PolarMono:
+#   [[ 90,  45],
+#    [135,   0]]
+POLAR_LATTICE = {0: (1, 1), 45: (0, 1), 90: (0, 0), 135: (1, 0)}
+
+
+## Strided view of the raw pixels behind one polarizer angle
+def sublattice_view(raw, window, angle=0):
+    """
+    Returns a view (no copy) of the raw mosaic pixels of one polarizer angle inside window.
+
+    Parameters:
+        raw (ndarray): Raw sensor frame in full-sensor coordinates.
+        window (tuple): Crop window (y1, y2, x1, x2) in full-sensor coordinates.
+        angle (int): Polarizer angle, one of POLAR_LATTICE.
+    """
+    y1, y2, x1, x2 = window
+    oy, ox = POLAR_LATTICE[angle]
+    return raw[y1 + (oy - y1) % 2:y2:2, x1 + (ox - x1) % 2:x2:2]
+
+
+## Exposure statistic computed directly on the raw mosaic
+def meter_window(raw, window, dark=None, angle=0, mask=None, saturation=None):
+    """
+    Max pixel of one polarizer channel inside window, computed on the raw mosaic.
+
+    Matches the max of the demosaiced channel over the same window, since bilinear
+    demosaicing keeps the measured values and only interpolates between them, but
+    touches a quarter of the window pixels and needs no demosaicing.
+
+    Parameters:
+        raw (ndarray): Raw sensor frame.
+        window (tuple): Crop window (y1, y2, x1, x2).
+        dark (ndarray): Optional master dark in the same dtype as raw, either of the full
+            sensor or of only the window (shape (y2 - y1, x2 - x1)).
+        angle (int): Polarizer angle to meter on.
+        mask (ndarray): Optional boolean defect mask in raw coordinates, see defect_map.
+            Masked pixels are ignored, so a hot pixel cannot set the exposure.
+        saturation (float): Optional raw level. If given, returns (max, saturated), where
+            saturated says whether a raw pixel, before dark subtraction, is at or above it.
+    """
+    view = sublattice_view(raw, window, angle)
+    if mask is not None:
+        mask_view = sublattice_view(mask, window, angle)
+    saturated = None
+    if saturation is not None:
+        raw_view = view if mask is None else np.where(mask_view, 0, view)
+        saturated = bool(raw_view.max() >= saturation)
+    if dark is not None:
+        if dark.shape == raw.shape:
+            dark_view = sublattice_view(dark, window, angle)
+        else:
+            # Dark of the window only, same lattice offsets relative to the window origin
+            y1, y2, x1, x2 = window
+            oy, ox = POLAR_LATTICE[angle]
+            dark_view = dark[(oy - y1) % 2::2, (ox - x1) % 2::2]
+        # max(raw, dark) - dark cannot wrap around for unsigned raw and dark
+        view = np.maximum(view, dark_view) - dark_view
+    if mask is not None:
+        view = np.where(mask_view, 0, view)
+    if saturation is not None:
+        return view.max(), saturated
+    return view.max()
+
+
+class PolarStackProcessor:
+    """
+    Crop-then-demosaic pipeline for the Thorlabs polarization cam.
+
+    The raw mosaic is cropped to window first, padded by a few pixels so the bilinear
+    interpolation at the window edges sees the same neighbours as a full-frame demosaic,
+    and aligned to the 2x2 polarizer superpixel so the mosaic pattern does not shift.
+    Only that window is dark subtracted, defect corrected and demosaiced. The four polarization channels
+    (0, 45, 90, 135) and the raw window are written into a (5, H, W) buffer from the
+    buffer pool, so the same few buffers are reused for every frame.
+
+    The stack returned by process() must be given back with release() once the caller
+    (e.g. the background writer) is done with it.
+
+    Parameters:
+        window (tuple): Crop window (y1, y2, x1, x2) in full-sensor coordinates.
+        pad (int): Extra raw pixels around the window used for interpolation.
+        timer (StageTimer): Optional timer for the dark subtraction and demosaicing stages.
+        pool (BufferPool): Pool the stack and scratch buffers are taken from.
+    """
+
+    def __init__(self, window, pad=2, timer=None, pool=None):
+        self.window = window
+        self.pad = pad
+        self.timer = timer
+        self.pool = pool if pool is not None else BufferPool(max_per_key=2)
+
+    def process(self, raw, dark=None, defects=None):
+        """
+        Returns the (5, H, W) stack of the window.
+
+        dark is an optional DarkCorrector for the full sensor. Only the padded window is
+        dark subtracted, into a pooled scratch buffer. defects is an optional DefectMap of
+        the sensor, its pixels are replaced in the scratch buffer before demosaicing, so
+        raw itself is not modified.
+        """
+        y1, y2, x1, x2 = self.window
+        py1, py2, px1, px2 = self._padded_window(raw.shape)
+
+        # Dark subtract only the padded window
+        raw_win = raw[py1:py2, px1:px2]
+        scratch = None
+        if dark is not None:
+            with self._stage("tl_dark_subtract"):
+                scratch = self.pool.acquire(raw_win.shape, dark.output_dtype(raw_win))
+                raw_win = dark.apply(raw_win, out=scratch, window=(slice(py1, py2), slice(px1, px2)))
+
+        # Replace hot and stuck pixels before demosaicing spreads them into the other channels
+        if defects is not None:
+            with self._stage("tl_defects"):
+                if scratch is None:
+                    scratch = self.pool.acquire(raw_win.shape, raw_win.dtype)
+                    np.copyto(scratch, raw_win)
+                    raw_win = scratch
+                defects.correct(raw_win, window=(py1, py2, px1, px2))
+
+        with self._stage("tl_demosaic"):
+            img_pol = pa.demosaicing(img_raw=raw_win, code=pa.COLOR_PolarMono)
+
+        out = self.pool.acquire((5, y2 - y1, x2 - x1), np.result_type(img_pol[0], raw_win))
+
+        # Copy the window interior into the stack, channels 0-3 polarization, 4 raw
+        iy, ix = y1 - py1, x1 - px1
+        for i in range(4):
+            np.copyto(out[i], img_pol[i][iy:iy + y2 - y1, ix:ix + x2 - x1])
+        np.copyto(out[4], raw_win[iy:iy + y2 - y1, ix:ix + x2 - x1])
+
+        self.pool.release(scratch)
+        return out
+
+    def release(self, stack):
+        """Give a stack returned by process() back to the pool."""
+        self.pool.release(stack)
+
+    def _stage(self, name):
+        return self.timer.stage(name) if self.timer is not None else nullcontext()
+
+    def _padded_window(self, shape):
+        y1, y2, x1, x2 = self.window
+        py1 = max(0, y1 - self.pad) // 2 * 2
+        px1 = max(0, x1 - self.pad) // 2 * 2
+        py2 = min(shape[0], (y2 + self.pad + 1) // 2 * 2)
+        px2 = min(shape[1], (x2 + self.pad + 1) // 2 * 2)
+        return py1, py2, px1, px2
@@ -0,0 +1,100 @@
+import math
+import numpy as np
+
+
+## Cheap downsampling of a frame to about max_size for the GUI preview
+def decimate(img, max_size=(500, 500)):
+    """
+    Returns a contiguous copy of img, taking every n-th pixel with the largest n that
+    keeps it at least max_size, so the GUI only scales it down by less than 2x.
+
+    The copy is small and owned by the caller, so it can be handed to the GUI thread while
+    the full frame goes back to the buffer pool. Striding is enough for a preview and
+    touches only the pixels that are kept.
+
+    Parameters:
+        img (ndarray): 2D frame.
+        max_size (tuple): (width, height) of the preview.
+    """
+    height, width = img.shape[:2]
+    step = max(1, math.floor(max(width / max_size[0], height / max_size[1])))
+    return img[::step, ::step].copy()
+
+
+class PreviewRenderer:
+    """
+    Converts preview frames to contiguous 8-bit grayscale for QImage, without float64 temporaries.
+
+    Integer frames (the 12-bit TL data) go through a 4096-entry uint8 lookup table, one
+    np.take per frame. Float frames (Cubert bands) are scaled into 12-bit indices in a
+    cached float32 scratch buffer and then use the same table, so gamma and stretch cost
+    the same for both cams. Tables are cached per (low, high) level range.
+
+    The returned array is reused by the next render() call of the same shape, QImage /
+    QPixmap.fromImage has to be done with it before then.
+
+    Parameters:
+        bit_depth (int): Bit depth of integer frames, 12 for the TL cam.
+        gamma (float): Display gamma, 1 is linear.
+        percentiles (tuple): Optional (low, high) percentiles stretched to 0..255, e.g.
+            (1, 99.5). None maps 0..2**bit_depth-1 for integer frames and min..max for floats.
+    """
+
+    def __init__(self, bit_depth=12, gamma=1.0, percentiles=None):
+        self.levels = 2 ** bit_depth
+        self.gamma = gamma
+        self.percentiles = percentiles
+        self._luts = {}
+        self._buffers = {}
+
+    def render(self, img):
+        """Returns img as a C-contiguous uint8 array of the same 2D shape."""
+        if np.issubdtype(img.dtype, np.integer):
+            lo, hi = self._int_range(img)
+            return np.take(self._lut(lo, hi), img, mode="clip", out=self._buffer("out", img.shape, np.uint8))
+
+        lo, hi = self._float_range(img)
+        # Scale into 12-bit indices and reuse the table
+        scaled = self._buffer("scaled", img.shape, np.float32)
+        np.subtract(img, lo, out=scaled, casting="unsafe")
+        scaled *= (self.levels - 1) / (hi - lo)
+        np.clip(scaled, 0, self.levels - 1, out=scaled)
+        index = self._buffer("index", img.shape, np.uint16)
+        np.copyto(index, scaled, casting="unsafe")
+        return np.take(self._lut(0, self.levels - 1), index, out=self._buffer("out", img.shape, np.uint8))
+
+    def _int_range(self, img):
+        if self.percentiles is None:
+            return 0, self.levels - 1
+        # Percentiles from the histogram, no sort and no float copy of the frame
+        hist = np.bincount(np.minimum(img, self.levels - 1).ravel(), minlength=self.levels)
+        cdf = np.cumsum(hist) / img.size
+        lo = int(np.searchsorted(cdf, self.percentiles[0] / 100))
+        hi = int(np.searchsorted(cdf, self.percentiles[1] / 100))
+        return lo, max(hi, lo + 1)
+
+    def _float_range(self, img):
+        if self.percentiles is None:
+            lo, hi = float(np.min(img)), float(np.max(img))
+        else:
+            lo, hi = (float(v) for v in np.percentile(img, self.percentiles))
+        return lo, hi if hi > lo else lo + 1
+
+    def _lut(self, lo, hi):
+        lut = self._luts.get((lo, hi))
+        if lut is None:
+            x = np.clip((np.arange(self.levels, dtype=np.float64) - lo) / (hi - lo), 0, 1)
+            if self.gamma != 1:
+                x **= 1 / self.gamma
+            lut = np.rint(x * 255).astype(np.uint8)
+            if len(self._luts) >= 64:
+                self._luts.clear()
+            self._luts[(lo, hi)] = lut
+        return lut
+
+    def _buffer(self, key, shape, dtype):
+        buf = self._buffers.get(key)
+        if buf is None or buf.shape != shape:
+            buf = np.empty(shape, dtype=dtype)
+            self._buffers[key] = buf
+        return buf
@@ -1,21 +1,27 @@
 import os
-os.add_dll_directory(r"C:\\Users\\menon\\Documents\\FTDI_drivers\\amd64")
-os.add_dll_directory(r"C:\\Program Files\\Cuvis\\bin")
-os.add_dll_directory(r"C:\\Users\\menon\\AppData\\Local\\Programs\\Python\\Python312\\Lib\\site-packages\\cuvis_il")
-os.environ["CUVIS"] = r"C:\\Program Files\\Cuvis"
-
-import pylablib as pll
-from pylablib.devices import Thorlabs as tl
-import cuvis
 import time
-import platform
+import threading
 from datetime import timedelta
 import tifffile
 import numpy as np
 import polanalyser as pa
+from frame_writer import FrameWriter, tiff_options
+import camera_backends
+from dark_correction import DarkCorrector
+from dark_library import DarkLibrary
+from frame_stats import frame_stats
+from camera_recovery import RecoveryManager
+from frame_catalog import FrameCatalog
+import dark_capture
+from defect_map import DefectMap
 
 
 ## Parameters
+# "hardware" for the rig, "simulated" to run without cams (e.g. CAMERA_BACKEND=simulated on Linux)
+camera_backend = os.environ.get("CAMERA_BACKEND", "hardware")
+sim_options_tl = {}  # e.g. dict(latency_scale=0.1, failure_rate=0.01), see camera_backends
+sim_options_cb = {}
+
 thorlabs_image_folder = 'example_images//thorlabs'
 cubert_image_folder = 'example_images//cubert'
 
@@ -26,12 +32,58 @@ exposure_time_cb = 550 # in ms
 do_dark_subtract_tl = True
 path_dark_tl = "C:\\Users\\menon\\Documents\\Camera_Operation\\images\\dark_frame\\thorlabs\\thorlabs_masterdark.npy"  
 roi_tl = (0, 2448, 0, 2048)
+# Hot/noisy/stuck pixel correction of the raw TL mosaic before demosaicing, see defect_map
+do_defect_correct_tl = True
+path_defects_tl = "C:\\Users\\menon\\Documents\\Camera_Operation\\images\\dark_frame\\thorlabs\\thorlabs_defects.npz"
+defects_tl = None
 
 # Additional parameters for Cubert cam
 do_dark_subtract_cb = True
 path_dark_cb = "C:\\Users\\menon\\Documents\\Camera_Operation\\images\\dark_frame\\cubert\\cubert_masterdark.npy"
 distance_cb = 1100  # in mm
 
+# Camera recovery: re-arm after timeouts, reopen with backoff after disconnects, see camera_recovery
+tl_recovery = RecoveryManager("TL", rearm=camera_backends.rearm_thorlabs_cam,
+                              reopen=lambda cam: camera_backends.reopen_thorlabs_cam(cam, exposure_time_tl, roi_tl),
+                              reinit=lambda cam: reinit_thorlabs_cam(cam))
+cb_recovery = RecoveryManager("CB", reopen=camera_backends.wait_cubert_online, base_delay_s=0.5)
+
+# Background TIFF writer, so slow disk writes do not stall the cams
+async_write = True
+max_frames_in_flight = 8
+writer_threads = 2
+frame_writer = None
+
+# TIFF compression per cam (None, 'zlib', 'zstd', 'lzma', 'lzw'), compare them with benchmark_tiff_codecs.py
+# zstd, lzw and the predictor for float frames need imagecodecs (pip install imagecodecs), checked by start_frame_writer()
+tiff_compression_tl = None
+tiff_compression_cb = None
+tiff_predictor = True  # horizontal / floating-point predictor for compressed TIFFs
+tiff_compression_level = None
+save_dtype_cb = None  # e.g. 'float32' to store float64 cubes at half the size, None keeps the processing dtype
+
+# Working dtype of the dark subtraction, "native" keeps the camera's integer dtype
+dark_dtype_tl = "native"
+dark_dtype_cb = "float32"
+_dark_correctors = []  # (master dark, dtype, DarkCorrector)
+_dark_lock = threading.Lock()
+
+# Frame catalog: SQLite index of every saved frame (exposure, statistics, dark id, ...), see frame_catalog
+use_frame_catalog = True
+frame_catalog_path = 'example_images//frame_catalog.sqlite'  # opened with the first saved frame
+frame_catalog = None
+_catalog_lock = threading.Lock()
+
+# Dark capture with the lenses covered, see capture_darks()
+dark_folder = 'example_images//darks'
+dark_name_tl = 'thorlabs_masterdark'
+dark_name_cb = 'cubert_masterdark'
+defect_name_tl = 'thorlabs_defects'  # defect map built from the longest TL dark exposure
+dark_exposures_tl = [exposure_time_tl]  # in ms, darks at several exposures are fitted into a dark library (.npz)
+dark_exposures_cb = [exposure_time_cb]
+dark_frames_tl = 50  # frames averaged per exposure
+dark_frames_cb = 20
+
 ## Main function
 def main():
     # Setup the Thorlabs cam
@@ -39,78 +91,108 @@ def main():
     print("TL setup done.")
 
     # Get Thorlabs masterdark calibration frame
-    dark_calibration_tl = np.load(path_dark_tl) if do_dark_subtract_tl else None
+    dark_calibration_tl = load_dark(path_dark_tl) if do_dark_subtract_tl else None
     print(dark_calibration_tl.shape)
 
+    # Get the Thorlabs defect map
+    load_defect_map()
+
     # Setup the Cubert cam
     acquisitionContext, processingContext, cubeExporter = setup_cubert_cam()
     print("CB setup done.")
 
     # Calibrate the Cubert cam
-    dark_calibration_cb = np.load(path_dark_cb) if do_dark_subtract_cb else None
+    dark_calibration_cb = load_dark(path_dark_cb) if do_dark_subtract_cb else None
+
+    # Start the background TIFF writer
+    start_frame_writer()
 
     # Start counter
     img_num = 1
 
     # Wait for user input to capture images
-    while True:
-        input("Press Enter to capture images...")
-        img_name = str(img_num)
-
-        # Capture and save Thorlabs image
-        tl_success, cam_tl = take_and_save_thorlabs_image(
-            img_name=img_name, dark_cal=dark_calibration_tl, cam_tl=cam_tl
-        )
-
-        # Capture and save Cubert image if Thorlabs image was successful
-        if tl_success:
-            take_and_save_cubert_image(
-                img_name=img_name, dark_cal=dark_calibration_cb,
-                acquContext=acquisitionContext, procContext=processingContext
+    try:
+        while True:
+            input("Press Enter to capture images...")
+            img_name = str(img_num)
+
+            # Capture and save Thorlabs image
+            tl_success, cam_tl = take_and_save_thorlabs_image(
+                img_name=img_name, dark_cal=dark_calibration_tl, cam_tl=cam_tl
             )
-        else:
-            print("Skipping CB image because TL imaging was unsuccessful.")
-
-        print("\nImage capture complete. Press Ctrl+C to quit.")
-        img_num += 1
 
+            # Capture and save Cubert image if Thorlabs image was successful
+            if tl_success:
+                take_and_save_cubert_image(
+                    img_name=img_name, dark_cal=dark_calibration_cb,
+                    acquContext=acquisitionContext, procContext=processingContext
+                )
+            else:
+                print("Skipping CB image because TL imaging was unsuccessful.")
+
+            print("\nImage capture complete. Press Ctrl+C to quit.")
+            img_num += 1
+    except KeyboardInterrupt:
+        print("Quitting.")
+    finally:
+        # Make sure all queued images are on disk before exiting
+        stop_frame_writer()
+
+    print(tl_recovery.report())
+    print(cb_recovery.report())
     cam_tl.close()
 
 
 ## Setup Thorlabs camera
 def setup_thorlabs_cam():
-    tl.list_cameras_tlcam()
-    cam = tl.ThorlabsTLCamera()
-    cam.set_exposure(exposure_time_tl * 1e-3)
-    cam.set_roi(*roi_tl, hbin=1, vbin=1)
-    return cam
+    return camera_backends.open_thorlabs_cam(camera_backend, exposure_time_tl, roi_tl, **sim_options_tl)
+
+## Full re-initialization of the Thorlabs cam, last step of tl_recovery
+def reinit_thorlabs_cam(cam_tl):
+    try:
+        cam_tl.close()
+    except Exception:
+        pass
+    return setup_thorlabs_cam()
 
 ## Take Thorlabs image, apply dark calibration, and save as TIFF
 def take_and_save_thorlabs_image(img_name, dark_cal, cam_tl):
     imaging_failed_counter = 0
     success = False
+    dark_tl = None
+    t_start = time.time()
 
     while imaging_failed_counter < 15:
         print(f"TL: Taking {exposure_time_tl}ms exposure with TL cam...")
         try:
-            img_tl = cam_tl.snap() - dark_cal[0] if do_dark_subtract_tl and dark_cal is not None else cam_tl.snap()
+            img_tl = cam_tl.snap()
+            if do_dark_subtract_tl and dark_cal is not None:
+                dark_tl = get_dark_corrector(dark_cal, dark_dtype_tl, tl=True, exposure_ms=exposure_time_tl)
+                img_tl = dark_tl.apply_inplace(img_tl)
             print("Shape")
             print(img_tl.shape)
-            img_tl = np.maximum(img_tl, 0)
+            tl_recovery.succeeded()
             success = True
             break
-        except:
+        except Exception as e:
             imaging_failed_counter += 1
-            print(f"TL: Imaging failed. Restarting cam. Counter {imaging_failed_counter}")
-            cam_tl.close()
-            cam_tl = setup_thorlabs_cam()
+            print(f"TL: Imaging failed. Counter {imaging_failed_counter}")
+            cam_tl = tl_recovery.recover(e, cam_tl)
 
     if success:
+        # Replace hot and stuck pixels before demosaicing spreads them into the other channels
+        if do_defect_correct_tl and defects_tl is not None:
+            defects_tl.correct(img_tl)
         img_tl_pol = pa.demosaicing(img_raw=img_tl, code=pa.COLOR_PolarMono)
         img_tl_pol = np.append(img_tl_pol, [img_tl], axis=0)
         path = os.path.join(thorlabs_image_folder, f"{img_name}_thorlabs.tif")
-        tifffile.imwrite(path, img_tl_pol, photometric='minisblack')
-        print(f"TL: Saved image as TIFF. Shape: {img_tl_pol.shape}, Max: {np.max(img_tl_pol)}, Min: {np.min(img_tl_pol)}, Avg: {np.average(img_tl_pol)}, SNR: {snr(img_tl_pol)}")
+        stats = frame_stats(img_tl_pol)
+        tl_info = {"path": path, "shape": img_tl_pol.shape, "dtype": str(img_tl_pol.dtype),
+                   "exposure_ms": exposure_time_tl, "attempts": imaging_failed_counter + 1,
+                   "t_start": t_start, "capture_s": time.time() - t_start, **stats.as_dict(),
+                   "dark_id": dark_tl.id if dark_tl is not None else None}
+        save_tiff(path, img_tl_pol, on_done=lambda error: mark_saved(img_name, "tl", error, tl_info), compression=tiff_compression_tl)
+        print(f"TL: Saved image as TIFF. Shape: {img_tl_pol.shape}, {stats}")
     else:
         print("TL: No image to save.")
 
@@ -118,58 +200,49 @@ def take_and_save_thorlabs_image(img_name, dark_cal, cam_tl):
 
 ## Setup Cubert camera
 def setup_cubert_cam():
-    data_dir = os.getenv("CUVIS") if platform.system() == "Windows" else os.getenv("CUVIS_DATA")
-    factory_dir = os.path.join(data_dir, "factory")
-    userSettingsDir = os.path.join(data_dir, os.pardir, "settings")
-
-    settings = cuvis.General(userSettingsDir)
-    settings.set_log_level("info")
-
-    calibration = cuvis.Calibration(factory_dir)
-    processingContext = cuvis.ProcessingContext(calibration)
-    acquisitionContext = cuvis.AcquisitionContext(calibration)
-
-    saveArgs = cuvis.SaveArgs(export_dir=cubert_image_folder, allow_overwrite=True, allow_session_file=True)
-    cubeExporter = cuvis.CubeExporter(saveArgs)
-
-    while acquisitionContext.state == cuvis.HardwareState.Offline:
-        print(".", end="")
-        time.sleep(1)
-    print("\nCubert camera is online.")
-
-    acquisitionContext.operation_mode = cuvis.OperationMode.Software
-    acquisitionContext.integration_time = exposure_time_cb
-    processingContext.calc_distance(distance_cb)
-
-    return acquisitionContext, processingContext, cubeExporter
+    return camera_backends.open_cubert_cam(camera_backend, exposure_time_cb, distance_cb, cubert_image_folder, **sim_options_cb)
 
 ## Take Cubert image, apply dark calibration, and save as TIFF
 def take_and_save_cubert_image(img_name, dark_cal, acquContext, procContext):
     imaging_failed_counter = 0
     saved = False
+    t_start = time.time()
 
     while imaging_failed_counter < 15:
-        time.sleep(0.5)
         print(f"CB: Taking {exposure_time_cb}ms exposure with CB cam...")
         try:
             am = acquContext.capture()
             mesu, res = am.get(timedelta(milliseconds=2500))
-        except:
+            if mesu is None:
+                raise TimeoutError(f"CB capture returned {res}")
+            cb_recovery.succeeded()
+        except Exception as e:
             mesu = None
-            imaging_failed_counter += 1
-            print(f"CB: Imaging failed. Counter: {imaging_failed_counter}")
+            cb_recovery.recover(e, acquContext)
 
         if mesu is not None:
             mesu.set_name(f"{img_name}_cubert")
             procContext.apply(mesu)
-            data_array = np.array(mesu.data['cube'].array)
-            data_array = data_array.transpose(2, 0, 1)
+            cube = np.asarray(mesu.data['cube'].array).transpose(2, 0, 1)
+            corrector = None
             if do_dark_subtract_cb and dark_cal is not None:
-                data_array = np.maximum(data_array.astype(float) - dark_cal.astype(float), 0)
-            if snr(data_array) > 0.05:
+                # Saturating subtract straight from the cuvis buffer into one float32 array
+                corrector = get_dark_corrector(dark_cal, dark_dtype_cb, exposure_ms=exposure_time_cb)
+                data_array = corrector.apply(cube)
+            else:
+                data_array = np.array(cube)
+            # One pass for both the SNR check and the log line
+            stats = frame_stats(data_array)
+            if stats.snr > 0.05:
                 path = os.path.join(cubert_image_folder, f"{img_name}_cubert.tif")
-                tifffile.imwrite(path, data_array, photometric='minisblack')
-                print(f"CB: Saved image as TIFF. Shape: {data_array.shape}, Max: {np.max(data_array)}, Min: {np.min(data_array)}, Avg: {np.average(data_array)}, SNR: {snr(data_array)}")
+                if save_dtype_cb is not None:
+                    data_array = data_array.astype(save_dtype_cb, copy=False)
+                cb_info = {"path": path, "shape": data_array.shape, "dtype": str(data_array.dtype),
+                           "exposure_ms": exposure_time_cb, "attempts": imaging_failed_counter + 1,
+                           "t_start": t_start, "capture_s": time.time() - t_start, **stats.as_dict(),
+                           "dark_id": corrector.id if corrector is not None else None}
+                save_tiff(path, data_array, on_done=lambda error: mark_saved(img_name, "cb", error, cb_info), compression=tiff_compression_cb)
+                print(f"CB: Saved image as TIFF. Shape: {data_array.shape}, {stats}")
                 saved = True
                 break
             else:
@@ -181,6 +254,120 @@ def take_and_save_cubert_image(img_name, dark_cal, acquContext, procContext):
 
     return saved
 
+## Record a saved frame in the frame catalog, opened on first use
+def mark_saved(img_name, camera, error, info):
+    global frame_catalog
+    if error is not None:
+        print(f"{camera.upper()}: Saving {img_name} failed, frame is not cataloged: {error}")
+        return
+    if not use_frame_catalog:
+        return
+    try:
+        with _catalog_lock:
+            if frame_catalog is None:
+                frame_catalog = FrameCatalog(frame_catalog_path)
+            catalog = frame_catalog
+        catalog.record(img_name, camera, **info)
+    except Exception as e:
+        print(f"{camera.upper()}: Cataloging {img_name} failed: {e}")
+
+## Close the frame catalog, the next saved frame reopens it (e.g. at a new frame_catalog_path)
+def close_frame_catalog():
+    global frame_catalog
+    with _catalog_lock:
+        if frame_catalog is not None:
+            frame_catalog.close()
+        frame_catalog = None
+
+## Load a master dark (.npy) or an exposure-indexed dark library (.npz, see dark_library)
+def load_dark(path):
+    return DarkLibrary.load(path) if path.endswith(".npz") else np.load(path)
+
+## Load the TL defect map used by take_and_save_thorlabs_image, None if there is none
+def load_defect_map(path=None):
+    global defects_tl
+    path = path or path_defects_tl
+    defects_tl = None
+    if not do_defect_correct_tl:
+        return None
+    if os.path.exists(path):
+        defects_tl = DefectMap.load(path)
+        print(f"TL: {defects_tl.summary()}")
+    else:
+        print(f"TL: No defect map at {path}, capture darks to create one.")
+    return defects_tl
+
+## Dark corrector for a master dark, converted to the working dtype only once
+def get_dark_corrector(dark_cal, dtype, tl=False, exposure_ms=None):
+    # A dark library gives the dark for the exposure of the frame
+    if isinstance(dark_cal, DarkLibrary):
+        return dark_cal.corrector(exposure_ms, dtype)
+    with _dark_lock:
+        for cal, dt, corrector in _dark_correctors:
+            if cal is dark_cal and dt == dtype:
+                return corrector
+        # TL master darks are raw frames, or (channel, y, x) stacks whose channel 0 is subtracted from the raw frame
+        corrector = DarkCorrector(dark_cal[0] if tl and dark_cal.ndim == 3 else dark_cal, dtype=dtype)
+        _dark_correctors.append((dark_cal, dtype, corrector))
+        del _dark_correctors[:-4]
+        return corrector
+
+## Capture master darks of both cams at the same time, with the lenses covered
+def capture_darks(cam_tl, acquContext, procContext, should_stop=None, on_progress=None):
+    """
+    dark_capture.capture_darks with the dark_* settings of this module. The new TL defect
+    map is used from the next frame on.
+
+    on_progress(camera, exposure_ms, frame, n_frames) is called after every frame.
+
+    Returns:
+        (paths, cam_tl): {"tl": path, "cb": path} of the new darks for load_dark (None if
+        a cam failed or the capture was cancelled), plus "defects_tl", the TL defect map
+        built from them, and the (possibly re-opened) TL cam.
+    """
+    global defects_tl
+    paths, cam_tl, defects = dark_capture.capture_darks(
+        cam_tl, acquContext, procContext, dark_folder, dark_exposures_tl, dark_exposures_cb, dark_frames_tl, dark_frames_cb,
+        name_tl=dark_name_tl, name_cb=dark_name_cb, defect_name_tl=defect_name_tl,
+        tl_recovery=tl_recovery, cb_recovery=cb_recovery, should_stop=should_stop, on_progress=on_progress)
+    if defects is not None:
+        defects_tl = defects
+    return paths, cam_tl
+
+## Start the background TIFF writer
+def start_frame_writer():
+    global frame_writer
+    # Reject TIFF codecs that cannot be written here before the first frame is lost to them
+    for compression in (tiff_compression_tl, tiff_compression_cb):
+        tiff_options(compression, predictor=tiff_predictor, level=tiff_compression_level)
+    if async_write and frame_writer is None:
+        frame_writer = FrameWriter(max_in_flight=max_frames_in_flight, num_workers=writer_threads)
+    return frame_writer
+
+## Flush outstanding writes, stop the writer and return failed writes
+def stop_frame_writer():
+    global frame_writer
+    errors = frame_writer.close() if frame_writer is not None else []
+    frame_writer = None
+    close_frame_catalog()
+    return errors
+
+## Save TIFF, in the background if the frame writer is running
+def save_tiff(path, data, on_done=None, compression=None):
+    options = tiff_options(compression, predictor=tiff_predictor, level=tiff_compression_level, dtype=data.dtype)
+    if frame_writer is not None:
+        frame_writer.submit(path, data, on_done=on_done, **options)
+        return
+
+    error = None
+    try:
+        tifffile.imwrite(path, data, **options)
+    except Exception as e:
+        error = e
+        print(f"Failed to write {path}: {e}")
+    if on_done is not None:
+        on_done(error)
+
 ## Calculate SNR
 def snr(img, axis=None, ddof=0):
     img = np.asanyarray(img)
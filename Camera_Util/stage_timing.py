@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """
+    Collects wall-clock durations of named pipeline stages (snap, demosaic, write, ...).
+
+    Thread-safe, so the capture workers and the background writer can record into the
+    same timer. Set enabled = False to skip all bookkeeping.
+
+    Count, total and max of every stage are running values over the whole session. The
+    percentiles are taken over the last window durations of a stage, so memory stays flat
+    however long the session runs.
+
+    Parameters:
+        enabled (bool): Record durations.
+        window (int): Recent durations per stage kept for the percentiles.
+    """
+
+    def __init__(self, enabled=True, window=2000):
+        self.enabled = enabled
+        self.window = window
+        self._lock = threading.Lock()
+        self._stages = {}  # name -> [n, total_s, max_s, deque of recent durations]
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def add(self, name, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = [0, 0.0, 0.0, deque(maxlen=self.window)]
+            stage[0] += 1
+            stage[1] += seconds
+            stage[2] = max(stage[2], seconds)
+            stage[3].append(seconds)
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+
+    def summary(self):
+        """
+        Returns {stage: {"n", "total_s", "mean_ms", "p50_ms", "p95_ms", "max_ms"}}, p50 and
+        p95 over the last window durations.
+        """
+        with self._lock:
+            stages = {k: (n, total, longest, sorted(recent)) for k, (n, total, longest, recent) in self._stages.items()}
+        result = {}
+        for name, (n, total, longest, recent) in stages.items():
+            result[name] = {
+                "n": n,
+                "total_s": total,
+                "mean_ms": 1e3 * total / n,
+                "p50_ms": 1e3 * _percentile(recent, 50),
+                "p95_ms": 1e3 * _percentile(recent, 95),
+                "max_ms": 1e3 * longest,
+            }
+        return result
+
+    def report(self):
+        lines = [f"{'stage':<18}{'n':>6}{'p50 [ms]':>12}{'p95 [ms]':>12}{'total [s]':>12}"]
+        for name, s in sorted(self.summary().items(), key=lambda kv: -kv[1]["total_s"]):
+            lines.append(f"{name:<18}{s['n']:>6}{s['p50_ms']:>12.2f}{s['p95_ms']:>12.2f}{s['total_s']:>12.2f}")
+        return "\n".join(lines)
+
+
+## Percentile of a sorted list with linear interpolation
+def _percentile(sorted_values, q):
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    pos = (len(sorted_values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
@@ -0,0 +1,67 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import camera_recovery
+from camera_recovery import RecoveryManager, classify_error, TIMEOUT, DISCONNECT, OTHER
+
+
+class Steps:
+    """Recovery steps that record their calls and optionally fail."""
+
+    def __init__(self, failing=()):
+        self.calls = []
+        self.failing = set(failing)
+
+    def step(self, name):
+        def fn(device):
+            self.calls.append(name)
+            if name in self.failing:
+                raise RuntimeError(f"{name} failed")
+            return f"{name}-device"
+        return fn
+
+
+def manager(steps, monkeypatch, delays, **kwargs):
+    monkeypatch.setattr(camera_recovery.time, "sleep", delays.append)
+    return RecoveryManager("TL", rearm=steps.step("rearm"), reopen=steps.step("reopen"), reinit=steps.step("reinit"), **kwargs)
+
+
+def test_classify_error():
+    assert classify_error(TimeoutError()) == TIMEOUT
+    assert classify_error(RuntimeError("Frame timed out")) == TIMEOUT
+    assert classify_error(OSError("USB device not connected")) == DISCONNECT
+    assert classify_error(ValueError("bad roi")) == OTHER
+
+
+def test_timeouts_escalate_with_exponential_backoff(monkeypatch):
+    steps, delays = Steps(), []
+    recovery = manager(steps, monkeypatch, delays, rearm_attempts=2, reopen_attempts=3, base_delay_s=0.5, max_delay_s=1.5)
+    for _ in range(7):
+        device = recovery.recover(TimeoutError(), "cam")
+    assert steps.calls == ["rearm", "rearm", "reopen", "reopen", "reopen", "reinit", "reinit"]
+    # Only reopen and reinit wait, doubling up to max_delay_s
+    assert delays == [0.5, 1.0, 1.5, 1.5, 1.5]
+    assert device == "reinit-device"
+
+
+def test_disconnect_skips_rearm_and_success_resets(monkeypatch):
+    steps, delays = Steps(), []
+    recovery = manager(steps, monkeypatch, delays, base_delay_s=0.1)
+    recovery.recover(ConnectionError("gone"), "cam")
+    recovery.succeeded()
+    recovery.recover(TimeoutError(), "cam")
+    assert steps.calls == ["reopen", "rearm"]
+    assert delays == [0.1]
+    assert recovery.recoveries == 1
+    assert recovery.stats()["failures"] == {TIMEOUT: 1, DISCONNECT: 1, OTHER: 0}
+
+
+def test_failing_step_escalates_right_away(monkeypatch):
+    steps, delays = Steps(failing={"rearm"}), []
+    recovery = manager(steps, monkeypatch, delays, base_delay_s=0.1)
+    assert recovery.recover(TimeoutError(), "cam") == "cam"
+    recovery.recover(TimeoutError(), "cam")
+    assert steps.calls == ["rearm", "reopen"]
+    assert recovery.step_failures == 1
+    assert recovery.steps == {"rearm": 0, "reopen": 1, "reinit": 0}
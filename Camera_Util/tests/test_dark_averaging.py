@@ -0,0 +1,59 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import tifffile
+from dark_averaging import DarkAccumulator, combine_tile, create_robust_master_dark
+
+
+def test_sigma_clip_rejects_a_cosmic_ray_in_few_frames():
+    data = np.array([[10], [10], [10], [10], [1000]], dtype=np.uint16)
+    combined, noise = combine_tile(data, method="sigma_clip")
+    assert combined[0] == 10
+    assert noise[0] == 0
+
+
+def test_sigma_clip_keeps_gaussian_noise():
+    rng = np.random.default_rng(0)
+    data = rng.normal(100, 5, size=(7, 2000)).astype(np.float32)
+    data[3, :100] += 500  # cosmic rays in one frame
+    combined, noise = combine_tile(data, method="sigma_clip")
+    clean = np.delete(data, 3, axis=0)
+    # The hits (+500, about +70 on the plain mean) are rejected, a noisy clean sample may be too
+    assert np.abs(combined[:100] - clean[:, :100].mean(axis=0)).max() < 5
+    assert abs(np.mean(combined[100:] - data[:, 100:].mean(axis=0))) < 0.2
+    assert 3 < np.median(noise[100:]) < 6
+
+
+def test_median_is_exact():
+    data = np.array([[1, 5], [2, 7], [9, 6]], dtype=np.uint16)
+    combined, _ = combine_tile(data, method="median")
+    assert combined.tolist() == [2, 6]
+
+
+def test_accumulator_matches_numpy():
+    rng = np.random.default_rng(1)
+    frames = rng.integers(0, 4096, size=(6, 8, 5)).astype(np.uint16)
+    accumulator = DarkAccumulator()
+    for frame in frames:
+        accumulator.add(frame)
+    assert np.allclose(accumulator.mean, frames.mean(axis=0))
+    assert np.allclose(accumulator.std, frames.std(axis=0, ddof=1))
+
+
+def test_robust_master_dark_over_tiles(tmp_path):
+    rng = np.random.default_rng(2)
+    frames = rng.integers(90, 110, size=(5, 7, 9)).astype(np.uint16)
+    frames[2, 3, 4] = 4095
+    for i, frame in enumerate(frames):
+        tifffile.imwrite(str(tmp_path / f"dark_{i}.tif"), frame)
+
+    master, _ = create_robust_master_dark(str(tmp_path), str(tmp_path / "master"), method="sigma_clip", tile_pixels=10, workers=3)
+    expected = frames.mean(axis=0)
+    expected[3, 4] = np.delete(frames[:, 3, 4], 2).mean()
+    # Other pixels may lose a sample to the clip as well, so compare loosely there
+    assert master.shape == (7, 9)
+    assert abs(master[3, 4] - expected[3, 4]) < 1e-6
+    assert np.abs(master - expected).max() < 10
+    assert os.path.exists(tmp_path / "master.npy")
@@ -0,0 +1,70 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from dark_library import DarkLibrary
+
+
+## Master darks bias + rate * t of a random sensor
+def make_darks(exposures, shape=(6, 8), seed=0):
+    rng = np.random.default_rng(seed)
+    bias = rng.uniform(90, 110, size=shape)
+    rate = rng.uniform(0.0, 0.05, size=shape)
+    return bias, rate, {t: bias + rate * t for t in exposures}
+
+
+def test_fit_recovers_bias_and_rate():
+    bias, rate, darks = make_darks([10, 100, 1000])
+    library = DarkLibrary.fit(darks)
+    assert np.allclose(library.bias, bias, atol=1e-3)
+    assert np.allclose(library.rate, rate, atol=1e-6)
+    assert np.allclose(library.dark(500), bias + rate * 500, atol=1e-2)
+
+
+def test_fit_reads_npy_files_and_channels(tmp_path):
+    bias, rate, darks = make_darks([20, 200])
+    for t, dark in darks.items():
+        np.save(tmp_path / f"dark_tl_{t}ms.npy", dark[None])
+    np.save(tmp_path / "dark_tl_20ms_noise.npy", np.ones((1,) + bias.shape))
+    library = DarkLibrary.from_folder(str(tmp_path), channel=0)
+    assert library.exposures_ms == [20.0, 200.0]
+    assert np.allclose(library.dark(100), bias + rate * 100, atol=1e-2)
+
+
+def test_single_exposure_gives_the_same_dark_everywhere():
+    bias, _, darks = make_darks([50])
+    library = DarkLibrary.fit(darks)
+    assert np.allclose(library.dark(5), darks[50])
+    assert np.allclose(library.dark(5000), darks[50])
+
+
+def test_window_dark_matches_the_full_dark():
+    _, _, darks = make_darks([10, 1000])
+    library = DarkLibrary.fit(darks)
+    window = (1, 5, 2, 7)
+    full = library.dark(333)
+    assert np.allclose(library.window_dark(333, window), full[1:5, 2:7])
+    assert np.array_equal(library.window_dark(333, window, dtype=np.uint16),
+                          np.rint(full[1:5, 2:7]).astype(np.uint16))
+
+
+def test_cache_is_bounded_and_shares_rounded_exposures():
+    _, _, darks = make_darks([10, 1000])
+    library = DarkLibrary.fit(darks, quantum_ms=1.0, cache_size=2)
+    assert library.dark(100.2) is library.dark(99.8)
+    library.dark(200)
+    library.dark(300)
+    assert len(library._cache) == 2
+    assert library.corrector(300) is library.corrector(300.1)
+    assert library.corrector(300).id.endswith("@300ms")
+
+
+def test_save_and_load(tmp_path):
+    _, _, darks = make_darks([10, 1000])
+    library = DarkLibrary.fit(darks)
+    library.save(str(tmp_path / "library.npz"))
+    loaded = DarkLibrary.load(str(tmp_path / "library.npz"))
+    assert loaded.id == library.id
+    assert loaded.exposures_ms == [10.0, 1000.0]
+    assert np.array_equal(loaded.dark(400), library.dark(400))
@@ -0,0 +1,69 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from defect_map import DefectMap
+
+SHAPE = (16, 16)
+
+
+def index(y, x):
+    return y * SHAPE[1] + x
+
+
+def flat_dark(seed=0):
+    rng = np.random.default_rng(seed)
+    dark = rng.normal(100, 2, size=SHAPE).astype(np.float32)
+    noise = rng.uniform(2, 3, size=SHAPE).astype(np.float32)
+    return dark, noise
+
+
+def test_from_dark_finds_each_defect_class():
+    dark, noise = flat_dark()
+    dark[4, 5] = 400  # hot
+    noise[7, 7] = 30  # noisy
+    noise[10, 2] = 0  # stuck
+    defects = DefectMap.from_dark(dark, noise)
+    assert defects.hot.tolist() == [index(4, 5)]
+    assert defects.noisy.tolist() == [index(7, 7)]
+    assert defects.stuck.tolist() == [index(10, 2)]
+    assert np.flatnonzero(defects.mask).tolist() == sorted([index(4, 5), index(7, 7), index(10, 2)])
+
+
+def test_correct_uses_same_polarizer_neighbours():
+    frame = np.arange(SHAPE[0] * SHAPE[1], dtype=np.uint16).reshape(SHAPE)
+    frame[6, 6] = 4095
+    defects = DefectMap(SHAPE, hot=[index(6, 6)])
+    ring = [frame[6 + dy, 6 + dx] for dy in (-2, 0, 2) for dx in (-2, 0, 2) if dy or dx]
+    defects.correct(frame)
+    assert frame[6, 6] == round(np.mean(ring))
+
+
+def test_correct_falls_back_to_the_outer_ring():
+    frame = np.full(SHAPE, 50, dtype=np.uint16)
+    inner = [index(8 + dy, 8 + dx) for dy in (-2, 0, 2) for dx in (-2, 0, 2)]
+    frame.flat[inner] = 4095
+    defects = DefectMap(SHAPE, hot=inner)
+    defects.correct(frame)
+    assert frame[8, 8] == 50
+
+
+def test_window_correction_matches_full_frame():
+    rng = np.random.default_rng(1)
+    frame = rng.integers(0, 4096, size=SHAPE).astype(np.uint16)
+    defects = DefectMap(SHAPE, hot=[index(5, 9), index(12, 3)])
+    full = defects.correct(frame.copy())
+    window = (2, 14, 4, 14)
+    part = defects.correct(np.ascontiguousarray(frame[2:14, 4:14]), window=window)
+    # (12, 3) is outside the window, (5, 9) has all its neighbours inside it
+    assert part[5 - 2, 9 - 4] != frame[5, 9]
+    assert np.array_equal(part, full[2:14, 4:14])
+
+
+def test_save_and_load(tmp_path):
+    defects = DefectMap(SHAPE, hot=[3], noisy=[40], stuck=[100])
+    defects.save(str(tmp_path / "defects.npz"))
+    loaded = DefectMap.load(str(tmp_path / "defects.npz"))
+    assert loaded.shape == SHAPE
+    assert loaded.indices.tolist() == [3, 40, 100]
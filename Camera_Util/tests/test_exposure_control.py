@@ -0,0 +1,51 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from exposure_control import ExposureController
+
+DARK = 10
+FULL_SCALE = 4095
+
+
+## Linear sensor: raw max clips at full scale, the metered max is dark subtracted
+def meter(exposure, gain):
+    raw = min(FULL_SCALE, DARK + gain * exposure)
+    return raw - DARK, raw >= FULL_SCALE
+
+
+def run(controller, gain, max_iterations=30):
+    exposure = controller.start()
+    for _ in range(max_iterations):
+        stat, saturated = meter(exposure, gain)
+        converged, exposure = controller.update(exposure, stat, saturated=saturated)
+        if converged:
+            return exposure
+    return None
+
+
+def test_converges_from_saturation_with_dark_subtracted_stat():
+    controller = ExposureController(target=4050, tolerance=100, saturation=FULL_SCALE, initial_exposure=3000)
+    exposure = run(controller, gain=13.3)
+    assert exposure is not None
+    assert 4050 - 100 <= meter(exposure, 13.3)[0] <= 4050
+    assert controller.iterations[-1] <= 15
+
+
+def test_saturated_frame_in_target_range_is_not_accepted():
+    controller = ExposureController(target=4090, tolerance=100, saturation=FULL_SCALE, initial_exposure=1000)
+    controller.start()
+    converged, next_exposure = controller.update(1000, FULL_SCALE - DARK, saturated=True)
+    assert not converged
+    assert next_exposure < 1000
+
+
+def test_raw_stat_saturation_without_flag():
+    controller = ExposureController(target=4050, tolerance=100, saturation=FULL_SCALE, initial_exposure=3000)
+    exposure = controller.start()
+    for _ in range(30):
+        raw = min(FULL_SCALE, 13.3 * exposure)
+        converged, exposure = controller.update(exposure, raw)
+        if converged:
+            break
+    assert converged
@@ -0,0 +1,48 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from frame_catalog import FrameCatalog
+from frame_stats import frame_stats, count_saturated
+
+FULL_SCALE = 4095
+DARK = 10
+
+
+## Info dict of a frame as scene_imager records it, saturation counted on the raw counts
+def frame_info(raw, exposure_ms=10.0):
+    stats = frame_stats(np.maximum(raw, DARK) - DARK)
+    stats.saturated = count_saturated(raw, FULL_SCALE)
+    return {"shape": raw.shape, "dtype": raw.dtype, "exposure_ms": exposure_ms, "t_start": 0.0, **stats.as_dict()}
+
+
+def test_clipped_frame_is_excluded_from_unsaturated_pairs(tmp_path):
+    rng = np.random.default_rng(0)
+    clean = rng.integers(100, 3000, size=(32, 32)).astype(np.uint16)
+    clipped = clean.copy()
+    clipped[:4, :4] = FULL_SCALE
+
+    catalog = FrameCatalog(str(tmp_path / "frames.sqlite"))
+    try:
+        for name, raw in (("clean", clean), ("clipped", clipped)):
+            catalog.record(name, "tl", **frame_info(raw))
+            catalog.record(name, "cb", **frame_info(clean))
+
+        assert catalog.query("SELECT saturated FROM frames WHERE name = 'clipped' AND camera = 'tl'")[0]["saturated"] == 16
+        assert catalog.select_pairs("tl_saturated = 0") == ["clean"]
+        assert catalog.select_pairs("cb_saturated = 0") == ["clean", "clipped"]
+    finally:
+        catalog.close()
+
+
+def test_record_replaces_a_frame_and_ignores_unknown_keys(tmp_path):
+    catalog = FrameCatalog(str(tmp_path / "frames.sqlite"))
+    try:
+        catalog.record("a", "tl", snr=1.0, unknown="x")
+        catalog.record("a", "tl", snr=3.0, crop=(1, 2, 3, 4))
+        rows = catalog.query("SELECT snr, crop FROM frames")
+        assert len(catalog) == 1
+        assert rows == [{"snr": 3.0, "crop": "[1, 2, 3, 4]"}]
+    finally:
+        catalog.close()
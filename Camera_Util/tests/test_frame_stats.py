@@ -0,0 +1,51 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+from frame_stats import frame_stats, count_saturated
+
+
+def test_matches_numpy_over_chunks():
+    data = np.random.default_rng(0).integers(0, 4096, size=(3, 50, 70)).astype(np.uint16)
+    # Chunks much smaller than the frame, so the running sums are merged many times
+    stats = frame_stats(data, saturation=4000, chunk_bytes=256)
+    assert stats.min == data.min() and stats.max == data.max()
+    assert stats.mean == pytest.approx(data.mean())
+    assert stats.std == pytest.approx(data.std())
+    assert stats.snr == pytest.approx(data.mean() / data.std())
+    assert stats.saturated == np.count_nonzero(data >= 4000)
+
+
+def test_per_channel_and_combined():
+    rng = np.random.default_rng(1)
+    data = np.stack([rng.normal(m, s, size=(30, 30)) for m, s in ((10, 1), (200, 5), (3000, 40))]).astype(np.float32)
+    stats = frame_stats(data, per_channel=True, chunk_bytes=512)
+    assert np.allclose(stats.mean, data.mean(axis=(1, 2)), rtol=1e-6)
+    assert np.allclose(stats.std, data.std(axis=(1, 2), dtype=np.float64), rtol=1e-5)
+    assert stats.channel(1).max == data[1].max()
+
+    combined = stats.combined()
+    assert combined.mean == pytest.approx(data.mean(dtype=np.float64))
+    assert combined.std == pytest.approx(data.std(dtype=np.float64), rel=1e-5)
+
+
+def test_large_offset_keeps_precision():
+    # Far from zero, a plain sum of squares minus the squared sum would cancel out the variance
+    data = (1e6 + np.random.default_rng(2).normal(0, 1, size=100000)).astype(np.float64)
+    assert frame_stats(data).std == pytest.approx(data.std(), rel=1e-6)
+
+
+def test_flat_frame_has_zero_snr():
+    stats = frame_stats(np.full((4, 4), 7, dtype=np.uint16))
+    assert stats.std == 0 and stats.snr == 0
+
+
+def test_count_saturated_skips_masked_pixels():
+    raw = np.zeros((4, 4), dtype=np.uint16)
+    raw[0, :3] = 4095
+    mask = np.zeros((4, 4), dtype=bool)
+    mask[0, 0] = True
+    assert count_saturated(raw, 4095) == 3
+    assert count_saturated(raw, 4095, mask=mask) == 2
@@ -0,0 +1,43 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import importlib.util
+import numpy as np
+import pytest
+import tifffile
+from frame_writer import FrameWriter, tiff_options
+
+HAVE_IMAGECODECS = importlib.util.find_spec("imagecodecs") is not None
+
+
+def test_unknown_codec_is_rejected():
+    with pytest.raises(ValueError):
+        tiff_options("jpeg")
+
+
+def test_builtin_codec_without_predictor_is_always_available():
+    assert tiff_options("zlib", predictor=False)["compression"] == "zlib"
+    assert tiff_options("zlib", predictor=True, dtype=np.uint16)["predictor"] is True
+
+
+@pytest.mark.skipif(HAVE_IMAGECODECS, reason="imagecodecs is installed")
+def test_codecs_needing_imagecodecs_are_rejected_up_front():
+    with pytest.raises(ValueError, match="imagecodecs"):
+        tiff_options("lzw", predictor=False)
+    # The floating-point predictor needs imagecodecs too, the horizontal one does not
+    with pytest.raises(ValueError):
+        tiff_options("zlib", predictor=True, dtype=np.float32)
+
+
+def test_writer_round_trip_and_callbacks(tmp_path):
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 4096, size=(3, 16, 16)).astype(np.uint16) for _ in range(4)]
+    done = []
+    writer = FrameWriter(max_in_flight=2, num_workers=2)
+    for i, frame in enumerate(frames):
+        writer.submit(str(tmp_path / f"{i}.tif"), frame, on_done=done.append, **tiff_options("zlib", predictor=False))
+    assert writer.close() == []
+    assert done == [None] * len(frames)
+    for i, frame in enumerate(frames):
+        assert np.array_equal(tifffile.imread(str(tmp_path / f"{i}.tif")), frame)
@@ -0,0 +1,64 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dataset_collection"))
+
+import numpy as np
+import pytest
+from paired_store import PairedStore
+
+h5py = pytest.importorskip("h5py")
+
+
+def pair(seed):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 4096, size=(5, 6, 6)).astype(np.uint16), rng.random((4, 3, 3)).astype(np.float32)
+
+
+def test_append_and_reopen(tmp_path):
+    path = str(tmp_path / "dataset.h5")
+    store = PairedStore(path)
+    for i, name in enumerate(("a", "b")):
+        tl, cb = pair(i)
+        assert store.append(name, tl, cb, timestamp=100.0 + i, tl_exposure_ms=1.0, cb_exposure_ms=2.0) == i
+    # Re-capturing a pair overwrites its sample
+    tl, cb = pair(2)
+    assert store.append("a", tl, cb, timestamp=200.0, tl_exposure_ms=3.0, cb_exposure_ms=4.0) == 0
+    store.close()
+
+    with h5py.File(path, "r") as f:
+        assert f["tl"].shape == (2, 5, 6, 6)
+        assert np.array_equal(f["tl"][0], tl)
+        assert np.array_equal(f["cb"][0], cb)
+        assert f["tl_exposure_ms"][0] == 3.0
+
+    store = PairedStore(path)
+    try:
+        assert len(store) == 2 and store.names() == {"a", "b"}
+    finally:
+        store.close()
+
+
+def test_torn_sample_is_dropped_on_reopen(tmp_path):
+    path = str(tmp_path / "dataset.h5")
+    store = PairedStore(path)
+    tl, cb = pair(0)
+    store.append("a", tl, cb, timestamp=0.0, tl_exposure_ms=1.0, cb_exposure_ms=1.0)
+    store.close()
+
+    # Crash after resizing and writing the images, before the name
+    with h5py.File(path, "a") as f:
+        for key in f:
+            f[key].resize((2,) + f[key].shape[1:])
+        f["tl"][1] = tl
+
+    store = PairedStore(path)
+    try:
+        assert len(store) == 1
+        assert store.append("b", tl, cb, timestamp=1.0, tl_exposure_ms=1.0, cb_exposure_ms=1.0) == 1
+    finally:
+        store.close()
+
+
+def test_unknown_backend(tmp_path):
+    with pytest.raises(ValueError):
+        PairedStore(str(tmp_path / "dataset.h5"), backend="npz")
@@ -0,0 +1,75 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import polanalyser as pa
+from dark_correction import DarkCorrector
+from dark_library import DarkLibrary
+from defect_map import DefectMap
+from polar_processing import PolarStackProcessor, meter_window
+
+SHAPE = (40, 48)
+
+
+def random_raw(seed=0):
+    return np.random.default_rng(seed).integers(100, 4000, size=SHAPE).astype(np.uint16)
+
+
+## Reference: full-frame demosaic, then crop, like before the crop-then-demosaic pipeline
+def full_frame_stack(raw, window):
+    y1, y2, x1, x2 = window
+    channels = pa.demosaicing(img_raw=raw, code=pa.COLOR_PolarMono)
+    return np.stack([c[y1:y2, x1:x2] for c in channels] + [raw[y1:y2, x1:x2]])
+
+
+def test_stack_matches_full_frame_demosaic():
+    raw = random_raw()
+    # Odd window origin, the padded crop must stay aligned to the 2x2 superpixel
+    for window in [(5, 29, 7, 33), (0, 20, 0, 24), (20, 40, 28, 48)]:
+        processor = PolarStackProcessor(window)
+        stack = processor.process(raw)
+        assert np.array_equal(stack, full_frame_stack(raw, window).astype(stack.dtype))
+        processor.release(stack)
+
+
+def test_stack_with_dark_and_defects_matches_full_frame():
+    raw = random_raw(1)
+    dark = np.random.default_rng(2).integers(0, 200, size=SHAPE).astype(np.uint16)
+    corrector = DarkCorrector(dark, dtype="native")
+    defects = DefectMap(SHAPE, hot=[15 * SHAPE[1] + 17])
+    window = (9, 31, 11, 35)
+
+    expected = defects.correct(corrector.apply(raw))
+    stack = PolarStackProcessor(window).process(raw, dark=corrector, defects=defects)
+    assert np.array_equal(stack, full_frame_stack(expected, window).astype(stack.dtype))
+    # raw itself is left alone
+    assert np.array_equal(raw, random_raw(1))
+
+
+def test_meter_window_matches_demosaiced_max():
+    raw = random_raw(3)
+    window = (3, 27, 5, 41)
+    y1, y2, x1, x2 = window
+    channels = pa.demosaicing(img_raw=raw, code=pa.COLOR_PolarMono)
+    for i, angle in enumerate((0, 45, 90, 135)):
+        assert meter_window(raw, window, angle=angle) == channels[i][y1:y2, x1:x2].max()
+
+
+def test_meter_window_with_window_dark_and_mask():
+    raw = random_raw(4)
+    window = (3, 27, 5, 41)
+    y1, y2, x1, x2 = window
+    library = DarkLibrary.fit({10: np.full(SHAPE, 100.0), 1000: np.full(SHAPE, 300.0)})
+    full_dark = library.corrector(500, dtype="native").dark(np.uint16)
+    window_dark = library.window_dark(500, window, dtype=np.uint16)
+    assert meter_window(raw, window, dark=window_dark) == meter_window(raw, window, dark=full_dark)
+
+    # A masked hot pixel of the metered 0 degree channel neither sets the max nor counts as saturated
+    raw[5, 7] = 4095
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[5, 7] = True
+    assert meter_window(raw, window, dark=window_dark, saturation=4095) == (4095 - window_dark[5 - y1, 7 - x1], True)
+    stat, saturated = meter_window(raw, window, dark=window_dark, mask=mask, saturation=4095)
+    assert stat < 4095 - window_dark.max()
+    assert not saturated
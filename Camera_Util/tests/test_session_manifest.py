@@ -0,0 +1,39 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dataset_collection"))
+
+import json
+from session_manifest import SessionManifest
+
+
+def test_records_survive_reopening(tmp_path):
+    path = str(tmp_path / "session" / "manifest.jsonl")
+    manifest = SessionManifest(path)
+    manifest.record("a", tl="a_tl.tif")
+    manifest.record("b", tl="b_tl.tif")
+    manifest.close()
+
+    manifest = SessionManifest(path)
+    try:
+        assert manifest.completed_names() == {"a", "b"}
+        assert manifest.entries["a"]["tl"] == "a_tl.tif"
+    finally:
+        manifest.close()
+
+
+def test_torn_last_line_is_ignored_and_terminated(tmp_path):
+    path = str(tmp_path / "manifest.jsonl")
+    with open(path, "w") as f:
+        f.write(json.dumps({"name": "a"}) + "\n" + '{"name": "b", "tl": "b_t')  # crash during the write
+
+    manifest = SessionManifest(path)
+    try:
+        assert manifest.completed_names() == {"a"}
+        manifest.record("c")
+    finally:
+        manifest.close()
+
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert json.loads(lines[-1])["name"] == "c"
+    assert SessionManifest(path).completed_names() == {"a", "c"}
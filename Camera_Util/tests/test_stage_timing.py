@@ -0,0 +1,53 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from stage_timing import StageTimer
+from buffer_pool import BufferPool
+
+
+def test_stage_timer_keeps_running_totals_and_a_bounded_window():
+    timer = StageTimer(window=100)
+    for i in range(1, 10001):
+        timer.add("snap", i * 1e-3)
+    s = timer.summary()["snap"]
+    assert s["n"] == 10000
+    assert abs(s["total_s"] - sum(range(1, 10001)) * 1e-3) < 1e-6
+    assert abs(s["max_ms"] - 10000) < 1e-6
+    # Percentiles over the last 100 durations (9901..10000 ms)
+    assert 9901 <= s["p50_ms"] <= 10000
+    assert len(timer._stages["snap"][3]) == 100
+
+
+def test_stage_timer_disabled_records_nothing():
+    timer = StageTimer(enabled=False)
+    with timer.stage("snap"):
+        pass
+    assert timer.summary() == {}
+
+
+def test_buffer_pool_reuses_buffers_and_counts_outstanding():
+    pool = BufferPool(max_per_key=1)
+    a = pool.acquire((4, 4), np.uint16)
+    b = pool.acquire((4, 4), np.uint16)
+    assert pool.stats()["outstanding"] == 2
+    pool.release(a)
+    pool.release(b)
+    s = pool.stats()
+    assert (s["outstanding"], s["pooled"], s["dropped"]) == (0, 1, 1)
+    assert pool.acquire((4, 4), np.uint16) is a
+    assert pool.stats()["hits"] == 1
+
+
+def test_buffer_pool_ignores_foreign_arrays():
+    pool = BufferPool()
+    a = pool.acquire((4, 4), np.float32)
+    pool.release(np.empty((4, 4), np.float32))
+    pool.release(None)
+    s = pool.stats()
+    assert (s["outstanding"], s["pooled"]) == (1, 0)
+    pool.release(a)
+    pool.release(a)  # a second release of the same buffer is ignored too
+    s = pool.stats()
+    assert (s["outstanding"], s["pooled"]) == (0, 1)